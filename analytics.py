@@ -1,21 +1,56 @@
 """
 Simple analytics logging router.
 
-This module defines an endpoint that accepts analytics log entries from
-the frontend and appends them to a newline-delimited JSON file.  It
+This module defines endpoints that accept analytics log entries from
+the frontend and append them to a newline-delimited JSON file.  It
 records the client's IP and a human-readable timestamp for easy
 analysis.  In production, consider piping these logs to a proper
 database or analytics service instead of a flat file.
+
+Handlers only enqueue entries.  A background writer drains the bounded
+queue and appends whole batches with a single write, rotating the file
+once it grows past `ANALYTICS_ROTATE_BYTES` or gets older than
+`ANALYTICS_ROTATE_SECONDS` (its creation time is kept in `<log>.created`,
+so restarts do not reset the age); rotated files are gzip-compressed and
+named `<log>.<UTC time>-<sequence>.gz`.  When the
+queue is full new entries are dropped and counted rather than slowing the
+request down.  Anything still buffered is written on shutdown.
+
+When several workers append to the same file (shared.enabled), each batch
+is written under an exclusive lock on `<log>.lock`, and a worker that
+finds the file was rotated by another one reopens it first.
 """
 
 from fastapi import APIRouter, Request
 from pydantic import BaseModel
+from typing import List, Optional
+import asyncio
+import contextlib
 import datetime
+import gzip
 import json
+import logging
 import os
+import shutil
+import threading
+import time
+
+import shared
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+ANALYTICS_QUEUE_SIZE = int(os.environ.get("ANALYTICS_QUEUE_SIZE", 10000))
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", 500))
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 1))
+ANALYTICS_ROTATE_BYTES = int(os.environ.get("ANALYTICS_ROTATE_BYTES", 50 * 1024 * 1024))
+ANALYTICS_ROTATE_SECONDS = float(os.environ.get("ANALYTICS_ROTATE_SECONDS", 24 * 60 * 60))
 
 
 class AnalyticsLog(BaseModel):
@@ -28,19 +63,188 @@ class AnalyticsLog(BaseModel):
     timestamp: int
 
 
+class AnalyticsWriter:
+    """Group-commits queued entries to the log file from a background task."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.queue: Optional[asyncio.Queue] = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.rotations = 0
+        self._file = None
+        self._created_at = 0.0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, entry: dict) -> bool:
+        if self.queue is None:
+            self.queue = asyncio.Queue(ANALYTICS_QUEUE_SIZE)
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def _drain(self, first: dict) -> List[dict]:
+        batch = [first]
+        while len(batch) < ANALYTICS_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    def _write(self, batch: List[dict]) -> None:
+        with self._lock:
+            self._write_locked(batch)
+
+    @contextlib.contextmanager
+    def _across_workers(self):
+        if not shared.enabled or fcntl is None:
+            yield
+            return
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            if self._file is not None and self._rotated_elsewhere():
+                self._file.close()
+                self._file = None
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _rotated_elsewhere(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _write_locked(self, batch: List[dict]) -> None:
+        with self._across_workers():
+            self._append(batch)
+
+    def _append(self, batch: List[dict]) -> None:
+        if self._file is None:
+            self._open()
+        self._file.write("".join(json.dumps(entry) + "\n" for entry in batch))
+        self._file.flush()
+        self.written += len(batch)
+        self.batches += 1
+        if self._file.tell() >= ANALYTICS_ROTATE_BYTES or time.time() - self._created_at >= ANALYTICS_ROTATE_SECONDS:
+            self._rotate()
+
+    def _open(self) -> None:
+        self._file = open(self.path, "a")
+        marker = self.path + ".created"
+        if self._file.tell():
+            try:
+                with open(marker) as f:
+                    self._created_at = float(f.read())
+                return
+            except (OSError, ValueError):
+                pass
+        # a new log file, or one from before the marker existed
+        self._created_at = time.time()
+        with open(marker, "w") as f:
+            f.write(repr(self._created_at))
+
+    def _rotated_name(self) -> str:
+        """A free name for the file being rotated; the sequence keeps rotations within one second apart and in order."""
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        sequence = 0
+        while True:
+            rotated = f"{self.path}.{stamp}-{sequence:03d}"
+            if not os.path.exists(rotated) and not os.path.exists(rotated + ".gz"):
+                return rotated
+            sequence += 1
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        rotated = self._rotated_name()
+        os.replace(self.path, rotated)
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        self.rotations += 1
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self.queue.get()
+            batch = self._drain(first)
+            try:
+                await loop.run_in_executor(None, self._write, batch)
+            except Exception:
+                self.dropped += len(batch)
+                logger.exception("failed to write %d analytics entries", len(batch))
+            if self.queue.empty():
+                await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+
+    async def start(self) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue(ANALYTICS_QUEUE_SIZE)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self.queue is not None and not self.queue.empty():
+            self._write(self._drain(self.queue.get_nowait()))
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "rotations": self.rotations
+        }
+
+
+writer = AnalyticsWriter(os.environ.get("ANALYTICS_LOG", "analytics.log"))
+
+
+def _entry(log: AnalyticsLog, request: Request) -> dict:
+    data = log.dict()
+    data["ip"] = request.client.host
+    data["ts_readable"] = datetime.datetime.fromtimestamp(data["timestamp"] / 1000).isoformat()
+    return data
+
+
 @router.post("/log")
 async def log_analytics(log: AnalyticsLog, request: Request) -> dict:
     """
-    Append a log entry to the analytics log file.
+    Queue a log entry for the analytics log file.
 
     The log file location can be customized via the `ANALYTICS_LOG`
     environment variable; it defaults to `analytics.log` in the current
     working directory.  Each line in the file is a JSON object.
     """
-    data = log.dict()
-    data["ip"] = request.client.host
-    data["ts_readable"] = datetime.datetime.fromtimestamp(data["timestamp"] / 1000).isoformat()
-    log_path = os.environ.get("ANALYTICS_LOG", "analytics.log")
-    with open(log_path, "a") as f:
-        f.write(json.dumps(data) + "\n")
-    return {"status": "ok"}
+    accepted = writer.submit(_entry(log, request))
+    return {"status": "ok" if accepted else "dropped"}
+
+
+@router.post("/log/bulk")
+async def log_analytics_bulk(logs: List[AnalyticsLog], request: Request) -> dict:
+    """Queue many log entries from one request."""
+    accepted = sum(writer.submit(_entry(log, request)) for log in logs)
+    return {"status": "ok", "accepted": accepted, "dropped": len(logs) - accepted}
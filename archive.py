@@ -0,0 +1,343 @@
+"""
+Retention for rodeoai.db: archived conversations, usage rollups and vacuum.
+
+Conversations nobody has touched for `ARCHIVE_AFTER_DAYS` move out of the
+database.  Their messages are written to segment files under
+`ARCHIVE_DIR`, one zlib-compressed JSON record per conversation, and
+deleted from `messages`; the conversation row stays (title, summary,
+history listing) with `archived` set.  A segment is named after the
+SHA-256 of its bytes and never changes once written, so backups copy each
+one once.  `archived_conversations` maps a conversation to its record
+(segment, offset, length) and to the range of message ids it holds.
+
+Reads stay transparent: db_models.get_conversation_messages, list_messages
+and get_message fall back to the archive when the hot tables have nothing,
+reading just that record.  A new turn on an archived conversation restores
+it (`restore`) before it is stored.  Archived messages are not in the
+search index until then.
+
+`usage_logs` rows older than `USAGE_ROLLUP_AFTER_DAYS` are folded into
+`usage_daily` (requests, tokens and cost per user, day and model) and
+deleted, but only once the columnar analytics store has copied them.
+
+After archiving, the search index is merged to drop the archived
+messages' entries, and the freed pages are given back to the file system
+with `PRAGMA incremental_vacuum`, a few at a time.  Databases created before this
+change have no auto-vacuum and need one full `python archive.py vacuum`
+first.
+
+A pass runs every `ARCHIVE_INTERVAL` seconds as a background job (jobs.py),
+so one worker at a time does it, for at most `ARCHIVE_PASS_SECONDS`.
+
+    python archive.py              # run a pass now
+    python archive.py status
+    python archive.py vacuum       # enable incremental vacuum (rewrites the file)
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import columnar
+import jobs
+import store
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 90))
+USAGE_ROLLUP_AFTER_DAYS = float(os.getenv("USAGE_ROLLUP_AFTER_DAYS", 30))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600))
+ARCHIVE_PASS_SECONDS = float(os.getenv("ARCHIVE_PASS_SECONDS", 30))
+# Conversations per segment, usage_logs ids per rollup transaction, pages per vacuum step
+ARCHIVE_BATCH = 500
+ROLLUP_BATCH = 50000
+VACUUM_PAGES = 2000
+
+MESSAGE_COLUMNS = ("id", "role", "content", "tokens_used", "model", "status", "created_at")
+
+logger = logging.getLogger(__name__)
+last_pass: Optional[dict] = None
+_merge_pending = False
+
+
+def _cutoff(days: float) -> str:
+    return (datetime.utcnow() - timedelta(days=days)).isoformat()
+
+
+def _segment_path(segment: str) -> str:
+    return os.path.join(ARCHIVE_DIR, segment[:2], segment + ".seg")
+
+
+def _write_segment(blob: bytes) -> str:
+    segment = hashlib.sha256(blob).hexdigest()
+    path = _segment_path(segment)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+    return segment
+
+
+@functools.lru_cache(maxsize=64)
+def _read_record(segment: str, offset: int, length: int) -> tuple:
+    with open(_segment_path(segment), "rb") as f:
+        f.seek(offset)
+        record = json.loads(zlib.decompress(f.read(length)))
+    return tuple(record["messages"])
+
+
+# -- archiving ------------------------------------------------------------
+
+def archive_batch(cutoff: str, limit: int = ARCHIVE_BATCH) -> int:
+    """Move up to `limit` conversations idle since `cutoff` into one segment; returns how many moved."""
+    with store.connection() as conn:
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM conversations WHERE archived = 0 AND updated_at < ? ORDER BY updated_at LIMIT ?", (cutoff, limit)
+        )]
+        if not ids:
+            return 0
+        placeholders = ",".join("?" * len(ids))
+        rows = conn.execute(
+            f"SELECT conversation_id, {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE conversation_id IN ({placeholders}) ORDER BY conversation_id, id",
+            ids
+        ).fetchall()
+    by_conversation: Dict[int, List[dict]] = {conversation_id: [] for conversation_id in ids}
+    for row in rows:
+        by_conversation[row["conversation_id"]].append({column: row[column] for column in MESSAGE_COLUMNS})
+
+    chunks, entries, offset = [], [], 0
+    for conversation_id, messages in by_conversation.items():
+        chunk = zlib.compress(json.dumps({"conversation_id": conversation_id, "messages": messages}).encode(), 6)
+        entries.append((conversation_id, offset, len(chunk), len(messages),
+                        messages[0]["id"] if messages else None, messages[-1]["id"] if messages else None))
+        chunks.append(chunk)
+        offset += len(chunk)
+    segment = _write_segment(b"".join(chunks))
+
+    now = time.time()
+    with store.connection() as conn:
+        # conversations that got a new turn since they were read stay where they are
+        moved = {row[0] for row in conn.execute(
+            f"UPDATE conversations SET archived = 1 WHERE id IN ({placeholders}) AND archived = 0 AND updated_at < ? RETURNING id",
+            ids + [cutoff]
+        )}
+        conn.executemany(
+            "INSERT INTO archived_conversations (conversation_id, segment, byte_offset, byte_length, messages, first_message, last_message, archived_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(conversation_id, segment, offset, length, count, first, last, now)
+             for conversation_id, offset, length, count, first, last in entries if conversation_id in moved]
+        )
+        conn.execute(f"DELETE FROM messages WHERE conversation_id IN ({','.join('?' * len(moved))})", list(moved))
+    return len(moved)
+
+
+def read_messages(conversation_id: int) -> Optional[List[dict]]:
+    """Messages of an archived conversation, oldest first; None when it is not archived."""
+    with store.connection() as conn:
+        row = conn.execute(
+            "SELECT segment, byte_offset, byte_length FROM archived_conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return [dict(message, conversation_id=conversation_id) for message in _read_record(*row)]
+
+
+def find_message(message_id: int) -> Optional[dict]:
+    """An archived message by id, or None."""
+    with store.connection() as conn:
+        candidates = conn.execute(
+            "SELECT conversation_id FROM archived_conversations WHERE first_message <= ? AND last_message >= ?", (message_id, message_id)
+        ).fetchall()
+    for (conversation_id,) in candidates:
+        for message in read_messages(conversation_id) or ():
+            if message["id"] == message_id:
+                return message
+    return None
+
+
+def restore(conversation_id: int) -> int:
+    """Bring an archived conversation's messages back into the database; returns how many."""
+    messages = read_messages(conversation_id)
+    if messages is None:
+        return 0
+    with store.connection() as conn:
+        row = conn.execute("DELETE FROM archived_conversations WHERE conversation_id = ? RETURNING segment", (conversation_id,)).fetchone()
+        if row is None:
+            return 0  # restored meanwhile
+        conn.executemany(
+            f"INSERT INTO messages (conversation_id, {', '.join(MESSAGE_COLUMNS)}) VALUES (?, {', '.join('?' * len(MESSAGE_COLUMNS))})",
+            [(conversation_id,) + tuple(message[column] for column in MESSAGE_COLUMNS) for message in messages]
+        )
+        # touched now, so the next pass does not archive it again before its new turn is stored
+        conn.execute("UPDATE conversations SET archived = 0, updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), conversation_id))
+    return len(messages)
+
+
+def remove_unused_segments() -> int:
+    """Delete segment files no archived conversation points into any more."""
+    with store.connection() as conn:
+        used = {row[0] for row in conn.execute("SELECT DISTINCT segment FROM archived_conversations")}
+    removed = 0
+    for directory, _, files in os.walk(ARCHIVE_DIR):
+        for name in files:
+            if name.endswith(".seg") and name[:-4] not in used:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+    return removed
+
+
+# -- usage rollup ---------------------------------------------------------
+
+def rollup_usage(cutoff: str) -> int:
+    """Fold `usage_logs` rows from before `cutoff` into `usage_daily`; returns the rows folded."""
+    # "YYYY-MM-DD HH:MM:SS", the format usage_logs.created_at is written in
+    cutoff = cutoff.replace("T", " ")[:19]
+    upto = columnar.compacted_usage_id()
+    total = 0
+    with store.connection() as conn:
+        start = conn.execute("SELECT coalesce(min(id), 0) FROM usage_logs").fetchone()[0]
+    while start and start <= upto:
+        end = min(start + ROLLUP_BATCH - 1, upto)
+        with store.connection() as conn:
+            conn.execute("""
+                INSERT INTO usage_daily (user_id, day, model, requests, prompt_tokens, completion_tokens, total_tokens, cost)
+                SELECT user_id, substr(created_at, 1, 10), model, count(*), sum(prompt_tokens), sum(completion_tokens), sum(total_tokens), sum(cost)
+                FROM usage_logs WHERE id BETWEEN ? AND ? AND created_at < ?
+                GROUP BY user_id, substr(created_at, 1, 10), model
+                ON CONFLICT (user_id, day, model) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    cost = cost + excluded.cost
+            """, (start, end, cutoff))
+            total += conn.execute("DELETE FROM usage_logs WHERE id BETWEEN ? AND ? AND created_at < ?", (start, end, cutoff)).rowcount
+        start = end + 1
+    return total
+
+
+# -- vacuum ---------------------------------------------------------------
+
+def vacuum_step(pages: int = VACUUM_PAGES) -> int:
+    """Give up to `pages` free pages back to the file system; returns how many were freed."""
+    with store.connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if before:
+            # execute() steps the pragma once, which frees a single page; executescript runs it to the end
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def merge_search_step(pages: int = VACUUM_PAGES) -> bool:
+    """Merge `messages_fts` segments, dropping the entries of deleted messages; False once nothing is left to merge."""
+    # FTS5 deletes only add tombstones, which slow every query until a merge removes them
+    with store.connection() as conn:
+        before = conn.total_changes
+        conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', ?)", (-int(pages),))
+        return conn.total_changes - before >= 2
+
+
+def enable_incremental_vacuum() -> None:
+    """Switch an existing database to incremental auto-vacuum; a full VACUUM, which rewrites the file."""
+    with store.connection() as conn:
+        conn.commit()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+# -- passes ---------------------------------------------------------------
+
+def run_pass(budget: float = ARCHIVE_PASS_SECONDS) -> dict:
+    """Archive, roll up and vacuum for up to about `budget` seconds; `done` is False if work is left."""
+    global last_pass, _merge_pending
+    started = time.monotonic()
+    result = {"conversations": 0, "usage_rows": 0, "segments_removed": 0, "pages_freed": 0, "done": True}
+    cutoff = _cutoff(ARCHIVE_AFTER_DAYS)
+    while True:
+        moved = archive_batch(cutoff)
+        result["conversations"] += moved
+        if moved < ARCHIVE_BATCH:
+            break
+        if time.monotonic() - started >= budget:
+            result["done"] = False
+            break
+    result["usage_rows"] = rollup_usage(_cutoff(USAGE_ROLLUP_AFTER_DAYS))
+    result["segments_removed"] = remove_unused_segments()
+    if result["conversations"]:
+        _merge_pending = True
+    while _merge_pending and time.monotonic() - started < budget:
+        _merge_pending = merge_search_step()
+    while time.monotonic() - started < budget:
+        freed = vacuum_step()
+        result["pages_freed"] += freed
+        if freed < VACUUM_PAGES:
+            break
+    else:
+        result["done"] = False
+    if _merge_pending:
+        result["done"] = False
+    result["seconds"] = round(time.monotonic() - started, 2)
+    last_pass = dict(result, finished=datetime.utcnow().isoformat())
+    return result
+
+
+async def _run_job(payloads: List[dict]) -> None:
+    result = await store.run(run_pass)
+    if result["conversations"] or result["usage_rows"]:
+        logger.info("archive pass: %s", result)
+    await store.run(jobs.enqueue, "archive", {}, "archive", None, ARCHIVE_INTERVAL if result["done"] else 0)
+
+
+def schedule() -> None:
+    """Make sure a pass is queued (the first one a minute after start-up)."""
+    if ARCHIVE_INTERVAL > 0:
+        jobs.defer("archive", {}, key="archive", delay=min(60, ARCHIVE_INTERVAL))
+
+
+jobs.register("archive", _run_job, priority=2)
+
+
+def status() -> dict:
+    with store.connection() as conn:
+        pages, free, page_size = (conn.execute(f"PRAGMA {name}").fetchone()[0] for name in ("page_count", "freelist_count", "page_size"))
+        archived, segments, archived_messages = conn.execute(
+            "SELECT count(*), count(DISTINCT segment), coalesce(sum(messages), 0) FROM archived_conversations"
+        ).fetchone()
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    segment_bytes = sum(os.path.getsize(os.path.join(d, name)) for d, _, files in os.walk(ARCHIVE_DIR) for name in files if name.endswith(".seg"))
+    return {
+        "database_bytes": pages * page_size,
+        "free_bytes": free * page_size,
+        "incremental_vacuum": auto_vacuum == 2,
+        "archived_conversations": archived,
+        "archived_messages": archived_messages,
+        "segments": segments,
+        "segment_bytes": segment_bytes,
+    }
+
+
+def stats() -> dict:
+    return {"after_days": ARCHIVE_AFTER_DAYS, "last_pass": last_pass}
+
+
+if __name__ == "__main__":
+    import db_models  # noqa: F401  (the schema)
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "vacuum":
+        enable_incremental_vacuum()
+    elif command == "run":
+        while not run_pass()["done"]:
+            pass
+        print(json.dumps(last_pass, indent=2))
+    print(json.dumps(status(), indent=2))
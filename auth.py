@@ -1,15 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
-import sqlite3
 import os
-import hashlib
+import time
+import db_models  # registers the schema setup (users table) run on first connection
+import passwords
+import store
+from cache import token_cache, user_cache
+from store import connection
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
 ALGORITHM = "HS256"
@@ -27,33 +32,6 @@ class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
 
-def get_db():
-    conn = sqlite3.connect("rodeoai.db")
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            tier TEXT DEFAULT 'free',
-            daily_usage INTEGER DEFAULT 0,
-            last_reset TEXT DEFAULT CURRENT_TIMESTAMP,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def get_password_hash(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return get_password_hash(plain_password) == hashed_password
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -64,23 +42,35 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def decode_token(token: str):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         return None
+    token_cache.set(token, payload, ttl=payload["exp"] - time.time() if "exp" in payload else None)
+    return payload
 
 def get_user_by_email(email: str):
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
-    conn.close()
+    with connection() as conn:
+        user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
     return dict(user) if user else None
 
 def get_user_by_id(user_id: int):
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    with connection() as conn:
+        user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
     return dict(user) if user else None
 
+def create_user(email: str, password_hash: str) -> int:
+    with connection() as conn:
+        cursor = conn.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (email, password_hash))
+        return cursor.lastrowid
+
+def update_password_hash(user_id: int, old_hash: str, new_hash: str):
+    with connection() as conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?", (new_hash, user_id, old_hash))
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = decode_token(token)
@@ -89,34 +79,44 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     user_id = payload.get("user_id")
     if not user_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    user = get_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return user
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await store.run(get_user_by_id, user_id)
+        if not user:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        user_cache.set(user_id, user)
+    return dict(user)
+
+async def get_optional_user(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    request.state.auth_started = time.perf_counter()
+    try:
+        if credentials is None:
+            return None
+        return await get_current_user(credentials)
+    finally:
+        request.state.auth_seconds = time.perf_counter() - request.state.auth_started
 
 @router.post("/register", response_model=Token)
 async def register(user_data: UserRegister):
-    if get_user_by_email(user_data.email):
+    if await store.run(get_user_by_email, user_data.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
-    password_hash = get_password_hash(user_data.password)
-    conn = get_db()
-    cursor = conn.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (user_data.email, password_hash))
-    user_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    password_hash = await passwords.hash_password(user_data.password)
+    user_id = await store.run(create_user, user_data.email, password_hash)
     access_token = create_access_token(data={"user_id": user_id})
     return {"access_token": access_token}
 
 @router.post("/login", response_model=Token)
 async def login(user_data: UserLogin):
-    user = get_user_by_email(user_data.email)
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    user = await store.run(get_user_by_email, user_data.email)
+    ok, new_hash = await passwords.verify(user_data.password, user["password_hash"] if user else None)
+    if not ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+    if new_hash is not None:
+        await store.run(update_password_hash, user["id"], user["password_hash"], new_hash)
+        user_cache.invalidate(user["id"])
     access_token = create_access_token(data={"user_id": user["id"]})
     return {"access_token": access_token}
 
 @router.get("/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
     return {"id": current_user["id"], "email": current_user["email"], "tier": current_user["tier"]}
-
-init_db()
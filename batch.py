@@ -0,0 +1,105 @@
+"""
+Batched chat: many independent prompts in one request.
+
+`POST /api/chat/batch` (main.py) takes up to `BATCH_MAX_ITEMS` chat
+requests, e.g. one coaching tip per event on a dashboard.  `fan_out` runs
+them at most `parallelism` at a time (`BATCH_PARALLELISM` by default and at
+most) and yields each result as soon as it is ready, tagged with the
+item's index in the request, so one slow answer does not hold back the
+others.  An item that fails becomes an error event of its own; the rest of
+the batch carries on.  A final event counts the completed and failed items.
+
+Every item still goes through the response cache, single-flight and the
+scheduler like a single chat, taking its own ticket, so a batch gets no
+more upstream slots than the same requests sent one by one.  Keeping
+`BATCH_PARALLELISM` below `SCHEDULER_MAX_PER_USER` keeps a batch from
+being shed by the per-caller queue limit.
+
+Results are streamed as NDJSON, one JSON object per line, or as SSE
+`data:` frames (with heartbeats) to clients that accept
+`text/event-stream`:
+
+    {"index": 2, "model": "scamper", "content": "...", "source": "upstream"}
+    {"index": 0, "error": "Too many queued requests for this model", "status": 429}
+    {"done": true, "completed": 1, "failed": 1}
+"""
+
+import asyncio
+import json
+import os
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+import sse
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 50))
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", 8))
+
+NDJSON = "application/x-ndjson"
+
+
+async def fan_out(count: int, run_item: Callable[[int], Awaitable[dict]], parallelism: int = BATCH_PARALLELISM, heartbeat: float = 0) -> AsyncGenerator[Optional[dict], None]:
+    """Results of `run_item(0)` .. `run_item(count - 1)` in the order they finish.
+
+    Each result gets its "index"; an item that raises yields its error and
+    status instead.  With `heartbeat`, None is yielded whenever no item has
+    finished for that many seconds.  Closing the generator cancels the
+    items still running.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+    finished: asyncio.Queue = asyncio.Queue()
+
+    async def one(index: int) -> None:
+        async with semaphore:
+            try:
+                result = await run_item(index)
+            except HTTPException as e:
+                result = {"error": e.detail, "status": e.status_code}
+            except Exception as e:
+                result = {"error": str(e), "status": 500}
+        finished.put_nowait({"index": index, **result})
+
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(one(index)) for index in range(count)]
+    try:
+        for _ in range(count):
+            while True:
+                try:
+                    yield await asyncio.wait_for(finished.get(), heartbeat if heartbeat > 0 else None)
+                    break
+                except asyncio.TimeoutError:
+                    yield None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def frames(results: AsyncGenerator[Optional[dict], None], event_stream: bool) -> AsyncGenerator[bytes, None]:
+    completed = failed = 0
+    async for result in results:
+        if result is None:
+            if event_stream:
+                yield sse.HEARTBEAT_FRAME
+            continue
+        if "error" in result:
+            failed += 1
+        else:
+            completed += 1
+        yield encode(result, event_stream)
+    yield encode({"done": True, "completed": completed, "failed": failed}, event_stream)
+
+
+def encode(event: dict, event_stream: bool) -> bytes:
+    body = json.dumps(event).encode()
+    return b"data: " + body + b"\n\n" if event_stream else body + b"\n"
+
+
+def stream(count: int, run_item: Callable[[int], Awaitable[dict]], parallelism: int, accept: str = "", accept_encoding: str = "", extra_headers: Optional[dict] = None) -> StreamingResponse:
+    """Run a batch and stream its results as SSE if `accept` asks for it, NDJSON otherwise."""
+    event_stream = "text/event-stream" in accept
+    results = fan_out(count, run_item, min(parallelism, BATCH_PARALLELISM), sse.SSE_HEARTBEAT if event_stream else 0)
+    return sse.event_stream(frames(results, event_stream), accept_encoding, extra_headers,
+                            media_type="text/event-stream" if event_stream else NDJSON)
@@ -0,0 +1,1219 @@
+"""
+Load benchmarks for the RodeoAI backend.
+
+Each scenario starts fake_openai.py and the API as separate single-worker
+uvicorn processes on local ports (in a scratch directory, so the real
+rodeoai.db is never touched), drives a workload and prints a JSON report:
+
+    python bench.py sse --concurrency 1,10,50,100
+
+The `db` scenario runs in-process against a synthetic database.  `mixed`
+drives a weighted blend of register/login, /api/auth/me, streaming and
+non-streaming chat and analytics logging, and reports per-operation
+throughput and latency plus the API's event-loop lag (scraped from
+/metrics).  `workers` runs the API the way `python main.py` does with
+1..N worker processes and drives it from several client processes for a
+fixed time.  Scenarios that check expectations (`coalesce`, `router`)
+list the ones not met under "failed" and exit with status 1.  Reports
+carry the git revision and arguments; pass `--baseline old.json` to add
+the relative change of every number:
+
+    python bench.py mixed --output new.json --baseline old.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS: Dict[str, Callable] = {}
+
+
+def scenario(name: str):
+    def register(fn):
+        SCENARIOS[name] = fn
+        return fn
+    return register
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples: List[float]) -> dict:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def check(report: dict, ok: bool, message: str) -> None:
+    """Record a failed expectation in `report`; `main` exits non-zero if there are any."""
+    if not ok:
+        report.setdefault("failed", []).append(message)
+
+
+@contextlib.contextmanager
+def serve(app: str, env: dict, cwd: str, workers: int = 1):
+    """Run `app` under uvicorn and yield its base URL once it answers."""
+    port = free_port()
+    proc_env = dict(os.environ, PYTHONPATH=ROOT, **env)
+    cmd = [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning"]
+    if app == "main:app" and workers > 1:
+        # the API's own supervisor and shared state (serve.py), as deployed
+        cmd = [sys.executable, os.path.join(ROOT, "main.py")]
+        proc_env.update(PORT=str(port), WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen(cmd, cwd=cwd, env=proc_env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                httpx.get(url + "/", timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.time() > deadline or proc.poll() is not None:
+                    raise RuntimeError(f"{app} did not start")
+                time.sleep(0.1)
+        yield url
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+@contextlib.contextmanager
+def stack(fake_env: dict = None, app_env: dict = None, workers: int = 1):
+    """Fake upstream plus the API pointed at it; yields (api_url, fake_url)."""
+    with tempfile.TemporaryDirectory() as workdir:
+        with serve("fake_openai:app", fake_env or {}, workdir) as fake_url:
+            env = {"OPENAI_API_KEY": "sk-bench", "OPENAI_BASE_URL": fake_url + "/v1", **(app_env or {})}
+            with serve("main:app", env, workdir, workers) as api_url:
+                yield api_url, fake_url
+
+
+async def read_sse(client: httpx.AsyncClient, url: str, payload: dict, headers: dict = None) -> dict:
+    """Consume one SSE response, time its first frame and completion, and collect the answer text."""
+    start = time.perf_counter()
+    ttft = None
+    frames = 0
+    text = []
+    async with client.stream("POST", url, json=payload, headers=headers) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data:"):
+                frames += 1
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                if line.startswith('data: {"content"'):
+                    text.append(json.loads(line[5:])["content"])
+    return {"ttft": ttft or 0.0, "duration": time.perf_counter() - start, "frames": frames, "text": "".join(text),
+            "bytes": response.num_bytes_downloaded, "status": response.status_code}
+
+
+def fake_env(args) -> dict:
+    return {"FAKE_TTFT": str(args.ttft), "FAKE_TPS": str(args.tps), "FAKE_TOKENS": str(args.tokens),
+            "FAKE_ERROR_RATE": str(args.error_rate)}
+
+
+def chat_payload(model: str = "scamper", text: str = "What is the NFR schedule?", stream: bool = True) -> dict:
+    return {"model": model, "stream": stream, "messages": [{"role": "user", "content": text}]}
+
+
+@scenario("coldstart")
+async def bench_coldstart(args) -> dict:
+    """Cold start: `import main`, process start to first answer, and the first request of each kind."""
+    import statistics
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=ROOT, RODEOAI_DB=os.path.join(workdir, "rodeoai.db"),
+               ANALYTICS_LOG=os.path.join(workdir, "analytics.log"))
+    imports = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import main"], cwd=workdir, env=env, check=True)
+        imports.append(time.perf_counter() - start)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as fakedir, serve("fake_openai:app", fake_env(args), fakedir) as fake_url:
+        env.update(OPENAI_API_KEY="sk-bench", OPENAI_BASE_URL=fake_url + "/v1")
+        for run in range(args.runs):
+            if run == 0 and os.path.exists(env["RODEOAI_DB"]):
+                os.remove(env["RODEOAI_DB"])  # the first start creates the schema, later ones find it
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            start = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                                    cwd=workdir, env=env)
+            try:
+                async with httpx.AsyncClient(timeout=60) as client:
+                    while True:
+                        try:
+                            await client.get(url + "/api/models")
+                            break
+                        except httpx.HTTPError:
+                            if proc.poll() is not None:
+                                raise RuntimeError("main:app did not start")
+                            await asyncio.sleep(0.01)
+                    result = {"ready_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+                    async def first(name, request):
+                        began = time.perf_counter()
+                        await request
+                        result[name + "_ms"] = round((time.perf_counter() - began) * 1000, 1)
+
+                    await first("register", client.post(url + "/api/auth/register", json={"email": f"cold{run}@example.com", "password": "eight-seconds"}))
+                    began = time.perf_counter()
+                    sse = await read_sse(client, url + "/api/chat", chat_payload(text=f"cold start {run}"))
+                    result["chat_ttft_ms"] = round(sse["ttft"] * 1000, 1)
+                    result["chat_total_ms"] = round((time.perf_counter() - began) * 1000, 1)
+                    runs.append(result)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=30)
+
+    def median(key, rows):
+        return round(statistics.median(row[key] for row in rows), 1) if rows else None
+
+    later = runs[1:]
+    return {
+        "scenario": "coldstart",
+        "import_main_ms": {"median": round(statistics.median(imports) * 1000, 1), "min": round(min(imports) * 1000, 1)},
+        "new_database": runs[0],
+        "existing_database": {key: median(key, later) for key in runs[0]} if later else None,
+        "fake_ttft_ms": args.ttft * 1000,
+    }
+
+
+@scenario("batch")
+async def bench_batch(args) -> dict:
+    """N prompts as N sequential /api/chat calls, N concurrent calls, and one /api/chat/batch request."""
+    results = []
+    with stack(fake_env(args), {"RESPONSE_CACHE_BACKEND": "off"}) as (api_url, _):
+        async with httpx.AsyncClient(timeout=120) as client:
+            for size in args.concurrency:
+                payloads = [chat_payload(text=f"tip for event {size}-{i}", stream=False) for i in range(size)]
+                start = time.perf_counter()
+                for payload in payloads:
+                    await client.post(api_url + "/api/chat", json=payload)
+                sequential = time.perf_counter() - start
+
+                start = time.perf_counter()
+                await asyncio.gather(*[client.post(api_url + "/api/chat", json=dict(payload, messages=[{"role": "user", "content": "again " + payload["messages"][0]["content"]}])) for payload in payloads])
+                concurrent = time.perf_counter() - start
+
+                items = [{"model": p["model"], "messages": [{"role": "user", "content": "batch " + p["messages"][0]["content"]}]} for p in payloads]
+                start = time.perf_counter()
+                first = None
+                events = []
+                async with client.stream("POST", api_url + "/api/chat/batch", json={"requests": items}) as response:
+                    async for line in response.aiter_lines():
+                        if line:
+                            first = first or time.perf_counter() - start
+                            events.append(json.loads(line))
+                batched = time.perf_counter() - start
+                results.append({
+                    "items": size,
+                    "sequential_ms": round(sequential * 1000, 1),
+                    "concurrent_requests_ms": round(concurrent * 1000, 1),
+                    "batch_ms": round(batched * 1000, 1),
+                    "batch_first_result_ms": round((first or 0) * 1000, 1),
+                    "batch_summary": events[-1] if events else None,
+                })
+    return {"scenario": "batch", "fake_ttft_ms": args.ttft * 1000, "results": results}
+
+
+@scenario("sse")
+async def bench_sse(args) -> dict:
+    """Concurrent streaming chats against one worker."""
+    results = []
+    with stack(fake_env(args)) as (api_url, _):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            for concurrency in args.concurrency:
+                start = time.perf_counter()
+                runs = await asyncio.gather(*[
+                    read_sse(client, api_url + "/api/chat", chat_payload(text=f"q{concurrency}-{i}"))
+                    for i in range(concurrency)
+                ])
+                wall = time.perf_counter() - start
+                results.append({
+                    "concurrency": concurrency,
+                    "wall_s": round(wall, 3),
+                    "streams_per_s": round(concurrency / wall, 2),
+                    "ttft": percentiles([r["ttft"] for r in runs]),
+                    "duration": percentiles([r["duration"] for r in runs]),
+                    "failed": sum(1 for r in runs if r["status"] != 200),
+                })
+    return {"scenario": "sse", "results": results}
+
+
+async def server_cpu(client: httpx.AsyncClient, api_url: str) -> float:
+    text = (await client.get(api_url + "/metrics")).text
+    return float(re.search(r"^process_cpu_seconds_total (\S+)$", text, re.M).group(1))
+
+
+@scenario("frames")
+async def bench_frames(args) -> dict:
+    """Per-token SSE frames versus coalesced (and gzip) frames; try --concurrency 1000."""
+    cases = {
+        "per_token": ({"SSE_COALESCE_MS": "0", "SSE_HEARTBEAT": "0"}, {}),
+        "coalesced": ({}, {}),
+        "coalesced_gzip": ({"SSE_COMPRESSION": "gzip"}, {"Accept-Encoding": "gzip"}),
+    }
+    sizing = {"UPSTREAM_MAX_CONNECTIONS": "5000", "UPSTREAM_MAX_KEEPALIVE": "5000", "UPSTREAM_MODEL_CONCURRENCY": "5000",
+              "RESPONSE_CACHE_BACKEND": "off", "LOOP_LAG_INTERVAL": "0.05"}
+    results = []
+    for case, (app_env, headers) in cases.items():
+        with stack(fake_env(args), {**sizing, **app_env}) as (api_url, _):
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+            async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+                for concurrency in args.concurrency:
+                    lag_before = await loop_lag_buckets(client, api_url)
+                    cpu_before = await server_cpu(client, api_url)
+                    start = time.perf_counter()
+                    runs = await asyncio.gather(*[
+                        read_sse(client, api_url + "/api/chat", chat_payload(text=f"{case} {concurrency}-{i}"), headers)
+                        for i in range(concurrency)
+                    ])
+                    wall = time.perf_counter() - start
+                    results.append({
+                        "case": case,
+                        "concurrency": concurrency,
+                        "wall_s": round(wall, 3),
+                        "server_cpu_s": round(await server_cpu(client, api_url) - cpu_before, 3),
+                        "frames_per_stream": round(sum(r["frames"] for r in runs) / concurrency, 1),
+                        "bytes_per_stream": round(sum(r["bytes"] for r in runs) / concurrency),
+                        "ttft": percentiles([r["ttft"] for r in runs]),
+                        "duration": percentiles([r["duration"] for r in runs]),
+                        "event_loop_lag": lag_percentiles(lag_before, await loop_lag_buckets(client, api_url)),
+                        "failed": sum(1 for r in runs if r["status"] != 200),
+                    })
+    return {"scenario": "frames", "tokens": args.tokens, "tps": args.tps, "results": results}
+
+
+async def timed_requests(client: httpx.AsyncClient, method: str, url: str, total: int, concurrency: int, **kwargs) -> dict:
+    """Issue `total` requests from `concurrency` workers; report throughput and latency."""
+    latencies = []
+    failures = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal failures
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {"requests_per_s": round(total / elapsed, 1), "latency": percentiles(latencies), "failed": failures}
+
+
+async def register(client: httpx.AsyncClient, api_url: str, email: str = "rider@example.com") -> str:
+    body = {"email": email, "password": "eight-seconds"}
+    response = await client.post(api_url + "/api/auth/register", json=body)
+    if response.status_code != 200:
+        response = await client.post(api_url + "/api/auth/login", json=body)
+    return response.json()["access_token"]
+
+
+@scenario("auth")
+async def bench_auth(args) -> dict:
+    """Concurrent /api/auth/me with the user and token caches off, then on."""
+    results = {}
+    for label, env in (("uncached", {"USER_CACHE_TTL": "0", "TOKEN_CACHE_TTL": "0"}), ("cached", {})):
+        with stack(app_env=env) as (api_url, _):
+            async with httpx.AsyncClient(timeout=60) as client:
+                headers = {"Authorization": "Bearer " + await register(client, api_url)}
+                results[label] = [
+                    dict(concurrency=c, **await timed_requests(client, "GET", api_url + "/api/auth/me", args.requests, c, headers=headers))
+                    for c in args.concurrency
+                ]
+                results[label + "_caches"] = (await client.get(api_url + "/")).json()["caches"]
+    return {"scenario": "auth", "requests": args.requests, "results": results}
+
+
+@scenario("login")
+async def bench_login(args) -> dict:
+    """Login storm: /api/auth/me latency while logins hash on the event loop versus the hashing pool."""
+    users, results = 20, {}
+    for label, env in (("inline", {"PASSWORD_HASH_WORKERS": "0"}), ("pool", {})):
+        with stack(app_env={"LOOP_LAG_INTERVAL": "0.05", **env}) as (api_url, _):
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+            async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+                for u in range(users):
+                    await register(client, api_url, f"storm{u}@example.com")
+                headers = {"Authorization": "Bearer " + await register(client, api_url)}
+                results[label] = []
+                for concurrency in args.concurrency:
+                    logins, stop = [], asyncio.Event()
+
+                    async def storm(worker: int):
+                        n = worker
+                        while not stop.is_set():
+                            start = time.perf_counter()
+                            await client.post(api_url + "/api/auth/login",
+                                              json={"email": f"storm{n % users}@example.com", "password": "eight-seconds"})
+                            logins.append(time.perf_counter() - start)
+                            n += concurrency
+
+                    idle = await timed_requests(client, "GET", api_url + "/api/auth/me", 50, 1, headers=headers)
+                    lag_before = await loop_lag_buckets(client, api_url)
+                    started = time.perf_counter()
+                    workers = [asyncio.create_task(storm(w)) for w in range(concurrency)]
+                    await asyncio.sleep(0.5)
+                    probes = await timed_requests(client, "GET", api_url + "/api/auth/me", args.requests, 1, headers=headers)
+                    stop.set()
+                    await asyncio.gather(*workers)
+                    elapsed = time.perf_counter() - started
+                    results[label].append({
+                        "concurrency": concurrency,
+                        "me_idle": idle["latency"],
+                        "me_during_storm": probes["latency"],
+                        "logins_per_s": round(len(logins) / elapsed, 1),
+                        "login": percentiles(logins),
+                        "event_loop_lag": lag_percentiles(lag_before, await loop_lag_buckets(client, api_url)),
+                    })
+    return {"scenario": "login", "requests": args.requests, "results": results}
+
+
+async def flight_counts(client: httpx.AsyncClient, api_url: str) -> int:
+    """Chats the app has started or joined a single-flight upstream call for."""
+    flights = (await client.get(api_url + "/")).json()["singleflight"]
+    return flights["started"] + flights["coalesced"]
+
+
+@scenario("coalesce")
+async def bench_coalesce(args) -> dict:
+    """N concurrent identical chats must cost exactly one upstream completion."""
+    results = []
+    with stack(fake_env(args), {"RESPONSE_CACHE_BACKEND": "off"}) as (api_url, fake_url):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            for concurrency in args.concurrency:
+                await client.post(fake_url + "/stats/reset")
+                # the upstream answer waits until every client has joined the flight
+                await client.post(fake_url + "/hold")
+                before = await flight_counts(client, api_url)
+                payload = chat_payload(text=f"best barrel saddle for a {concurrency} year old horse")
+                requests = [asyncio.create_task(read_sse(client, api_url + "/api/chat", payload)) for _ in range(concurrency)]
+                try:
+                    deadline = time.perf_counter() + 60
+                    while await flight_counts(client, api_url) - before < concurrency and time.perf_counter() < deadline:
+                        await asyncio.sleep(0.05)
+                finally:
+                    await client.post(fake_url + "/release")
+                runs = await asyncio.gather(*requests)
+                upstream_calls = (await client.get(fake_url + "/stats")).json()["completions"]
+                results.append({
+                    "concurrency": concurrency,
+                    "upstream_calls": upstream_calls,
+                    "same_answer": all(r["status"] == 200 and r["text"] and r["text"] == runs[0]["text"] for r in runs),
+                    "ttft": percentiles([r["ttft"] for r in runs]),
+                })
+    report = {"scenario": "coalesce", "results": results}
+    for result in results:
+        check(report, result["upstream_calls"] == 1, f"{result['concurrency']} identical chats made {result['upstream_calls']} upstream calls, expected 1")
+        check(report, result["same_answer"], f"{result['concurrency']} identical chats did not all get the same answer")
+    return report
+
+
+@scenario("fairness")
+async def bench_fairness(args) -> dict:
+    """A team user floods scamper while free users keep chatting: first-come upstream slots versus fair queuing."""
+    import sqlite3
+    from collections import Counter
+    flood, free_users, rounds = 60, 5, 3
+    sizing = {"UPSTREAM_MODEL_CONCURRENCY": "4", "SCHEDULER_CONCURRENCY": "scamper=4", "SCHEDULER_MAX_PER_USER": "25",
+              "RESPONSE_CACHE_BACKEND": "off"}
+    results = {}
+    for label, env in (("first_come", {"SCHEDULER": "off"}), ("fair", {})):
+        db_path = os.path.join(tempfile.mkdtemp(), "rodeoai.db")
+        with stack(fake_env(args), {"RODEOAI_DB": db_path, **sizing, **env}) as (api_url, _):
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+            async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+                team = {"Authorization": "Bearer " + await register(client, api_url, "team@example.com")}
+                free = [{"Authorization": "Bearer " + await register(client, api_url, f"free{u}@example.com")} for u in range(free_users)]
+                with sqlite3.connect(db_path) as conn:
+                    conn.execute("UPDATE users SET tier = 'team' WHERE email = 'team@example.com'")
+                url = api_url + "/api/chat"
+                burst = asyncio.gather(*[read_sse(client, url, chat_payload(text=f"flood {n}"), team) for n in range(flood)])
+                await asyncio.sleep(0.5)
+                free_runs = []
+                for r in range(rounds):
+                    free_runs += await asyncio.gather(*[read_sse(client, url, chat_payload(text=f"free {u} {r}"), h) for u, h in enumerate(free)])
+                team_runs = await burst
+                served = [run for run in team_runs if run["status"] == 200]
+                results[label] = {
+                    "free_ttft": percentiles([run["ttft"] for run in free_runs]),
+                    "team_ttft": percentiles([run["ttft"] for run in served]),
+                    "team_status": dict(Counter(run["status"] for run in team_runs)),
+                    "scheduler": (await client.get(api_url + "/")).json()["scheduler"]["lanes"]["scamper"],
+                }
+    return {"scenario": "fairness", "flood": flood, "free_requests": free_users * rounds, "results": results}
+
+
+@scenario("columnar")
+async def bench_columnar(args) -> dict:
+    """Time-range aggregates over a synthetic columnar usage store of --rows rows."""
+    from array import array
+    sys.path.insert(0, ROOT)
+    import columnar
+    workdir = tempfile.mkdtemp()
+    days, users, models, tiers = 100, 5000, ["scamper", "gold-buckle", "bodacious"], ["free", "pro", "champion", "team"]
+    per_day = args.rows // days
+    columnar_store = columnar.ColumnarStore(os.path.join(workdir, "store"))
+    for name in models:
+        columnar_store.encode("model", name)
+    for name in tiers:
+        columnar_store.encode("tier", name)
+
+    start = time.perf_counter()
+    day_columns = {
+        "user_id": array("i", (i % users + 1 for i in range(per_day))),
+        "model": array("H", (i % 3 for i in range(per_day))),
+        "tier": array("H", (i % 4 for i in range(per_day))),
+        "prompt_tokens": array("i", (50 + i % 200 for i in range(per_day))),
+        "completion_tokens": array("i", (100 + i % 400 for i in range(per_day))),
+        "cost": array("d", ((i % 7) * 0.0001 for i in range(per_day))),
+        "second": array("i", (i % 86400 for i in range(per_day))),
+    }
+    rollup: dict = {}
+    for i in range(per_day):
+        columnar._add(rollup, {"model": models[i % 3], "user": str(i % users + 1), "tier": tiers[i % 4]},
+                      (1, day_columns["prompt_tokens"][i], day_columns["completion_tokens"][i], day_columns["cost"][i]))
+    first = columnar.date(2026, 1, 1)
+    for d in range(days):
+        columnar_store.append("usage", (first + columnar.timedelta(days=d)).isoformat(), day_columns, json.loads(json.dumps(rollup)))
+    build_s = time.perf_counter() - start
+
+    last = (first + columnar.timedelta(days=days - 1)).isoformat()
+    queries = {}
+    for group_by in ("model", "tier", "day", "user"):
+        columnar_store._rollups.clear()
+        t0 = time.perf_counter()
+        groups = columnar_store.aggregate("usage", first.isoformat(), last, group_by)
+        cold = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        columnar_store.aggregate("usage", first.isoformat(), last, group_by)
+        queries[group_by] = {"groups": len(groups), "cold_ms": round(cold * 1000, 2), "warm_ms": round((time.perf_counter() - t0) * 1000, 2)}
+    week_end = (first + columnar.timedelta(days=6)).isoformat()
+    t0 = time.perf_counter()
+    columnar_store.scan_usage(first.isoformat(), week_end, user_id=42, model="gold-buckle")
+    queries["scan_user_model_7d"] = {"rows_scanned": per_day * 7, "ms": round((time.perf_counter() - t0) * 1000, 2)}
+    total_requests = sum(v[0] for v in columnar_store.aggregate("usage", first.isoformat(), last, "model").values())
+    return {"scenario": "columnar", "rows": per_day * days, "days": days, "rows_in_rollups": total_requests,
+            "build_s": round(build_s, 2), "queries": queries}
+
+
+@scenario("router")
+async def bench_router(args) -> dict:
+    """Gold Buckle against a slow, then a failing, stand-in gpt-4o: hedges must win, failovers complete, the circuit open."""
+    results = {}
+    cases = {
+        "slow_primary": {"FAKE_MODEL_TTFT": "gpt-4o=3.0,gpt-4o-mini=0.05"},
+        "failing_primary": {"FAKE_MODEL_ERROR_RATE": "gpt-4o=1.0"},
+    }
+    app_env = {"RESPONSE_CACHE_BACKEND": "off", "ROUTER_TTFT_BUDGET": "0.5", "CIRCUIT_FAILURES": "3",
+               "CIRCUIT_COOLDOWN": "600", "ROUTER_SLOW_SAMPLES": "5", "ROUTER_SLOW_RETRY": "600"}  # no probes during the run
+    for case, env in cases.items():
+        with stack({**fake_env(args), **env}, app_env) as (api_url, fake_url):
+            async with httpx.AsyncClient(timeout=60) as client:
+                runs = []
+                for i in range(args.requests):
+                    runs.append(await read_sse(client, api_url + "/api/chat", chat_payload("gold-buckle", f"{case} {i}")))
+                results[case] = {
+                    "requests": len(runs),
+                    "ttft": percentiles([r["ttft"] for r in runs]),
+                    "complete": sum(1 for r in runs if r["frames"] > 1),
+                    "upstream_calls": (await client.get(fake_url + "/stats")).json()["by_model"],
+                    "router": (await client.get(api_url + "/")).json()["router"],
+                }
+    report = {"scenario": "router", "results": results}
+    for case, result in results.items():
+        check(report, result["complete"] == result["requests"], f"{case}: {result['requests'] - result['complete']} chats did not complete")
+    slow, failing = results["slow_primary"], results["failing_primary"]
+    check(report, slow["router"]["hedges"] > 0 and slow["upstream_calls"].get("gpt-4o-mini", 0) > 0, "slow_primary: no hedge was started")
+    check(report, slow["ttft"]["p95_ms"] < 3000, f"slow_primary: p95 TTFT {slow['ttft']['p95_ms']} ms, so the hedge did not win over the 3 s primary")
+    slow_primary = slow["router"]["upstreams"].get("gpt-4o", {})
+    check(report, slow_primary.get("slow") and slow_primary.get("ttft_p95_ms") is not None,
+          "slow_primary: the router did not learn that gpt-4o misses its budget")
+    check(report, slow["upstream_calls"].get("gpt-4o", 0) < slow["requests"],
+          f"slow_primary: all {slow['requests']} chats still went to gpt-4o first, so each cost two upstream calls")
+    check(report, failing["router"]["failovers"] > 0, "failing_primary: no failover")
+    check(report, failing["router"]["upstreams"].get("gpt-4o", {}).get("circuit") == "open", "failing_primary: gpt-4o's circuit did not open")
+    check(report, failing["upstream_calls"].get("gpt-4o", 0) <= int(app_env["CIRCUIT_FAILURES"]),
+          f"failing_primary: {failing['upstream_calls'].get('gpt-4o', 0)} calls reached gpt-4o after its circuit opened")
+
+    # a failed-over answer must not be cached under the model that failed
+    with stack({**fake_env(args), **cases["failing_primary"]}, {**app_env, "RESPONSE_CACHE_BACKEND": "memory"}) as (api_url, fake_url):
+        async with httpx.AsyncClient(timeout=60) as client:
+            for _ in range(2):
+                await read_sse(client, api_url + "/api/chat", chat_payload("gold-buckle", "failover cache"))
+            served = (await client.get(fake_url + "/stats")).json()["by_model"].get("gpt-4o-mini", 0)
+            cache_hits = (await client.get(api_url + "/")).json()["response_cache"]["hits"]
+    results["failover_cache"] = {"fallback_calls": served, "cache_hits": cache_hits}
+    check(report, served == 2 and cache_hits == 0, f"a failed-over answer was cached ({served} fallback calls, {cache_hits} cache hits for 2 identical chats)")
+    return report
+
+
+async def loop_lag_buckets(client: httpx.AsyncClient, api_url: str) -> Dict[float, int]:
+    """Cumulative bucket counts of the API's event-loop lag histogram."""
+    text = (await client.get(api_url + "/metrics")).text
+    pattern = r'^rodeoai_event_loop_lag_seconds_bucket\{le="([^"]+)"\} (\d+)$'
+    return {float(le): int(count) for le, count in re.findall(pattern, text, re.M)}
+
+
+def lag_percentiles(before: Dict[float, int], after: Dict[float, int]) -> dict:
+    """Bucket upper bounds holding the p50/p99 lag samples taken between two scrapes."""
+    bounds = sorted(after)
+    counts = [after[b] - before.get(b, 0) for b in bounds]
+    if not counts or not counts[-1]:
+        return {}
+
+    def pick(q):
+        for bound, cumulative in zip(bounds, counts):
+            if cumulative >= q * counts[-1]:
+                return None if bound == float("inf") else round(bound * 1000, 2)
+
+    return {"samples": counts[-1], "p50_le_ms": pick(0.50), "p99_le_ms": pick(0.99)}
+
+
+MIX_OPS = ("register", "login", "me", "stream", "chat", "log")
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        op, weight = item.split("=")
+        if op not in MIX_OPS:
+            raise argparse.ArgumentTypeError(f"unknown operation {op!r}")
+        mix[op] = int(weight)
+    return mix
+
+
+def _drive(api_url: str, tokens: List[str], concurrency: int, duration: float, seed: int) -> dict:
+    """Load-generator process of the `workers` scenario: /api/auth/me and streaming chats for `duration` seconds."""
+    samples: Dict[str, list] = {"me": [], "stream": []}
+    failures = 0
+
+    async def run():
+        nonlocal failures
+        deadline = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            async def worker(w: int):
+                nonlocal failures
+                rng = random.Random(seed * 1000 + w)
+                n = 0
+                while time.perf_counter() < deadline:
+                    n += 1
+                    headers = {"Authorization": "Bearer " + rng.choice(tokens)}
+                    op = "stream" if rng.random() < 0.2 else "me"
+                    start = time.perf_counter()
+                    try:
+                        if op == "me":
+                            status = (await client.get(api_url + "/api/auth/me", headers=headers)).status_code
+                        else:
+                            status = (await read_sse(client, api_url + "/api/chat", chat_payload(text=f"scaling {seed} {w} {n}"), headers))["status"]
+                    except httpx.HTTPError:
+                        status = 599
+                    samples[op].append(time.perf_counter() - start)
+                    failures += status >= 400
+
+            await asyncio.gather(*[worker(w) for w in range(concurrency)])
+
+    asyncio.run(run())
+    return {"samples": samples, "failures": failures}
+
+
+@scenario("workers")
+async def bench_workers(args) -> dict:
+    """Throughput of `python main.py` with 1..N worker processes (WEB_CONCURRENCY) under the same load."""
+    import multiprocessing
+    import sqlite3
+    results = []
+    clients = args.clients or max(1, (os.cpu_count() or 1) // 2)
+    concurrency = max(args.concurrency)
+    for workers in args.workers:
+        workdir = tempfile.mkdtemp()
+        db_path = os.path.join(workdir, "rodeoai.db")
+        app_env = {"RODEOAI_DB": db_path, "ANALYTICS_LOG": os.path.join(workdir, "analytics.log"),
+                   "SHARED_STATE_PATH": os.path.join(workdir, "shared_state.db"),
+                   "RESPONSE_CACHE_PATH": os.path.join(workdir, "response_cache.db")}
+        with stack(fake_env(args), app_env, workers) as (api_url, _):
+            async with httpx.AsyncClient(timeout=60) as client:
+                tokens = [await register(client, api_url, f"scale{u}@example.com") for u in range(20)]
+                # every worker must be up before the clock starts
+                pids, deadline = set(), time.time() + 60
+                while len(pids) < workers and time.time() < deadline:
+                    pids.add((await client.get(api_url + "/", headers={"Connection": "close"})).json()["shared"]["pid"])
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("UPDATE users SET tier = 'team'")
+            with multiprocessing.get_context("spawn").Pool(clients) as pool:
+                start = time.perf_counter()
+                parts = pool.starmap(_drive, [(api_url, tokens, max(1, concurrency // clients), args.duration, c) for c in range(clients)])
+                wall = time.perf_counter() - start
+        samples = {op: [x for part in parts for x in part["samples"][op]] for op in ("me", "stream")}
+        total = sum(len(v) for v in samples.values())
+        results.append({
+            "workers": workers,
+            "requests_per_s": round(total / wall, 1),
+            "failed": sum(part["failures"] for part in parts),
+            "latency": {op: percentiles(v) for op, v in samples.items()},
+        })
+    base = results[0]["requests_per_s"] / results[0]["workers"]
+    for result in results:
+        result["scaling_efficiency"] = round(result["requests_per_s"] / (base * result["workers"]), 2) if base else None
+    return {"scenario": "workers", "cpus": os.cpu_count(), "clients": clients, "concurrency": concurrency,
+            "duration_s": args.duration, "results": results}
+
+
+@scenario("mixed")
+async def bench_mixed(args) -> dict:
+    """Weighted mix of auth, chat and analytics requests from concurrent clients."""
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "rodeoai.db")
+    app_env = {"RODEOAI_DB": db_path, "LOOP_LAG_INTERVAL": "0.05", "ANALYTICS_LOG": os.path.join(workdir, "analytics.log")}
+    ops, weights = zip(*args.mix.items())
+    results = []
+    with stack(fake_env(args), app_env) as (api_url, fake_url):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            pool = [await register(client, api_url, f"pool{u}@example.com") for u in range(20)]
+            import sqlite3
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("UPDATE users SET tier = 'team'")
+            counter = iter(range(10 ** 9))
+
+            async def run_op(op: str, rng: random.Random) -> int:
+                n = next(counter)
+                headers = {"Authorization": "Bearer " + rng.choice(pool)}
+                if op == "register":
+                    body = {"email": f"mixed{n}-{rng.random():.6f}@example.com", "password": "eight-seconds"}
+                    return (await client.post(api_url + "/api/auth/register", json=body)).status_code
+                if op == "login":
+                    body = {"email": f"pool{rng.randrange(len(pool))}@example.com", "password": "eight-seconds"}
+                    return (await client.post(api_url + "/api/auth/login", json=body)).status_code
+                if op == "me":
+                    return (await client.get(api_url + "/api/auth/me", headers=headers)).status_code
+                if op == "stream":
+                    return (await read_sse(client, api_url + "/api/chat", chat_payload(text=f"mixed stream {n}"), headers))["status"]
+                if op == "chat":
+                    payload = chat_payload(text=f"mixed chat {n}", stream=False)
+                    return (await client.post(api_url + "/api/chat", json=payload, headers=headers)).status_code
+                entry = {"chatId": n, "model": "scamper", "prompt": "p" * 80, "response": "r" * 400, "timestamp": int(time.time() * 1000)}
+                return (await client.post(api_url + "/log", json=entry)).status_code
+
+            for concurrency in args.concurrency:
+                samples: Dict[str, list] = {op: [] for op in ops}
+                statuses: Dict[str, Dict[str, int]] = {op: {} for op in ops}
+                remaining = iter(range(args.requests))
+
+                async def worker(seed: int):
+                    rng = random.Random(seed)
+                    for _ in remaining:
+                        op = rng.choices(ops, weights)[0]
+                        start = time.perf_counter()
+                        try:
+                            status = str(await run_op(op, rng))
+                        except httpx.HTTPError as e:
+                            status = type(e).__name__
+                        samples[op].append(time.perf_counter() - start)
+                        statuses[op][status] = statuses[op].get(status, 0) + 1
+
+                await client.post(fake_url + "/stats/reset")
+                lag_before = await loop_lag_buckets(client, api_url)
+                start = time.perf_counter()
+                await asyncio.gather(*[worker(args.seed * 1000 + w) for w in range(concurrency)])
+                wall = time.perf_counter() - start
+                results.append({
+                    "concurrency": concurrency,
+                    "wall_s": round(wall, 3),
+                    "requests_per_s": round(args.requests / wall, 1),
+                    "operations": {
+                        op: {
+                            "count": len(samples[op]),
+                            "per_s": round(len(samples[op]) / wall, 1),
+                            "latency": percentiles(samples[op]),
+                            "status": statuses[op],
+                        }
+                        for op in ops
+                    },
+                    "event_loop_lag": lag_percentiles(lag_before, await loop_lag_buckets(client, api_url)),
+                    "upstream": (await client.get(fake_url + "/stats")).json(),
+                })
+    return {"scenario": "mixed", "requests": args.requests, "mix": args.mix, "results": results}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(baseline, current, path: str = "") -> dict:
+    """Relative change of every number present in both reports, keyed by path."""
+    changes = {}
+    if isinstance(baseline, dict) and isinstance(current, dict):
+        for key in baseline.keys() & current.keys():
+            changes.update(compare(baseline[key], current[key], f"{path}.{key}" if path else str(key)))
+    elif isinstance(baseline, list) and isinstance(current, list):
+        for i, (old, new) in enumerate(zip(baseline, current)):
+            changes.update(compare(old, new, f"{path}[{i}]"))
+    elif isinstance(baseline, (int, float)) and isinstance(current, (int, float)) and not isinstance(baseline, bool):
+        if baseline != current:
+            changes[path] = {"baseline": baseline, "current": current,
+                             "change_pct": round((current - baseline) / baseline * 100, 1) if baseline else None}
+    return changes
+
+
+@scenario("history")
+async def bench_history(args) -> dict:
+    """Conversation/message history: OFFSET paging without indexes versus keyset paging with them."""
+    import sqlite3
+    workdir = tempfile.mkdtemp()
+    os.environ["RODEOAI_DB"] = os.path.join(workdir, "rodeoai.db")
+    sys.path.insert(0, ROOT)
+    import db_models
+    import migrations
+    import store
+    conversations, messages, page = 10000, 5000, 50
+    body = "Keep your heels down and your eyes up through the turn. " * 25
+    store.prepare()  # the schema, before seeding through a connection of our own
+    conn = sqlite3.connect(store.DB_PATH)
+    conn.executemany("INSERT INTO users (email, password_hash) VALUES (?, ?)", [(f"rider{u}@example.com", "x") for u in range(101)])
+    conn.executemany("INSERT INTO conversations (user_id, title, updated_at) VALUES (?, ?, ?)",
+                     [(1 if c < conversations else c % 100 + 2, f"conversation {c}", f"2026-01-01T00:00:{c // 100 % 60:02d}.{c:06d}")
+                      for c in range(conversations * 2)])
+    conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                     [(1 if m < messages else m % conversations + 1, "user" if m % 2 else "assistant", body) for m in range(messages * 20)])
+    conn.commit()
+
+    def timed(fn, *a) -> float:
+        start = time.perf_counter()
+        fn(*a)
+        return time.perf_counter() - start
+
+    def offset_page(offset: int) -> None:
+        with store.connection() as c:
+            c.execute("SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?", (1, page, offset)).fetchall()
+
+    def measure() -> dict:
+        pages, cursor = [], None
+        while True:
+            start = time.perf_counter()
+            rows = db_models.list_conversations(1, page, cursor)
+            pages.append(time.perf_counter() - start)
+            if len(rows) < page:
+                break
+            cursor = (rows[-1]["updated_at"], rows[-1]["id"])
+        message_pages, before = [], None
+        for _ in range(20):
+            start = time.perf_counter()
+            rows = db_models.list_messages(1, page, before)
+            message_pages.append(time.perf_counter() - start)
+            before = rows[0]["id"]
+        return {
+            "offset_first_page_ms": round(timed(offset_page, 0) * 1000, 2),
+            "offset_last_page_ms": round(timed(offset_page, conversations - page) * 1000, 2),
+            "keyset_pages": len(pages),
+            "keyset_page": percentiles(pages),
+            "all_messages_ms": round(timed(db_models.get_conversation_messages, 1) * 1000, 2),
+            "message_page_preview": percentiles(message_pages),
+            "message_page_bodies_ms": round(timed(db_models.list_messages, 1, page, None, None, True) * 1000, 2),
+        }
+
+    with store.connection() as c:
+        c.execute("DROP INDEX idx_conversations_user_updated")
+        c.execute("DROP INDEX idx_messages_conversation")
+    before_indexes = measure()
+    with store.connection() as c:
+        for statement in migrations.MIGRATIONS[0][1]:
+            c.execute(statement)
+    return {"scenario": "history", "conversations": conversations, "messages": messages,
+            "without_indexes": before_indexes, "with_indexes": measure()}
+
+
+@scenario("search")
+async def bench_search(args) -> dict:
+    """Message search: FTS5 (bulk build, trigger upkeep, ranked and newest-first queries) versus LIKE scans."""
+    import sqlite3
+    workdir = tempfile.mkdtemp()
+    os.environ["RODEOAI_DB"] = os.path.join(workdir, "rodeoai.db")
+    sys.path.insert(0, ROOT)
+    import db_models
+    import migrations
+    import search
+    import store
+    users, per_user, messages = 1000, 20, args.messages
+    rng = random.Random(args.seed)
+    common = ("rope horse barrel saddle calf run turn time arena rider spur chute pattern "
+              "heel head loop dally practice speed pocket rein").split()
+    rare = ("bosal hackamore mecate tapadero bronc latigo honda romal piggin tiedown").split()
+    filler = "the a your and to of in on with keep for is it through".split()
+    vocabulary = common + rare + filler
+    weights = [40] * len(common) + [0.05] * len(rare) + [120] * len(filler)
+
+    # Load the corpus the way an existing database would have it: before the
+    # search migration, so its index is built by its backfill.
+    with store.connection() as c:
+        c.execute("DROP TRIGGER messages_fts_insert")
+        c.execute("DROP TRIGGER messages_fts_delete")
+        c.execute("DROP TRIGGER messages_fts_update")
+        c.execute("DROP TABLE messages_fts")
+        c.execute("PRAGMA user_version = 1")
+    conn = sqlite3.connect(store.DB_PATH)
+    conn.executemany("INSERT INTO users (email, password_hash) VALUES (?, ?)", [(f"rider{u}@example.com", "x") for u in range(users)])
+    conn.executemany("INSERT INTO conversations (user_id, title) VALUES (?, ?)",
+                     [(c % users + 1, f"conversation {c}") for c in range(users * per_user)])
+    start = time.perf_counter()
+    for batch in range(0, messages, 100_000):
+        conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                         [(m % (users * per_user) + 1, "user" if m % 2 else "assistant",
+                           " ".join(rng.choices(vocabulary, weights, k=rng.randint(8, 60))))
+                          for m in range(batch, min(messages, batch + 100_000))])
+    conn.commit()
+    conn.close()
+    load_seconds = time.perf_counter() - start
+    with store.connection() as c:
+        start = time.perf_counter()
+        migrations.migrate(c)
+        build_seconds = time.perf_counter() - start
+    optimize_seconds = search.optimize()["seconds"]
+
+    def insert_rate(count: int) -> float:
+        """Seconds per message for single-row inserts (index kept current by the triggers)."""
+        start = time.perf_counter()
+        for i in range(count):
+            db_models.add_message(i % (users * per_user) + 1, "user", " ".join(rng.choices(vocabulary, weights, k=30)))
+        return (time.perf_counter() - start) / count
+
+    def like(user_id: int, terms: List[str]) -> None:
+        with store.connection() as c:
+            c.execute("SELECT m.id, m.content FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+                      "WHERE c.user_id = ? AND " + " AND ".join(["m.content LIKE ?"] * len(terms)) + " LIMIT 20",
+                      (user_id, *(f"%{t}%" for t in terms))).fetchall()
+
+    queries = {"rare": lambda: rng.choice(rare), "common": lambda: rng.choice(common),
+               "two_terms": lambda: " ".join(rng.sample(common, 2)), "prefix": lambda: rng.choice(common)[:3] + "*"}
+    results = {}
+    for kind, make in queries.items():
+        samples = {"relevance": [], "recent": [], "like": []}
+        hits = 0
+        for _ in range(args.requests):
+            user_id, query = rng.randint(1, users), make()
+            for order in ("relevance", "recent"):
+                start = time.perf_counter()
+                hits += len(db_models.search_messages(user_id, search.build_match(query), 20, 0, order))
+                samples[order].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            like(user_id, re.findall(r"\w+", query))
+            samples["like"].append(time.perf_counter() - start)
+        results[kind] = {name: percentiles(s) for name, s in samples.items()}
+        results[kind]["mean_hits"] = round(hits / args.requests / 2, 1)
+    with store.connection() as c:
+        start = time.perf_counter()
+        c.execute("SELECT m.id FROM messages m WHERE m.content LIKE '%bosal%' LIMIT 20").fetchall()
+        like_all_ms = round((time.perf_counter() - start) * 1000, 2)
+    return {
+        "scenario": "search", "messages": messages, "users": users,
+        "load_seconds": round(load_seconds, 1),
+        "index_build_seconds": round(build_seconds, 1),
+        "optimize_seconds": optimize_seconds,
+        "insert_us": round(insert_rate(2000) * 1e6, 1),
+        "queries": results,
+        "like_unscoped_rare_ms": like_all_ms,
+    }
+
+
+def seed_database(path: str, users: int, conversations: int, messages: int) -> None:
+    """Fill a fresh database with synthetic users, conversations and messages."""
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO users (email, password_hash) VALUES (?, ?)",
+                     [(f"rider{u}@example.com", "x" * 64) for u in range(users)])
+    conn.executemany("INSERT INTO conversations (user_id, title) VALUES (?, ?)",
+                     [(c % users + 1, f"conversation {c}") for c in range(conversations)])
+    conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                     [(m % conversations + 1, "user" if m % 2 else "assistant", f"how do I rope faster {m}")
+                      for m in range(messages)])
+    conn.commit()
+    conn.close()
+
+
+@scenario("prompts")
+async def bench_prompts(args) -> dict:
+    """Prompt assembly per request (rebuilt vs compiled) and how often a growing conversation's payload prefix changes."""
+    sys.path.insert(0, ROOT)
+    import context
+    import prompts
+    from config import MODEL_REGISTRY
+    rng = random.Random(args.seed)
+    words = "rope horse barrel saddle calf run turn time arena rider the a your and to of in".split()
+
+    class Message:
+        def __init__(self, role, content):
+            self.role, self.content = role, content
+
+    turns = [Message("user" if i % 2 == 0 else "assistant", " ".join(rng.choices(words, k=rng.randint(20, 400))))
+             for i in range(400)]
+
+    def rebuilt(model_key, messages):
+        system = MODEL_REGISTRY[model_key]["system_prompt"] + "\n\n" + prompts.PERSONAS["wesley"]["prompt"]
+        history = [{"role": m.role, "content": m.content} for m in messages]
+        budget = context.budget_for(model_key) - context.message_tokens(system)
+        start = context.window_start([context.message_tokens(m["content"]) for m in history], budget, 0)
+        return [{"role": "system", "content": system}] + history[start:]
+
+    def compiled(model_key, messages):
+        return prompts.get(model_key, "wesley").assemble(messages)
+
+    def per_request(fn, length: int) -> float:
+        messages = turns[:length]
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            fn("scamper", messages)
+        return round((time.perf_counter() - start) / args.requests * 1e6, 1)
+
+    def prefix_changes(step: float) -> dict:
+        """Requests of a 400-turn conversation whose kept window starts at a different message than the last one."""
+        prompt = prompts.get("scamper", "wesley")
+        budget = context.budget_for("scamper") - prompt.tokens
+        counts = [context.message_tokens(m.content) for m in turns]
+        starts, kept = [], []
+        for length in range(1, len(turns) + 1):
+            start = context.window_start(counts[:length], budget, step)
+            starts.append(start)
+            kept.append(sum(counts[start:length]))
+        trimmed = [k for s, k in zip(starts, kept) if s > 0]
+        return {"start_changes": sum(1 for a, b in zip(starts, starts[1:]) if a != b),
+                "min_kept_tokens": min(trimmed) if trimmed else None, "budget_tokens": budget}
+
+    return {
+        "scenario": "prompts",
+        "assembly_us": {length: {"rebuilt": per_request(rebuilt, length), "compiled": per_request(compiled, length)}
+                        for length in (2, 20, 200)},
+        "window": {"per_turn": prefix_changes(0), "stepped": prefix_changes(context.CONTEXT_TRIM_STEP)},
+    }
+
+
+@scenario("jobs")
+async def bench_jobs(args) -> dict:
+    """Background job queue: enqueue cost, then draining N no-op jobs one per call versus in batches."""
+    workdir = tempfile.mkdtemp()
+    os.environ.update(RODEOAI_DB=os.path.join(workdir, "rodeoai.db"), JOB_POLL_INTERVAL="0.01")
+    sys.path.insert(0, ROOT)
+    import db_models  # noqa: F401  (the schema, jobs table included)
+    import jobs
+    import store
+    total = args.requests
+    results = {}
+    for batch_size in (1, 50):
+        kind = f"noop-{batch_size}"
+
+        async def handler(payloads):
+            pass
+
+        jobs.register(kind, handler, batch_size=batch_size)
+        target = jobs.completed + total
+        start = time.perf_counter()
+        for n in range(total):
+            jobs.enqueue(kind, {"n": n})
+        enqueued = time.perf_counter() - start
+        start = time.perf_counter()
+        await jobs.start()
+        while jobs.completed < target:
+            await asyncio.sleep(0.005)
+        drained = time.perf_counter() - start
+        await jobs.stop()
+        jobs._kinds.pop(kind)
+        results[f"batch_size_{batch_size}"] = {
+            "enqueue_us": round(enqueued / total * 1e6, 1),
+            "drain_jobs_per_s": round(total / drained),
+        }
+    with store.connection() as conn:
+        left = conn.execute("SELECT count(*) FROM jobs").fetchone()[0]
+    return {"scenario": "jobs", "jobs": total, "workers": jobs.JOB_WORKERS, "results": results, "left_in_table": left}
+
+
+@scenario("archive")
+async def bench_archive(args) -> dict:
+    """Retention: database size and hot-path latency before and after archiving --messages messages (90% idle), and rehydration."""
+    import sqlite3
+    workdir = tempfile.mkdtemp()
+    os.environ.update(RODEOAI_DB=os.path.join(workdir, "rodeoai.db"), ARCHIVE_DIR=os.path.join(workdir, "archive"),
+                      ANALYTICS_STORE_DIR=os.path.join(workdir, "analytics_store"))
+    sys.path.insert(0, ROOT)
+    import archive
+    import columnar
+    import db_models
+    import store
+    rng = random.Random(args.seed)
+    words = "rope horse barrel saddle calf run turn time arena rider the a your and to of in heels down eyes up".split()
+    users, conversations, page = 100, max(100, args.messages // 50), 50
+    hot = conversations // 10
+    store.prepare()
+    conn = sqlite3.connect(store.DB_PATH)
+    conn.executemany("INSERT INTO users (email, password_hash) VALUES (?, ?)", [(f"rider{u}@example.com", "x") for u in range(users)])
+    conn.executemany("INSERT INTO conversations (user_id, title, updated_at) VALUES (?, ?, ?)",
+                     [(c % users + 1, f"conversation {c}", "2026-10-01T00:00:00" if c < hot else "2025-01-01T00:00:00")
+                      for c in range(conversations)])
+    conn.executemany("INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                     ((m % conversations + 1, "user" if m % 2 else "assistant", " ".join(rng.choices(words, k=rng.randint(10, 120))), "2025-01-01 00:00:00")
+                      for m in range(args.messages)))
+    conn.executemany("INSERT INTO usage_logs (user_id, model, prompt_tokens, completion_tokens, total_tokens, cost, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((u % users + 1, "scamper", 100, 200, 300, 0.001, f"2025-{u % 12 + 1:02d}-{u % 28 + 1:02d} 12:00:00")
+                      for u in range(args.messages // 2)))
+    conn.commit()
+    conn.close()
+    columnar.compact()  # the rollup only folds rows the analytics store already has
+
+    def timed(fn, *a) -> float:
+        start = time.perf_counter()
+        fn(*a)
+        return time.perf_counter() - start
+
+    def measure() -> dict:
+        conversation_pages = [timed(db_models.list_conversations, rng.randint(1, users), page) for _ in range(200)]
+        message_pages = [timed(db_models.list_messages, rng.randint(1, hot), page) for _ in range(200)]
+        searches = [timed(db_models.search_messages, rng.randint(1, users), rng.choice(words[:10]), 20) for _ in range(50)]
+        return {"database_mb": round(os.path.getsize(store.DB_PATH) / 1e6, 1), "conversation_page": percentiles(conversation_pages),
+                "hot_message_page": percentiles(message_pages), "search": percentiles(searches)}
+
+    before = measure()
+    passes, start = 0, time.perf_counter()
+    while True:
+        passes += 1
+        if archive.run_pass()["done"]:
+            break
+    compaction = time.perf_counter() - start
+    with store.connection() as c:
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    after = measure()
+    status = archive.status()
+    after["segments_mb"] = round(status["segment_bytes"] / 1e6, 1)
+    cold = rng.sample(range(hot + 1, conversations + 1), 100)
+    archive._read_record.cache_clear()
+    archived_page = [timed(db_models.list_messages, c, page) for c in cold[:50]]
+    restored = [timed(archive.restore, c) for c in cold[50:]]
+    return {"scenario": "archive", "conversations": conversations, "messages": args.messages,
+            "archived_conversations": status["archived_conversations"], "compaction_s": round(compaction, 2), "passes": passes,
+            "before": before, "after": after, "archived_message_page": percentiles(archived_page), "restore": percentiles(restored)}
+
+
+@scenario("db")
+async def bench_db(args) -> dict:
+    """Auth + history read path: per-call sqlite3.connect versus the pooled store."""
+    import sqlite3
+    workdir = tempfile.mkdtemp()
+    os.environ["RODEOAI_DB"] = os.path.join(workdir, "rodeoai.db")
+    sys.path.insert(0, ROOT)
+    import auth
+    import db_models
+    import store
+    store.prepare()
+    seed_database(store.DB_PATH, 100, 1000, 20000)
+    requests = args.requests
+
+    def legacy_read(user_id: int) -> None:
+        def query(sql, params):
+            conn = sqlite3.connect(store.DB_PATH)
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(sql, params).fetchall()
+            conn.close()
+            return [dict(r) for r in rows]
+        query("SELECT * FROM users WHERE id = ?", (user_id,))
+        conversations = query("SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?", (user_id, 50))
+        query("SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at ASC", (conversations[0]["id"],))
+
+    def pooled_read(user_id: int) -> None:
+        auth.get_user_by_id(user_id)
+        conversations = db_models.get_user_conversations(user_id)
+        db_models.get_conversation_messages(conversations[0]["id"])
+
+    async def measure(read, concurrency: int) -> dict:
+        ids = iter(range(requests))
+
+        async def worker():
+            for i in ids:
+                await store.run(read, i % 100 + 1)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        return {"requests_per_s": round(requests / elapsed, 1), "elapsed_s": round(elapsed, 3)}
+
+    results = []
+    for concurrency in args.concurrency:
+        results.append({
+            "concurrency": concurrency,
+            "before": await measure(legacy_read, concurrency),
+            "after": await measure(pooled_read, concurrency),
+        })
+    return {"scenario": "db", "requests": requests, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,10,50,100", type=lambda v: [int(c) for c in v.split(",")])
+    parser.add_argument("--ttft", type=float, default=0.5, help="fake upstream time to first token (s)")
+    parser.add_argument("--tps", type=float, default=20, help="fake upstream tokens per second")
+    parser.add_argument("--tokens", type=int, default=10, help="fake upstream tokens per completion")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake upstream calls that fail")
+    parser.add_argument("--mix", type=parse_mix, default="register=2,login=3,me=35,stream=25,chat=10,log=25",
+                        help="operation weights (mixed scenario)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the operation mix")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per measurement (in-process scenarios)")
+    parser.add_argument("--runs", type=int, default=5, help="process starts to measure (coldstart scenario)")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="synthetic rows (columnar scenario)")
+    parser.add_argument("--messages", type=int, default=1_000_000, help="synthetic messages (search scenario)")
+    parser.add_argument("--workers", default="1,2,4", type=lambda v: [int(w) for w in v.split(",")],
+                        help="worker process counts (workers scenario)")
+    parser.add_argument("--clients", type=int, default=0, help="load-generator processes (workers scenario; default half the CPUs)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load per measurement (workers scenario)")
+    parser.add_argument("--output", help="write the JSON report to this file as well as stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    args = parser.parse_args()
+    report = asyncio.run(SCENARIOS[args.scenario](args))
+    report["meta"] = {"git": git_revision(), "python": sys.version.split()[0], "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["diff"] = compare({k: v for k, v in baseline.items() if k != "meta"}, {k: v for k, v in report.items() if k != "meta"})
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    for failure in report.get("failed", []):
+        print("FAILED: " + failure, file=sys.stderr)
+    if report.get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+In-process TTL/LRU caches.
+
+Every cache created here is registered by name so its hit/miss counters
+can be reported by the health check.  A cache with `maxsize` or `ttl` of 0
+is disabled: lookups always miss and writes are dropped.
+
+Each worker process has its own copy of every cache.  Invalidations of a
+cache created with `shared=True` are published to the other workers (see
+shared.py), so an entry dropped in one process does not live on in another
+until it expires.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+import shared
+import store
+
+_MISSING = object()
+_registry: Dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int, ttl: float, shared: bool = False):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys: Iterable[Hashable], publish: bool = True) -> None:
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+        if publish and self.shared and keys and shared.enabled:
+            store.offload(shared.publish, "cache", {"cache": self.name, "keys": keys})
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+        if self.shared and shared.enabled:
+            store.offload(shared.publish, "cache", {"cache": self.name, "keys": None})
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def stats() -> Dict[str, dict]:
+    return {name: c.stats() for name, c in _registry.items()}
+
+
+def _on_invalidate(message: dict) -> None:
+    target = _registry.get(message["cache"])
+    if target is None:
+        return
+    if message["keys"] is None:
+        with target._lock:
+            target._data.clear()
+    else:
+        target.invalidate_many(message["keys"], publish=False)
+
+
+shared.subscribe("cache", _on_invalidate)
+
+
+# Authenticated user rows by id; invalidated whenever tier or usage changes.
+user_cache = TTLCache("users", int(os.getenv("USER_CACHE_SIZE", 10000)), float(os.getenv("USER_CACHE_TTL", 60)), shared=True)
+
+# Decoded JWT payloads by raw token, so each token's signature is verified once.
+token_cache = TTLCache("tokens", int(os.getenv("TOKEN_CACHE_SIZE", 10000)), float(os.getenv("TOKEN_CACHE_TTL", 300)))
@@ -1,19 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
-import openai
-import os
+from typing import List, Optional
+import drafts
 from auth import get_current_user
+from config import MODEL_REGISTRY
+from context import conversation_context
+from routing import model_router
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-MODELS = {
-    "scamper": "gpt-4o-mini",
-    "gold buckle": "gpt-4o", 
-    "bodacious": "gpt-4-turbo"
-}
+# Display names ("gold buckle") to registry keys
+MODELS = {entry["name"].lower(): key for key, entry in MODEL_REGISTRY.items()}
+SYSTEM_PROMPT = "You are RodeoAI, an expert on all things rodeo. Provide accurate, practical advice about rodeo events, techniques, equipment, and western lifestyle. Be concise and helpful."
 
 class Message(BaseModel):
     role: str
@@ -22,33 +21,25 @@ class Message(BaseModel):
 class ChatRequest(BaseModel):
     messages: List[Message]
     model: str = "scamper"
+    conversation_id: Optional[int] = None
 
 @router.post("/")
 async def chat(request: ChatRequest, current_user: dict = Depends(get_current_user)):
     if request.model not in MODELS:
         raise HTTPException(status_code=400, detail="Invalid model")
     
-    openai_model = MODELS[request.model]
+    model_key = MODELS[request.model]
+    conversation_id, message_id = await drafts.open_exchange(current_user, request.conversation_id, model_key, [(msg.role, msg.content) for msg in request.messages])
     messages = [
-        {
-            "role": "system",
-            "content": "You are RodeoAI, an expert on all things rodeo. Provide accurate, practical advice about rodeo events, techniques, equipment, and western lifestyle. Be concise and helpful."
-        }
-    ] + [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        {"role": "system", "content": SYSTEM_PROMPT}
+    ] + await conversation_context(conversation_id, model_key, SYSTEM_PROMPT)
+    draft = drafts.start(message_id, conversation_id, model_router.stream(model_key, messages))
     
     async def generate():
         try:
-            stream = openai.chat.completions.create(
-                model=openai_model,
-                messages=messages,
-                stream=True,
-                temperature=0.7,
-                max_tokens=2000
-            )
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            async for content in draft.follow():
+                yield content
         except Exception as e:
             yield f"\n\n[Error: {str(e)}]"
     
-    return StreamingResponse(generate(), media_type="text/plain")
+    return StreamingResponse(generate(), media_type="text/plain", headers=drafts.headers(conversation_id, message_id))
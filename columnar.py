@@ -0,0 +1,453 @@
+"""
+Columnar analytics store for usage_logs and the analytics NDJSON files.
+
+Compaction copies new `usage_logs` rows and analytics log lines into one
+partition directory per UTC day under `ANALYTICS_STORE_DIR`.  Each column
+is a flat binary file of fixed-width values (stdlib `array`), so a day is
+appended to with one write per column and read back with one read.  Model
+and tier names are dictionary-encoded.  Alongside its columns every
+partition keeps rollups, one file per dimension: request, token and cost
+totals per model, user and tier for `usage`, and per model for `events`.
+
+Time-range aggregates are answered from the rollups alone, so their cost
+depends on the number of days rather than rows.  Filtered queries that no
+rollup covers (one user on one model, say) scan the columns.
+
+Compaction is incremental: the last `usage_logs` id, the byte offset into
+the live analytics log and the rotated files already read are kept in
+`state.json`.  It runs every `ANALYTICS_COMPACT_INTERVAL` seconds while
+the app is up, in one worker at a time (a shared.py lease), or on demand
+with `POST /api/analytics/compact` or `python columnar.py compact`, which
+take the same lease and give up (409) while another worker holds it.
+
+Every process keeps the dictionary, state and rollups it has read in
+memory.  A compaction holds a file lock on the store and starts from the
+state and dictionary on disk, so two processes never ingest the same rows
+or hand out the same code twice; queries reload whatever changed once
+another process has saved a new `state.json`.
+"""
+
+import asyncio
+import contextlib
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+from array import array
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+
+import shared
+import store
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ANALYTICS_STORE_DIR = os.getenv("ANALYTICS_STORE_DIR", "analytics_store")
+ANALYTICS_COMPACT_INTERVAL = float(os.getenv("ANALYTICS_COMPACT_INTERVAL", 300))
+ANALYTICS_API_KEY = os.getenv("ANALYTICS_API_KEY")
+COMPACT_BATCH = 50000
+
+SCHEMAS = {
+    "usage": {
+        "user_id": "i",
+        "model": "H",
+        "tier": "H",
+        "prompt_tokens": "i",
+        "completion_tokens": "i",
+        "cost": "d",
+        "second": "i"
+    },
+    "events": {
+        "chat_id": "q",
+        "model": "H",
+        "prompt_chars": "i",
+        "response_chars": "i",
+        "second": "i"
+    }
+}
+
+router = APIRouter(prefix="/api/analytics", tags=["analytics"])
+logger = logging.getLogger(__name__)
+
+
+class ColumnarStore:
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        self._rollups: Dict[tuple, dict] = {}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        self._loaded = self._stamp()
+        self.dictionary = self._load_json("dictionary.json", {"model": [], "tier": []})
+        self.state = self._load_json("state.json", {"usage_id": 0, "log_offset": 0, "log_files": []})
+        self._rollups = {}
+
+    def _stamp(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(os.path.join(self.root, "state.json"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def refresh(self) -> None:
+        """Reload the dictionary and state, and drop cached rollups, if another process saved since we read them."""
+        if self._stamp() != self._loaded:
+            self._load()
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        """Hold the store's file lock, so one process compacts at a time."""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, "compact.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_json(self, name: str, default: dict) -> dict:
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_json(self, path: str, data: dict) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def encode(self, field: str, value: Optional[str]) -> int:
+        values = self.dictionary[field]
+        value = value or ""
+        try:
+            return values.index(value)
+        except ValueError:
+            values.append(value)
+            return len(values) - 1
+
+    def _partition(self, table: str, day: str) -> str:
+        return os.path.join(self.root, table, day)
+
+    def append(self, table: str, day: str, columns: Dict[str, array], rollup: dict) -> None:
+        """Append encoded columns to a day and merge its rollups."""
+        path = self._partition(table, day)
+        os.makedirs(path, exist_ok=True)
+        for name in SCHEMAS[table]:
+            with open(os.path.join(path, name), "ab") as f:
+                columns[name].tofile(f)
+        for dimension, groups in rollup.items():
+            merged = self.rollup(table, day, dimension)
+            for key, values in groups.items():
+                _sum_into(merged, key, values)
+            self._save_json(os.path.join(path, f"rollup_{dimension}.json"), merged)
+
+    def rollup(self, table: str, day: str, dimension: str) -> dict:
+        cached = self._rollups.get((table, day, dimension))
+        if cached is None:
+            path = os.path.join(self._partition(table, day), f"rollup_{dimension}.json")
+            cached = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    cached = json.load(f)
+            self._rollups[(table, day, dimension)] = cached
+        return cached
+
+    def columns(self, table: str, day: str, names: Iterable[str]) -> Dict[str, array]:
+        path = self._partition(table, day)
+        loaded = {}
+        for name in names:
+            column = array(SCHEMAS[table][name])
+            column_path = os.path.join(path, name)
+            with open(column_path, "rb") as f:
+                column.fromfile(f, os.path.getsize(column_path) // column.itemsize)
+            loaded[name] = column
+        return loaded
+
+    def save_metadata(self) -> None:
+        self._save_json(os.path.join(self.root, "dictionary.json"), self.dictionary)
+        self._save_json(os.path.join(self.root, "state.json"), self.state)
+        self._loaded = self._stamp()
+
+    # -- compaction -----------------------------------------------------
+
+    def compact(self, log_path: str) -> dict:
+        with self._lock, self._exclusive():
+            self.refresh()
+            usage_rows = self._compact_usage()
+            event_rows = self._compact_events(log_path)
+            self.save_metadata()
+        return {"usage_rows": usage_rows, "event_rows": event_rows}
+
+    def _compact_usage(self) -> int:
+        total = 0
+        while True:
+            with store.connection() as conn:
+                rows = conn.execute("""
+                    SELECT l.id, l.user_id, l.model, u.tier, l.prompt_tokens, l.completion_tokens, l.cost, l.created_at
+                    FROM usage_logs l LEFT JOIN users u ON u.id = l.user_id
+                    WHERE l.id > ? ORDER BY l.id LIMIT ?
+                """, (self.state["usage_id"], COMPACT_BATCH)).fetchall()
+            if not rows:
+                return total
+            by_day = defaultdict(list)
+            for row in rows:
+                by_day[row["created_at"][:10]].append(row)
+            for day, day_rows in by_day.items():
+                columns = {name: array(code) for name, code in SCHEMAS["usage"].items()}
+                rollup = {}
+                for row in day_rows:
+                    created = row["created_at"]
+                    values = (row["user_id"], self.encode("model", row["model"]), self.encode("tier", row["tier"]),
+                              row["prompt_tokens"], row["completion_tokens"], row["cost"],
+                              int(created[11:13] or 0) * 3600 + int(created[14:16] or 0) * 60 + int(float(created[17:19] or 0)))
+                    for name, value in zip(SCHEMAS["usage"], values):
+                        columns[name].append(value)
+                    _add(rollup, {"model": row["model"], "user": str(row["user_id"]), "tier": row["tier"] or ""},
+                         (1, row["prompt_tokens"], row["completion_tokens"], row["cost"]))
+                self.append("usage", day, columns, rollup)
+            self.state["usage_id"] = rows[-1]["id"]
+            total += len(rows)
+
+    def _compact_events(self, log_path: str) -> int:
+        total = 0
+        for rotated in sorted(glob.glob(log_path + ".*.gz")):
+            name = os.path.basename(rotated)
+            if name in self.state["log_files"]:
+                continue
+            # The oldest unread rotated file is the live log we were reading;
+            # its first log_offset bytes have already been ingested.
+            skip, self.state["log_offset"] = self.state["log_offset"], 0
+            with gzip.open(rotated, "rb") as f:
+                if skip:
+                    f.seek(skip)
+                total += self._ingest_lines(line.decode() for line in f)
+            self.state["log_files"].append(name)
+        if os.path.exists(log_path):
+            if os.path.getsize(log_path) < self.state["log_offset"]:
+                self.state["log_offset"] = 0
+            with open(log_path) as f:
+                f.seek(self.state["log_offset"])
+                lines = []
+                for line in iter(f.readline, ""):
+                    if not line.endswith("\n"):
+                        break
+                    lines.append(line)
+                total += self._ingest_lines(lines)
+                self.state["log_offset"] += sum(len(line.encode()) for line in lines)
+        return total
+
+    def _ingest_lines(self, lines: Iterable[str]) -> int:
+        by_day = defaultdict(lambda: ({name: array(code) for name, code in SCHEMAS["events"].items()}, {}))
+        count = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                when = datetime.utcfromtimestamp(entry["timestamp"] / 1000)
+            except (ValueError, KeyError, TypeError):
+                continue
+            columns, rollup = by_day[when.date().isoformat()]
+            values = (entry.get("chatId", 0), self.encode("model", entry.get("model")),
+                      len(entry.get("prompt", "")), len(entry.get("response", "")),
+                      when.hour * 3600 + when.minute * 60 + when.second)
+            for name, value in zip(SCHEMAS["events"], values):
+                columns[name].append(value)
+            _add(rollup, {"model": entry.get("model", "")}, (1, values[2], values[3]))
+            count += 1
+        for day, (columns, rollup) in by_day.items():
+            self.append("events", day, columns, rollup)
+        return count
+
+    # -- queries --------------------------------------------------------
+
+    def aggregate(self, table: str, start: str, end: str, group_by: str) -> dict:
+        """Totals for [start, end] from the per-day rollups."""
+        self.refresh()
+        result: dict = {}
+        for day in _day_range(start, end):
+            if not os.path.isdir(self._partition(table, day)):
+                continue
+            if group_by == "day":
+                result[day] = list(self.rollup(table, day, "total").get("all", []))
+            else:
+                for key, values in self.rollup(table, day, group_by).items():
+                    _sum_into(result, key, values)
+        return result
+
+    def scan_usage(self, start: str, end: str, user_id: Optional[int] = None, model: Optional[str] = None) -> list:
+        """Filtered usage totals computed from the raw columns."""
+        self.refresh()
+        model_code = self.dictionary["model"].index(model) if model in self.dictionary["model"] else -1
+        if model is not None and model_code < 0:
+            return [0, 0, 0, 0.0]
+        totals = [0, 0, 0, 0.0]
+        for day in _day_range(start, end):
+            if not os.path.isdir(self._partition("usage", day)):
+                continue
+            cols = self.columns("usage", day, ("user_id", "model", "prompt_tokens", "completion_tokens", "cost"))
+            users, models = cols["user_id"], cols["model"]
+            prompt, completion, cost = cols["prompt_tokens"], cols["completion_tokens"], cols["cost"]
+            for i in range(len(users)):
+                if (user_id is None or users[i] == user_id) and (model is None or models[i] == model_code):
+                    totals[0] += 1
+                    totals[1] += prompt[i]
+                    totals[2] += completion[i]
+                    totals[3] += cost[i]
+        return totals
+
+
+def _add(rollup: dict, keys: Dict[str, str], values: tuple) -> None:
+    _sum_into(rollup.setdefault("total", {}), "all", values)
+    for dimension, key in keys.items():
+        _sum_into(rollup.setdefault(dimension, {}), key, values)
+
+
+def _sum_into(target: dict, key: str, values) -> None:
+    current = target.get(key)
+    if current is None:
+        target[key] = list(values)
+    else:
+        for i, value in enumerate(values):
+            current[i] += value
+
+
+def _day_range(start: str, end: str) -> Iterable[str]:
+    day, last = date.fromisoformat(start), date.fromisoformat(end)
+    while day <= last:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
+
+columnar_store: Optional[ColumnarStore] = None
+
+
+def get_store() -> ColumnarStore:
+    global columnar_store
+    if columnar_store is None:
+        columnar_store = ColumnarStore(ANALYTICS_STORE_DIR)
+    return columnar_store
+
+
+def compact() -> dict:
+    return get_store().compact(os.getenv("ANALYTICS_LOG", "analytics.log"))
+
+
+def compacted_usage_id() -> int:
+    """The last `usage_logs` id copied into the store, as last saved by any worker (0 before the first compaction)."""
+    try:
+        with open(os.path.join(ANALYTICS_STORE_DIR, "state.json")) as f:
+            return json.load(f).get("usage_id", 0)
+    except FileNotFoundError:
+        return 0
+
+
+def lease() -> bool:
+    """Take or renew the compaction role; False while another worker holds it."""
+    return shared.lease("analytics-compaction", 2 * max(ANALYTICS_COMPACT_INTERVAL, 60))
+
+
+async def _compact_periodically() -> None:
+    while True:
+        await asyncio.sleep(ANALYTICS_COMPACT_INTERVAL)
+        try:
+            if await store.run(lease):
+                await store.run(compact)
+        except Exception:
+            logger.exception("analytics compaction failed")
+
+
+_tasks: List[asyncio.Task] = []
+
+
+async def start_compaction() -> None:
+    if ANALYTICS_COMPACT_INTERVAL > 0 and not _tasks:
+        _tasks.append(asyncio.get_running_loop().create_task(_compact_periodically()))
+
+
+async def stop_compaction() -> None:
+    while _tasks:
+        _tasks.pop().cancel()
+
+
+def require_analytics_key(x_analytics_key: Optional[str] = Header(None)) -> None:
+    if not ANALYTICS_API_KEY or x_analytics_key != ANALYTICS_API_KEY:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Analytics key required")
+
+
+def _validate_range(start: str, end: str) -> None:
+    try:
+        if date.fromisoformat(start) > date.fromisoformat(end):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start and end must be YYYY-MM-DD with start <= end")
+
+
+@router.get("/usage", dependencies=[Depends(require_analytics_key)])
+async def usage_aggregates(
+    start: str,
+    end: str,
+    group_by: str = Query("model", pattern="^(model|user|tier|day)$"),
+    user_id: Optional[int] = None,
+    model: Optional[str] = None
+):
+    """Requests, prompt/completion tokens and cost over a date range."""
+    _validate_range(start, end)
+    columnar = get_store()
+    if user_id is not None or model is not None:
+        requests, prompt_tokens, completion_tokens, cost = await store.run(columnar.scan_usage, start, end, user_id, model)
+        return {"start": start, "end": end, "user_id": user_id, "model": model, "requests": requests,
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cost": round(cost, 6)}
+    groups = await store.run(columnar.aggregate, "usage", start, end, group_by)
+    return {
+        "start": start,
+        "end": end,
+        "group_by": group_by,
+        "groups": {key: {"requests": v[0], "prompt_tokens": v[1], "completion_tokens": v[2], "cost": round(v[3], 6)}
+                   for key, v in groups.items() if v}
+    }
+
+
+@router.get("/events", dependencies=[Depends(require_analytics_key)])
+async def event_aggregates(start: str, end: str, group_by: str = Query("model", pattern="^(model|day)$")):
+    """Logged chats and prompt/response sizes over a date range."""
+    _validate_range(start, end)
+    groups = await store.run(get_store().aggregate, "events", start, end, group_by)
+    return {
+        "start": start,
+        "end": end,
+        "group_by": group_by,
+        "groups": {key: {"chats": v[0], "prompt_chars": v[1], "response_chars": v[2]} for key, v in groups.items() if v}
+    }
+
+
+@router.post("/compact", dependencies=[Depends(require_analytics_key)])
+async def compact_now():
+    if not await store.run(lease):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another worker is compacting")
+    return await store.run(compact)
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] != ["compact"]:
+        sys.exit("usage: python columnar.py compact")
+    # respect the workers' lease whenever they share state
+    shared.enabled = shared.enabled or os.path.exists(shared.SHARED_STATE_PATH)
+    if not lease():
+        sys.exit("another worker holds the analytics-compaction lease; try again later")
+    try:
+        print(json.dumps(compact()))
+    finally:
+        shared.release("analytics-compaction")
@@ -1,37 +1,79 @@
 import os
 from typing import Dict, Any
 
-FOUNDATION_MODELS: Dict[str, Dict[str, Any]] = {
+# Single source of truth for the chat models.  Every other model map
+# (main.RODEO_MODELS, FOUNDATION_MODELS below, chat.MODELS, quota.MODEL_COSTS)
+# is derived from this one.  `fallbacks` are tried in order when the upstream
+# model fails or misses `ttft_budget` (seconds to first token).  `base_model`,
+# where set, is the model quota reports pricing against instead of `model`.
+MODEL_REGISTRY: Dict[str, Dict[str, Any]] = {
     "scamper": {
         "name": "Scamper",
-        "description": "Fast, efficient, instant answers",
-        "openai_model": "gpt-4o-mini",
-        "icon": "⚡",
+        "model": "gpt-4o-mini",
+        "description": "Lightning-fast answers",
+        "details": "Fast, efficient, instant answers",
+        "emoji": "⚡",
         "color": "#008B8B",
         "tagline": "Lightning-fast rodeo answers",
+        "system_prompt": "You are Scamper, a lightning-fast rodeo assistant. Provide quick, concise answers.",
+        "temperature": 0.7,
         "max_tokens": 1000,
-        "temperature": 0.7
+        "context_budget": 4000,
+        "cost_input": 0.00000015,
+        "cost_output": 0.0000006,
+        "ttft_budget": 3.0,
+        "fallbacks": []
     },
     "gold-buckle": {
         "name": "Gold Buckle",
-        "description": "Balanced, everyday workhorse",
-        "openai_model": "gpt-4o",
-        "icon": "🏆",
+        "model": "gpt-4o",
+        "description": "Your champion companion",
+        "details": "Balanced, everyday workhorse",
+        "emoji": "🏆",
         "color": "#DAA520",
         "tagline": "Your champion companion",
+        "system_prompt": "You are Gold Buckle, a balanced rodeo expert. Provide comprehensive answers.",
+        "temperature": 0.7,
         "max_tokens": 2000,
-        "temperature": 0.7
+        "context_budget": 8000,
+        "cost_input": 0.0000025,
+        "cost_output": 0.00001,
+        "ttft_budget": 5.0,
+        "fallbacks": ["scamper"]
     },
     "bodacious": {
         "name": "Bodacious",
-        "description": "Maximum power, deep reasoning, complex analysis",
-        "openai_model": "gpt-4-turbo",
-        "icon": "🐂",
+        "model": "gpt-4-turbo",
+        "base_model": "gpt-4",
+        "description": "Unstoppable intelligence",
+        "details": "Maximum power, deep reasoning, complex analysis",
+        "emoji": "🐂",
         "color": "#8B0000",
         "tagline": "Unstoppable intelligence",
+        "system_prompt": "You are Bodacious, the most powerful rodeo assistant. Provide deep analysis.",
+        "temperature": 0.7,
         "max_tokens": 4000,
-        "temperature": 0.7
+        "context_budget": 16000,
+        "cost_input": 0.000003,
+        "cost_output": 0.000015,
+        "ttft_budget": 8.0,
+        "fallbacks": ["gold-buckle", "scamper"]
+    }
+}
+
+FOUNDATION_MODELS: Dict[str, Dict[str, Any]] = {
+    key: {
+        "name": entry["name"],
+        "description": entry["details"],
+        "openai_model": entry["model"],
+        "icon": entry["emoji"],
+        "color": entry["color"],
+        "tagline": entry["tagline"],
+        "max_tokens": entry["max_tokens"],
+        "context_budget": entry["context_budget"],
+        "temperature": entry["temperature"]
     }
+    for key, entry in MODEL_REGISTRY.items()
 }
 
 TIER_LIMITS: Dict[str, Dict[str, Any]] = {
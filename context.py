@@ -0,0 +1,164 @@
+"""
+Token-aware context windows for chat requests.
+
+Every model has a prompt budget (`context_budget` in config.FOUNDATION_MODELS).
+Only the most recent turns that fit in it are sent upstream; the newest
+message is always kept.  The start of the window moves in steps of
+`CONTEXT_TRIM_STEP` of the budget rather than one turn at a time, so
+consecutive requests of a conversation share a byte-identical prefix the
+provider can serve from its prompt cache (see prompts.py).  Token counts
+are estimated with tiktoken when it is installed and a characters/4
+heuristic otherwise, and are cached: per message text in memory, and per
+stored message in `messages.tokens_used`.
+
+For stored conversations the turns that fall out of the window are folded
+into a rolling summary kept on the conversation row (`summary`, plus
+`summary_upto`, the id of the last message it covers).  The summary is
+refreshed by a background job (jobs.py) with a cheap Scamper call, so a
+request never waits for it; it uses whatever summary is current, and the
+window never reaches back into the turns that summary covers.
+"""
+
+import functools
+import os
+from typing import Dict, List, Optional
+
+import db_models
+import jobs
+import store
+import upstream
+from config import FOUNDATION_MODELS
+
+CONTEXT_LOAD_LIMIT = int(os.getenv("CONTEXT_LOAD_LIMIT", 200))
+CONTEXT_TRIM_STEP = float(os.getenv("CONTEXT_TRIM_STEP", 0.2))
+SUMMARY_MODEL = "scamper"
+SUMMARY_MAX_TOKENS = 400
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a rodeo assistant conversation. "
+    "Merge the new turns into the current summary. Keep names, horses, events, "
+    "dates and open questions; drop pleasantries. Reply with the summary only."
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    # imported and loaded on first use: reading the BPE ranks takes a while
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def preload() -> None:
+    """Load the tokenizer, e.g. on a worker thread before the first request counts tokens."""
+    _encoding()
+
+
+@functools.lru_cache(maxsize=50000)
+def message_tokens(content: str) -> int:
+    """Prompt tokens a message costs, including per-message framing."""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(content)) + MESSAGE_OVERHEAD
+    return len(content) // 4 + 1 + MESSAGE_OVERHEAD
+
+
+def budget_for(model_key: str) -> int:
+    return FOUNDATION_MODELS.get(model_key, FOUNDATION_MODELS["scamper"])["context_budget"]
+
+
+def window_start(counts: List[int], budget: int, step: float = CONTEXT_TRIM_STEP) -> int:
+    """Index of the oldest message in the newest run that fits `budget`.
+
+    Messages are dropped in whole steps of `step` * `budget` tokens, counted
+    from the first message, so the start stays put while a conversation
+    grows until another step has to go.
+    """
+    used = 0
+    start = len(counts)
+    for i in range(len(counts) - 1, -1, -1):
+        used += counts[i]
+        if used > budget and start < len(counts):
+            break
+        start = i
+    size = int(step * budget)
+    if size <= 0 or start == 0:
+        return start
+    # move forward to the first message of the next step, if one is left before the newest
+    before = sum(counts[:start - 1])
+    previous = before // size
+    before += counts[start - 1]
+    for i in range(start, len(counts) - 1):
+        if before // size > previous:
+            return i
+        previous = before // size
+        before += counts[i]
+    return start
+
+
+async def conversation_context(conversation_id: int, model_key: str, system_prompt: str) -> List[dict]:
+    """Upstream messages for a stored conversation: summary, then recent turns."""
+    conversation = await store.run(db_models.get_conversation, conversation_id)
+    rows = await store.run(db_models.get_recent_messages, conversation_id, CONTEXT_LOAD_LIMIT)
+    counted = []
+    for row in rows:
+        if not row["tokens_used"]:
+            row["tokens_used"] = message_tokens(row["content"])
+            counted.append((row["tokens_used"], row["id"]))
+    if counted:
+        await store.run(db_models.set_message_tokens, counted)
+
+    summary = conversation.get("summary")
+    budget = budget_for(model_key) - message_tokens(system_prompt) - (message_tokens(summary) if summary else 0)
+    start = window_start([row["tokens_used"] for row in rows], budget)
+    upto = conversation.get("summary_upto") or 0
+    if summary:
+        # never resend what the summary covers, e.g. after switching to a model with a larger budget
+        covered = sum(1 for row in rows if row["id"] <= upto)
+        start = max(start, min(covered, len(rows) - 1))
+    evicted = [row for row in rows[:start] if row["id"] > upto]
+    if evicted:
+        schedule_summary(conversation_id, evicted[-1]["id"])
+
+    context = []
+    if summary:
+        context.append({"role": "system", "content": "Summary of the earlier conversation:\n" + summary})
+    return context + [{"role": row["role"], "content": row["content"]} for row in rows[start:]]
+
+
+async def refresh_summary(conversation_id: int, summary: Optional[str], evicted: List[Dict]) -> str:
+    transcript = "\n".join(f"{row['role']}: {row['content']}" for row in evicted)
+    model = FOUNDATION_MODELS[SUMMARY_MODEL]
+    new_summary = await upstream.complete_chat(
+        model["openai_model"],
+        [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"}
+        ],
+        0.3,
+        SUMMARY_MAX_TOKENS
+    )
+    await store.run(db_models.update_conversation_summary, conversation_id, new_summary, evicted[-1]["id"])
+    return new_summary
+
+
+def schedule_summary(conversation_id: int, upto: int) -> None:
+    """Fold the turns up to message `upto` into the conversation's summary, in the background."""
+    jobs.defer("summary", {"conversation_id": conversation_id, "upto": upto}, key=str(conversation_id))
+
+
+async def summarize(payloads: List[dict]) -> None:
+    for payload in payloads:
+        conversation = await store.run(db_models.get_conversation, payload["conversation_id"])
+        after = (conversation or {}).get("summary_upto") or 0
+        if conversation is None or payload["upto"] <= after:
+            continue
+        evicted = await store.run(db_models.get_messages_between, conversation["id"], after, payload["upto"])
+        if evicted:
+            await refresh_summary(conversation["id"], conversation.get("summary"), evicted)
+
+
+jobs.register("summary", summarize)
@@ -2,8 +2,15 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from config import DATABASE_URL
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# built on first use, so importing this module opens nothing
+_session_factory = None
+
+def async_session() -> AsyncSession:
+    global _session_factory
+    if _session_factory is None:
+        engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+        _session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    return _session_factory()
 
 async def get_db():
     async with async_session() as session:
@@ -1,121 +1,280 @@
-import sqlite3
 from datetime import datetime
-from typing import Optional, List, Dict
+import html
+from typing import Optional, List, Dict, Tuple
+import archive
+import store
+from cache import user_cache
+from metering import ledger
+from migrations import MIGRATIONS, current_version, migrate
+from store import connection
 
-def get_db():
-    conn = sqlite3.connect("rodeoai.db")
-    conn.row_factory = sqlite3.Row
-    return conn
+MESSAGE_PREVIEW_CHARS = 200
 
 def init_all_tables():
-    conn = get_db()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            tier TEXT DEFAULT 'free',
-            daily_usage INTEGER DEFAULT 0,
-            total_usage INTEGER DEFAULT 0,
-            last_reset TEXT DEFAULT CURRENT_TIMESTAMP,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT,
-            model TEXT DEFAULT 'scamper',
-            persona TEXT DEFAULT 'general',
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            tokens_used INTEGER DEFAULT 0,
-            model TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS usage_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            conversation_id INTEGER,
-            model TEXT NOT NULL,
-            prompt_tokens INTEGER DEFAULT 0,
-            completion_tokens INTEGER DEFAULT 0,
-            total_tokens INTEGER DEFAULT 0,
-            cost REAL DEFAULT 0,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                tier TEXT DEFAULT 'free',
+                daily_usage INTEGER DEFAULT 0,
+                total_usage INTEGER DEFAULT 0,
+                last_reset TEXT DEFAULT CURRENT_TIMESTAMP,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                title TEXT,
+                model TEXT DEFAULT 'scamper',
+                persona TEXT DEFAULT 'general',
+                summary TEXT,
+                summary_upto INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens_used INTEGER DEFAULT 0,
+                model TEXT,
+                status TEXT DEFAULT 'complete',
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                conversation_id INTEGER,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                total_tokens INTEGER DEFAULT 0,
+                cost REAL DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            )
+        """)
+        # users may predate total_usage when an older auth.init_db created the table first
+        _add_missing_columns(conn, "users", {"total_usage": "INTEGER DEFAULT 0"})
+        _add_missing_columns(conn, "conversations", {"summary": "TEXT", "summary_upto": "INTEGER DEFAULT 0"})
+        _add_missing_columns(conn, "messages", {"status": "TEXT DEFAULT 'complete'"})
+        migrate(conn)
+
+def ensure_schema():
+    """Create and migrate the tables unless they are current, which costs one PRAGMA read."""
+    with connection() as conn:
+        current = current_version(conn) >= len(MIGRATIONS)
+    if not current:
+        init_all_tables()
+
+# once per process, before the first connection is handed out (or at startup, see store.prepare)
+store.setup(ensure_schema)
+
+def _add_missing_columns(conn, table: str, columns: Dict[str, str]):
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
 
 def create_conversation(user_id: int, model: str = "scamper", persona: str = "general") -> int:
-    conn = get_db()
-    cursor = conn.execute("INSERT INTO conversations (user_id, model, persona) VALUES (?, ?, ?)", (user_id, model, persona))
-    conversation_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return conversation_id
+    with connection() as conn:
+        cursor = conn.execute("INSERT INTO conversations (user_id, model, persona, updated_at) VALUES (?, ?, ?, ?)", (user_id, model, persona, datetime.utcnow().isoformat()))
+        return cursor.lastrowid
 
 def get_conversation(conversation_id: int) -> Optional[Dict]:
-    conn = get_db()
-    conv = conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
-    conn.close()
+    with connection() as conn:
+        conv = conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
     return dict(conv) if conv else None
 
 def get_user_conversations(user_id: int, limit: int = 50) -> List[Dict]:
-    conn = get_db()
-    convs = conn.execute("SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?", (user_id, limit)).fetchall()
-    conn.close()
+    with connection() as conn:
+        convs = conn.execute("SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?", (user_id, limit)).fetchall()
+    return [dict(c) for c in convs]
+
+def list_conversations(user_id: int, limit: int, before: Optional[Tuple[str, int]] = None) -> List[Dict]:
+    """A page of conversations, most recently updated first, after the (updated_at, id) cursor `before`."""
+    sql = "SELECT id, title, model, persona, created_at, updated_at FROM conversations WHERE user_id = ?"
+    params: list = [user_id]
+    if before is not None:
+        sql += " AND (updated_at, id) < (?, ?)"
+        params += before
+    with connection() as conn:
+        convs = conn.execute(sql + " ORDER BY updated_at DESC, id DESC LIMIT ?", params + [limit]).fetchall()
     return [dict(c) for c in convs]
 
 def update_conversation_title(conversation_id: int, title: str):
-    conn = get_db()
-    conn.execute("UPDATE conversations SET title = ?, updated_at = ? WHERE id = ?", (title, datetime.utcnow().isoformat(), conversation_id))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        conn.execute("UPDATE conversations SET title = ?, updated_at = ? WHERE id = ?", (title, datetime.utcnow().isoformat(), conversation_id))
+
+def get_untitled_openings(conversation_ids: List[int]) -> Dict[int, str]:
+    """First user message of each conversation in `conversation_ids` that has no title yet."""
+    placeholders = ",".join("?" * len(conversation_ids))
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT c.id, (SELECT m.content FROM messages m WHERE m.conversation_id = c.id AND m.role = 'user' ORDER BY m.id LIMIT 1) AS opening
+            FROM conversations c WHERE c.id IN ({placeholders}) AND c.title IS NULL
+        """, conversation_ids).fetchall()
+    return {row["id"]: row["opening"] for row in rows if row["opening"]}
+
+def set_generated_titles(titles: List[tuple]):
+    """Store (title, conversation_id) pairs, keeping titles set meanwhile; the history order is unchanged."""
+    with connection() as conn:
+        conn.executemany("UPDATE conversations SET title = ? WHERE id = ? AND title IS NULL", titles)
 
 def add_message(conversation_id: int, role: str, content: str, tokens_used: int = 0, model: str = None) -> int:
-    conn = get_db()
-    cursor = conn.execute("INSERT INTO messages (conversation_id, role, content, tokens_used, model) VALUES (?, ?, ?, ?, ?)", (conversation_id, role, content, tokens_used, model))
-    message_id = cursor.lastrowid
-    conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), conversation_id))
-    conn.commit()
-    conn.close()
-    return message_id
+    with connection() as conn:
+        cursor = conn.execute("INSERT INTO messages (conversation_id, role, content, tokens_used, model) VALUES (?, ?, ?, ?, ?)", (conversation_id, role, content, tokens_used, model))
+        conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), conversation_id))
+        return cursor.lastrowid
+
+def start_exchange(conversation_id: int, messages: List[tuple], model: str) -> int:
+    """Append (role, content) messages plus an empty assistant draft; returns the draft's id."""
+    with connection() as conn:
+        conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)", [(conversation_id, role, content) for role, content in messages])
+        cursor = conn.execute("INSERT INTO messages (conversation_id, role, content, model, status) VALUES (?, 'assistant', '', ?, 'draft')", (conversation_id, model))
+        conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), conversation_id))
+        return cursor.lastrowid
+
+def checkpoint_message(message_id: int, text: str):
+    """Append streamed text to a draft."""
+    with connection() as conn:
+        conn.execute("UPDATE messages SET content = content || ? WHERE id = ? AND status = 'draft'", (text, message_id))
+
+def finalize_message(message_id: int, content: str, tokens_used: int, status: str = "complete"):
+    with connection() as conn:
+        conn.execute("UPDATE messages SET content = ?, tokens_used = ?, status = ? WHERE id = ?", (content, tokens_used, status, message_id))
+
+def get_message(message_id: int) -> Optional[Dict]:
+    """A message together with the id of the user owning its conversation."""
+    with connection() as conn:
+        message = conn.execute("SELECT m.*, c.user_id FROM messages m JOIN conversations c ON c.id = m.conversation_id WHERE m.id = ?", (message_id,)).fetchone()
+    if message is None:
+        message = archive.find_message(message_id)
+        if message is not None:
+            message["user_id"] = get_conversation(message["conversation_id"])["user_id"]
+    return dict(message) if message else None
+
+# snippet() delimits matches with these; the text is escaped before they become <mark> tags
+_MARK_OPEN, _MARK_CLOSE = "\ue000", "\ue001"
+
+def _highlight(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+def search_messages(user_id: int, match: str, limit: int, offset: int = 0, order: str = "relevance") -> List[Dict]:
+    """Completed messages of `user_id` matching the FTS5 expression `match`, best ranked or newest first."""
+    # bm25 reads the whole index to weigh each term, so "recent" does not score at all
+    relevance = order == "relevance"
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT m.id, m.conversation_id, m.role, m.created_at, c.title,
+                   snippet(messages_fts, 0, ?, ?, '…', 16) AS snippet,
+                   {"bm25(messages_fts)" if relevance else "NULL"} AS score
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid & 0xFFFFFFFF
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH ? AND messages_fts.rowid BETWEEN ? AND ?
+            ORDER BY {"rank" if relevance else "messages_fts.rowid DESC"}
+            LIMIT ? OFFSET ?
+        """, (_MARK_OPEN, _MARK_CLOSE, match, user_id << 32, (user_id << 32) | 0xFFFFFFFF, limit, offset)).fetchall()
+    return [dict(r, snippet=_highlight(r["snippet"])) for r in rows]
 
 def get_conversation_messages(conversation_id: int) -> List[Dict]:
-    conn = get_db()
-    messages = conn.execute("SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at ASC", (conversation_id,)).fetchall()
-    conn.close()
+    with connection() as conn:
+        messages = conn.execute("SELECT * FROM messages WHERE conversation_id = ? ORDER BY id ASC", (conversation_id,)).fetchall()
+    if not messages:
+        return archive.read_messages(conversation_id) or []
     return [dict(m) for m in messages]
 
+def list_messages(conversation_id: int, limit: int, before_id: Optional[int] = None, after_id: Optional[int] = None, bodies: bool = False) -> List[Dict]:
+    """A page of messages in chronological order.
+
+    Without a cursor (or with `before_id`) this is the newest page ending
+    before that id; `after_id` pages forward.  Unless `bodies` is set only a
+    preview of each message is read.
+    """
+    body = "content" if bodies else f"substr(content, 1, {MESSAGE_PREVIEW_CHARS + 1}) AS preview"
+    sql = f"SELECT id, role, model, status, tokens_used, created_at, {body} FROM messages WHERE conversation_id = ?"
+    params: list = [conversation_id]
+    if after_id is not None:
+        sql += " AND id > ? ORDER BY id ASC LIMIT ?"
+        params += [after_id, limit]
+    else:
+        if before_id is not None:
+            sql += " AND id < ?"
+            params.append(before_id)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+    with connection() as conn:
+        rows = [dict(m) for m in conn.execute(sql, params).fetchall()]
+    if not rows:
+        archived = archive.read_messages(conversation_id)
+        if archived:
+            rows = _page(archived, limit, before_id, after_id, bodies)
+    if after_id is None:
+        rows.reverse()
+    if not bodies:
+        for row in rows:
+            row["truncated"] = len(row["preview"]) > MESSAGE_PREVIEW_CHARS
+            row["preview"] = row["preview"][:MESSAGE_PREVIEW_CHARS]
+    return rows
+
+def _page(messages: List[Dict], limit: int, before_id: Optional[int], after_id: Optional[int], bodies: bool) -> List[Dict]:
+    """`list_messages` over an archived conversation: the same rows, in the order the query returns them."""
+    if after_id is not None:
+        page = [m for m in messages if m["id"] > after_id][:limit]
+    else:
+        page = [m for m in messages if before_id is None or m["id"] < before_id][-limit:][::-1]
+    columns = ("id", "role", "model", "status", "tokens_used", "created_at")
+    return [dict({c: m[c] for c in columns}, **({"content": m["content"]} if bodies else {"preview": m["content"][:MESSAGE_PREVIEW_CHARS + 1]}))
+            for m in page]
+
+def get_recent_messages(conversation_id: int, limit: int) -> List[Dict]:
+    with connection() as conn:
+        messages = conn.execute("SELECT * FROM messages WHERE conversation_id = ? AND status = 'complete' ORDER BY id DESC LIMIT ?", (conversation_id, limit)).fetchall()
+    return [dict(m) for m in reversed(messages)]
+
+def get_messages_between(conversation_id: int, after_id: int, upto_id: int) -> List[Dict]:
+    """Completed messages with `after_id` < id <= `upto_id`, oldest first."""
+    with connection() as conn:
+        rows = conn.execute("SELECT id, role, content FROM messages WHERE conversation_id = ? AND id > ? AND id <= ? AND status = 'complete' ORDER BY id", (conversation_id, after_id, upto_id)).fetchall()
+    return [dict(r) for r in rows]
+
+def set_message_tokens(counts: List[tuple]):
+    """Store token counts given as (tokens_used, message_id) pairs."""
+    with connection() as conn:
+        conn.executemany("UPDATE messages SET tokens_used = ? WHERE id = ?", counts)
+
+def update_conversation_summary(conversation_id: int, summary: str, summary_upto: int):
+    with connection() as conn:
+        conn.execute("UPDATE conversations SET summary = ?, summary_upto = ? WHERE id = ?", (summary, summary_upto, conversation_id))
+
 def log_usage(user_id: int, conversation_id: int, model: str, prompt_tokens: int, completion_tokens: int, cost: float):
-    conn = get_db()
-    total_tokens = prompt_tokens + completion_tokens
-    conn.execute("INSERT INTO usage_logs (user_id, conversation_id, model, prompt_tokens, completion_tokens, total_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?)", (user_id, conversation_id, model, prompt_tokens, completion_tokens, total_tokens, cost))
-    conn.execute("UPDATE users SET daily_usage = daily_usage + ?, total_usage = total_usage + ? WHERE id = ?", (total_tokens, total_tokens, user_id))
-    conn.commit()
-    conn.close()
+    # Buffered by the ledger; rows reach usage_logs on its next flush.
+    ledger.record(user_id, conversation_id, model, prompt_tokens, completion_tokens, cost)
+
+def set_user_tier(user_id: int, tier: str):
+    with connection() as conn:
+        conn.execute("UPDATE users SET tier = ? WHERE id = ?", (tier, user_id))
+    user_cache.invalidate(user_id)
 
 def get_user_usage_today(user_id: int) -> int:
-    conn = get_db()
-    user = conn.execute("SELECT daily_usage FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    usage = ledger.usage_today(user_id)
+    if usage is not None:
+        return usage
+    with connection() as conn:
+        user = conn.execute("SELECT daily_usage FROM users WHERE id = ?", (user_id,)).fetchone()
     return user["daily_usage"] if user else 0
-
-init_all_tables()
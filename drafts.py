@@ -0,0 +1,198 @@
+"""
+Incremental persistence of streamed assistant messages.
+
+A persisted chat first stores the user's turn and an empty assistant row
+with status 'draft' (`open_exchange`).  Generation then runs in its own
+task, detached from the HTTP response: deltas are kept in memory and
+appended to the draft row every `DRAFT_CHECKPOINT_SECONDS` or once
+`DRAFT_CHECKPOINT_CHARS` new characters have built up, and the row is
+finalized with its full content, token count and status ('complete' or
+'failed') when the stream ends.  One large write at the end would lose the
+answer on a crash; a write per delta would put the database on the hot
+path.
+
+Readers follow a draft from any character offset, so a client that
+disconnects can resume where it left off (SSE `Last-Event-ID`, see
+`event_id`).  While the draft is live the in-memory buffer is followed;
+afterwards the stored row is replayed.  A draft generated by another
+worker process is followed through its checkpoints, polling the row until
+it is finalized or has not grown for `DRAFT_STALE_SECONDS`.
+"""
+
+import asyncio
+import logging
+import os
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+
+import archive
+import db_models
+import store
+import titles
+from context import message_tokens
+
+DRAFT_CHECKPOINT_SECONDS = float(os.getenv("DRAFT_CHECKPOINT_SECONDS", 2))
+DRAFT_CHECKPOINT_CHARS = int(os.getenv("DRAFT_CHECKPOINT_CHARS", 2000))
+DRAFT_STALE_SECONDS = float(os.getenv("DRAFT_STALE_SECONDS", 60))
+
+logger = logging.getLogger(__name__)
+_tasks: Set[asyncio.Task] = set()
+
+
+class Draft:
+    def __init__(self, message_id: int, conversation_id: int):
+        self.message_id = message_id
+        self.conversation_id = conversation_id
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._saved = 0
+        self._changed = asyncio.Condition()
+
+    async def _publish(self, chunk: Optional[str] = None) -> None:
+        async with self._changed:
+            if chunk is not None:
+                self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    async def _checkpoint(self) -> None:
+        text = "".join(self.chunks[self._saved:])
+        self._saved = len(self.chunks)
+        await store.run(db_models.checkpoint_message, self.message_id, text)
+
+    async def run(self, deltas: AsyncIterator[str]) -> None:
+        loop = asyncio.get_running_loop()
+        last_checkpoint = loop.time()
+        pending = 0
+        state = "failed"
+        try:
+            async for delta in deltas:
+                await self._publish(delta)
+                pending += len(delta)
+                if pending >= DRAFT_CHECKPOINT_CHARS or loop.time() - last_checkpoint >= DRAFT_CHECKPOINT_SECONDS:
+                    await self._checkpoint()
+                    last_checkpoint = loop.time()
+                    pending = 0
+            state = "complete"
+        except Exception as e:
+            self.error = e
+        except BaseException:
+            self.error = RuntimeError("generation was cancelled")
+            raise
+        finally:
+            content = "".join(self.chunks)
+            try:
+                await store.run(db_models.finalize_message, self.message_id, content, message_tokens(content) if content else 0, state)
+            except Exception:
+                logger.exception("could not finalize message %s", self.message_id)
+            self.done = True
+            active.pop(self.message_id, None)
+            await self._publish()
+
+    async def follow(self, offset: int = 0) -> AsyncGenerator[str, None]:
+        """Deltas from character `offset` on, live until the draft is finished."""
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                chunk = self.chunks[index]
+                index += 1
+                if offset >= len(chunk):
+                    offset -= len(chunk)
+                    continue
+                yield chunk[offset:]
+                offset = 0
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: index < len(self.chunks) or self.done)
+
+
+active: Dict[int, Draft] = {}
+
+
+def start(message_id: int, conversation_id: int, deltas: AsyncIterator[str]) -> Draft:
+    """Generate into the draft row `message_id` in the background."""
+    draft = active[message_id] = Draft(message_id, conversation_id)
+    task = asyncio.get_running_loop().create_task(draft.run(deltas))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return draft
+
+
+async def stop(timeout: float = 0) -> None:
+    """Give running generations `timeout` seconds, then cancel them; their drafts are finalized as failed."""
+    if _tasks and timeout > 0:
+        await asyncio.wait(list(_tasks), timeout=timeout)
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+async def open_exchange(user: dict, conversation_id: Optional[int], model_key: str, messages: List[Tuple[str, str]], persona: str = "general") -> Tuple[int, int]:
+    """Store the new turn and an assistant draft; returns (conversation_id, message_id).
+
+    A new conversation stores every message the client sent; an existing
+    one only the last, since the earlier turns are already stored.
+    """
+    new = conversation_id is None
+    if new:
+        conversation_id = await store.run(db_models.create_conversation, user["id"], model_key, persona)
+    else:
+        conversation = await store.run(db_models.get_conversation, conversation_id)
+        if conversation is None or conversation["user_id"] != user["id"]:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+        if conversation["archived"]:
+            await store.run(archive.restore, conversation_id)
+        messages = messages[-1:]
+    message_id = await store.run(db_models.start_exchange, conversation_id, messages, model_key)
+    if new:
+        titles.schedule(conversation_id)
+    return conversation_id, message_id
+
+
+def event_id(message_id: int, offset: int) -> str:
+    return f"{message_id}:{offset}"
+
+
+def parse_event_id(value: Optional[str], message_id: int) -> int:
+    """Character offset a `Last-Event-ID` for `message_id` points at (0 if none)."""
+    if not value:
+        return 0
+    try:
+        message, offset = value.split(":")
+        return int(offset) if int(message) == message_id else 0
+    except ValueError:
+        return 0
+
+
+async def resume(message_id: int, offset: int) -> AsyncGenerator[str, None]:
+    """Deltas of a stored or still generating message from `offset` on."""
+    draft = active.get(message_id)
+    if draft is not None:
+        async for delta in draft.follow(offset):
+            yield delta
+        return
+    # Drafts are finalized before they leave `active`, so a draft row here
+    # is being generated by another worker (or was, by one that died).
+    message = await store.run(db_models.get_message, message_id)
+    idle = 0.0
+    while True:
+        if offset < len(message["content"]):
+            yield message["content"][offset:]
+            offset = len(message["content"])
+            idle = 0.0
+        if message["status"] != "draft" or idle >= DRAFT_STALE_SECONDS:
+            break
+        await asyncio.sleep(DRAFT_CHECKPOINT_SECONDS)
+        idle += DRAFT_CHECKPOINT_SECONDS
+        message = await store.run(db_models.get_message, message_id)
+    if message["status"] != "complete":
+        raise RuntimeError("generation was interrupted")
+
+
+def headers(conversation_id: int, message_id: int) -> Dict[str, str]:
+    return {"X-Conversation-Id": str(conversation_id), "X-Message-Id": str(message_id)}
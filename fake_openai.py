@@ -0,0 +1,149 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Used by bench.py to exercise the upstream paths without network access or
+API spend.  Behaviour is controlled with environment variables so the
+harness can start it as a plain uvicorn process:
+
+    FAKE_TTFT        seconds before the first token (default 0.05)
+    FAKE_TPS         tokens per second after the first one (default 200)
+    FAKE_TOKENS      tokens per completion (default 50)
+    FAKE_ERROR_RATE  fraction of requests answered with HTTP 500 (default 0)
+
+FAKE_MODEL_TTFT and FAKE_MODEL_ERROR_RATE override the two settings per
+upstream model, e.g. FAKE_MODEL_TTFT="gpt-4o=8,gpt-4o-mini=0.1", to stand
+in for a slow or failing model.
+
+`GET /stats` reports how many completions were requested, in total and
+per model, which lets a benchmark verify how many upstream calls a
+workload really cost.  `POST /hold` makes new completions wait before
+their first token until `POST /release`, so a benchmark can get every
+client in before the answer starts.
+"""
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import asyncio
+import json
+import os
+import random
+import time
+
+FAKE_TTFT = float(os.getenv("FAKE_TTFT", 0.05))
+FAKE_TPS = float(os.getenv("FAKE_TPS", 200))
+FAKE_TOKENS = int(os.getenv("FAKE_TOKENS", 50))
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", 0))
+
+
+def _per_model(name: str) -> dict:
+    pairs = [item.split("=") for item in os.getenv(name, "").split(",") if "=" in item]
+    return {model.strip(): float(value) for model, value in pairs}
+
+
+FAKE_MODEL_TTFT = _per_model("FAKE_MODEL_TTFT")
+FAKE_MODEL_ERROR_RATE = _per_model("FAKE_MODEL_ERROR_RATE")
+
+WORDS = ["rope", "barrel", "bronc", "buckle", "arena", "saddle", "header", "heeler", "chute", "spur"]
+
+app = FastAPI(title="Fake OpenAI")
+stats = {"completions": 0, "streams": 0, "errors": 0, "by_model": {}}
+gate = asyncio.Event()
+gate.set()
+
+
+def _chunk(model: str, delta: dict, finish_reason=None) -> str:
+    body = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    return f"data: {json.dumps(body)}\n\n"
+
+
+def _usage(messages: list) -> dict:
+    prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": FAKE_TOKENS, "total_tokens": prompt_tokens + FAKE_TOKENS}
+
+
+@app.post("/v1/chat/completions")
+async def completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "gpt-4o-mini")
+    ttft = FAKE_MODEL_TTFT.get(model, FAKE_TTFT)
+    stats["completions"] += 1
+    stats["by_model"][model] = stats["by_model"].get(model, 0) + 1
+    if random.random() < FAKE_MODEL_ERROR_RATE.get(model, FAKE_ERROR_RATE):
+        stats["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "injected failure", "type": "server_error"}})
+
+    if not body.get("stream"):
+        await gate.wait()
+        await asyncio.sleep(ttft + FAKE_TOKENS / FAKE_TPS)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(random.choices(WORDS, k=FAKE_TOKENS))},
+                "finish_reason": "stop"
+            }],
+            "usage": _usage(body.get("messages", []))
+        }
+
+    stats["streams"] += 1
+
+    async def generate():
+        await gate.wait()
+        await asyncio.sleep(ttft)
+        yield _chunk(model, {"role": "assistant", "content": ""})
+        for i in range(FAKE_TOKENS):
+            if i:
+                await asyncio.sleep(1 / FAKE_TPS)
+            yield _chunk(model, {"content": random.choice(WORDS) + " "})
+        yield _chunk(model, {}, "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": _usage(body.get("messages", []))
+            }
+            yield f"data: {json.dumps(usage_chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    for key in stats:
+        stats[key] = {} if key == "by_model" else 0
+    return stats
+
+
+@app.post("/hold")
+async def hold():
+    gate.clear()
+    return {"held": True}
+
+
+@app.post("/release")
+async def release():
+    gate.set()
+    return {"held": False}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("PORT", 8001)))
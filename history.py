@@ -0,0 +1,91 @@
+"""
+Conversation and message history for the signed-in user.
+
+Pages are cursor based: a page carries the cursor of its last row and the
+next query continues from it through the composite indexes added by
+migrations.py, so every page costs the same no matter how deep it is
+(OFFSET would re-read every earlier row).  Message pages return a short
+preview of each body; the full text is fetched per message.
+"""
+
+import base64
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+import db_models
+import store
+from auth import get_current_user
+
+router = APIRouter(prefix="/api/history", tags=["history"])
+
+
+def encode_cursor(conversation: dict) -> str:
+    raw = json.dumps([conversation["updated_at"], conversation["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(updated_at), int(conversation_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def owned_conversation(conversation_id: int, user: dict) -> dict:
+    conversation = await store.run(db_models.get_conversation, conversation_id)
+    if conversation is None or conversation["user_id"] != user["id"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+    return conversation
+
+
+@router.get("/conversations")
+async def list_conversations(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Conversations, most recently updated first; pass `next_cursor` back for the next page."""
+    before = decode_cursor(cursor) if cursor else None
+    conversations = await store.run(db_models.list_conversations, current_user["id"], limit, before)
+    return {
+        "conversations": conversations,
+        "next_cursor": encode_cursor(conversations[-1]) if len(conversations) == limit else None
+    }
+
+
+@router.get("/conversations/{conversation_id}/messages")
+async def list_messages(
+    conversation_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    bodies: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Messages in chronological order, newest page first.
+
+    `before` (the `next_before` of a page) scrolls back, `after` pages
+    forward.  Bodies are cut to a preview unless `bodies=true`.
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either before or after")
+    await owned_conversation(conversation_id, current_user)
+    messages = await store.run(db_models.list_messages, conversation_id, limit, before, after, bodies)
+    full = len(messages) == limit
+    return {
+        "messages": messages,
+        "next_before": messages[0]["id"] if full and after is None else None,
+        "next_after": messages[-1]["id"] if full and after is not None else None
+    }
+
+
+@router.get("/messages/{message_id}")
+async def get_message(message_id: int, current_user: dict = Depends(get_current_user)):
+    message = await store.run(db_models.get_message, message_id)
+    if message is None or message["user_id"] != current_user["id"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+    return message
@@ -0,0 +1,263 @@
+"""
+Background jobs, persisted in SQLite so they survive restarts.
+
+Work that must not hold up a chat response (conversation titles, rolling
+summaries) is queued as a job: a row in the `jobs` table with a kind, a
+JSON payload, a priority (lower runs first) and the earliest time it may
+run.  `defer` queues one from the event loop without even waiting for the
+INSERT; `enqueue` is the blocking version.
+
+Every process runs `JOB_WORKERS` workers for the kinds it has registered.
+A worker claims the most urgent due job together with more jobs of the
+same kind, up to the kind's `batch_size`, so one handler call can serve
+many of them (titles.py names a batch of conversations with one Scamper
+call).  Jobs that only fall due within the kind's `linger` seconds join
+the batch early.  Claims are conditional UPDATEs, so workers of different
+processes never run a job twice.
+
+* Jobs queued with the same kind and `key` collapse into one until it
+  starts, keeping the newest payload; a job does not start while another
+  with its key is running, and one that would go back to the queue gives
+  way to a queued job with its key.
+* A failed batch is retried after `JOB_RETRY_DELAY` * 2^(attempts - 1)
+  seconds (jittered), and marked 'failed' after `JOB_MAX_ATTEMPTS`
+  attempts.  Failed jobs stay in the table for inspection; finished ones
+  are deleted.
+* A handler may run for `JOB_TIMEOUT` seconds.  Jobs still 'running' after
+  that were left by a worker that died and are queued again.
+
+Queue depth per kind and state, and how long the oldest due job has
+waited, are in the health check (`stats`); wait and run times per kind are
+in /metrics.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+import store
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 5))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", 300))
+# How often queue depth is counted and abandoned jobs are recovered
+JOB_STATS_INTERVAL = 5
+
+# Rows a queued job with the same key replaces when they would go back to the queue
+SUPERSEDED = ("dedup_key IS NOT NULL AND EXISTS (SELECT 1 FROM jobs AS queued "
+              "WHERE queued.kind = jobs.kind AND queued.dedup_key = jobs.dedup_key AND queued.state = 'queued')")
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[List[dict]], Awaitable[None]]
+
+
+class Kind:
+    def __init__(self, handler: Handler, batch_size: int, priority: int, linger: float):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.priority = priority
+        self.linger = linger
+
+
+_kinds: Dict[str, Kind] = {}
+_tasks: List[asyncio.Task] = []
+_deferred: Set[asyncio.Task] = set()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_wake: Optional[asyncio.Event] = None
+_depth: Dict[str, Dict[str, int]] = {}
+_oldest_due: Optional[float] = None
+completed = 0
+retried = 0
+failed = 0
+
+
+def register(kind: str, handler: Handler, batch_size: int = 1, priority: int = 0, linger: float = 0) -> None:
+    """Run `kind` jobs with `await handler(payloads)`, up to `batch_size` payloads per call."""
+    _kinds[kind] = Kind(handler, batch_size, priority, linger)
+
+
+def enqueue(kind: str, payload: dict, key: Optional[str] = None, priority: Optional[int] = None, delay: float = 0) -> None:
+    """Queue a job, or replace the payload of the queued `kind` job with the same `key`."""
+    if priority is None:
+        priority = _kinds[kind].priority if kind in _kinds else 0
+    now = time.time()
+    with store.connection() as conn:
+        conn.execute(
+            "INSERT INTO jobs (kind, dedup_key, payload, priority, run_after, created) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (kind, dedup_key) WHERE state = 'queued' "
+            "DO UPDATE SET payload = excluded.payload, priority = min(priority, excluded.priority)",
+            (kind, key, json.dumps(payload), priority, now + delay, now)
+        )
+    if delay <= 0 and _wake is not None:
+        _loop.call_soon_threadsafe(_wake.set)
+
+
+def defer(kind: str, payload: dict, key: Optional[str] = None, priority: Optional[int] = None, delay: float = 0) -> None:
+    """`enqueue` in the background; the caller does not wait for the write, and a failure is logged."""
+    async def run():
+        try:
+            await store.run(enqueue, kind, payload, key, priority, delay)
+        except Exception:
+            logger.exception("could not queue a %s job", kind)
+
+    task = asyncio.get_running_loop().create_task(run())
+    _deferred.add(task)
+    task.add_done_callback(_deferred.discard)
+
+
+def _claim() -> Tuple[Optional[str], list]:
+    """Mark the most urgent due job and more of its kind as running; returns the kind and their rows."""
+    now = time.time()
+    kinds = list(_kinds)
+    with store.connection() as conn:
+        top = conn.execute(
+            f"SELECT kind FROM jobs WHERE state = 'queued' AND run_after <= ? AND kind IN ({','.join('?' * len(kinds))}) "
+            "ORDER BY priority, run_after, id LIMIT 1",
+            [now] + kinds
+        ).fetchone()
+        if top is None:
+            return None, []
+        kind = _kinds[top["kind"]]
+        rows = conn.execute(
+            "UPDATE jobs SET state = 'running', attempts = attempts + 1, started = ? WHERE id IN ("
+            "  SELECT id FROM jobs AS queued WHERE kind = ? AND state = 'queued' AND run_after <= ? AND NOT EXISTS ("
+            "    SELECT 1 FROM jobs AS running WHERE running.kind = queued.kind AND running.dedup_key = queued.dedup_key AND running.state = 'running')"
+            "  ORDER BY priority, run_after, id LIMIT ?"
+            ") RETURNING id, payload, attempts, run_after",
+            (now, top["kind"], now + kind.linger, kind.batch_size)
+        ).fetchall()
+    return top["kind"], rows
+
+
+def _finish(rows: list, error: Optional[str]) -> None:
+    global completed, retried, failed
+    ids = [row["id"] for row in rows]
+    with store.connection() as conn:
+        if error is None:
+            conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(ids))})", ids)
+            completed += len(ids)
+            return
+        conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(ids))}) AND {SUPERSEDED}", ids)
+        now = time.time()
+        updates = []
+        for row in rows:
+            if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                updates.append(("failed", now, error, row["id"]))
+                failed += 1
+            else:
+                backoff = JOB_RETRY_DELAY * 2 ** (row["attempts"] - 1)
+                updates.append(("queued", now + backoff * random.uniform(0.8, 1.2), error, row["id"]))
+                retried += 1
+        conn.executemany("UPDATE jobs SET state = ?, run_after = ?, error = ? WHERE id = ?", updates)
+
+
+def _requeue(rows: list) -> None:
+    """Give back jobs that were claimed but not run to the end, without counting the attempt."""
+    ids = [row["id"] for row in rows]
+    with store.connection() as conn:
+        conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(ids))}) AND {SUPERSEDED}", ids)
+        conn.execute(f"UPDATE jobs SET state = 'queued', attempts = attempts - 1 WHERE id IN ({','.join('?' * len(ids))}) AND state = 'running'", ids)
+
+
+def _survey() -> Tuple[Dict[str, Dict[str, int]], Optional[float]]:
+    """Queue abandoned jobs again, then count jobs per kind and state."""
+    now = time.time()
+    with store.connection() as conn:
+        conn.execute(f"DELETE FROM jobs WHERE state = 'running' AND started < ? AND {SUPERSEDED}", (now - JOB_TIMEOUT,))
+        conn.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running' AND started < ?", (now - JOB_TIMEOUT,))
+        rows = conn.execute(
+            "SELECT kind, state, count(*) AS jobs, min(CASE WHEN state = 'queued' AND run_after <= ? THEN run_after END) AS due "
+            "FROM jobs GROUP BY kind, state",
+            (now,)
+        ).fetchall()
+    depth: Dict[str, Dict[str, int]] = {}
+    for row in rows:
+        depth.setdefault(row["kind"], {})[row["state"]] = row["jobs"]
+    due = [row["due"] for row in rows if row["due"] is not None]
+    return depth, min(due) if due else None
+
+
+async def _run(kind: str, rows: list) -> None:
+    started = time.time()
+    for row in rows:
+        metrics.JOB_WAIT.observe(max(0.0, started - row["run_after"]), kind=kind)
+    try:
+        with metrics.JOB_RUN.time(kind=kind):
+            await asyncio.wait_for(_kinds[kind].handler([json.loads(row["payload"]) for row in rows]), JOB_TIMEOUT)
+        error = None
+    except asyncio.CancelledError:
+        await store.run(_requeue, rows)
+        raise
+    except Exception as e:
+        logger.warning("%d %s job(s) failed: %r", len(rows), kind, e)
+        error = f"{type(e).__name__}: {e}"
+    await store.run(_finish, rows, error)
+
+
+async def _work() -> None:
+    while True:
+        _wake.clear()
+        try:
+            kind, rows = await store.run(_claim)
+        except Exception:
+            logger.exception("claiming jobs failed")
+            kind, rows = None, []
+        if rows:
+            await _run(kind, rows)
+            continue
+        try:
+            await asyncio.wait_for(_wake.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _monitor() -> None:
+    global _depth, _oldest_due
+    while True:
+        try:
+            _depth, _oldest_due = await store.run(_survey)
+        except Exception:
+            logger.exception("surveying the job queue failed")
+        await asyncio.sleep(JOB_STATS_INTERVAL)
+
+
+async def start() -> None:
+    global _loop, _wake
+    if _tasks or not _kinds or JOB_WORKERS <= 0:
+        return
+    _loop = asyncio.get_running_loop()
+    _wake = asyncio.Event()
+    _tasks.append(_loop.create_task(_monitor()))
+    _tasks.extend(_loop.create_task(_work()) for _ in range(JOB_WORKERS))
+
+
+async def stop() -> None:
+    """Finish queueing deferred jobs, then stop the workers; jobs they were running are queued again."""
+    global _wake
+    if _deferred:
+        await asyncio.gather(*_deferred, return_exceptions=True)
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _wake = None
+
+
+def stats() -> dict:
+    return {
+        "workers": max(0, len(_tasks) - 1),
+        "kinds": sorted(_kinds),
+        "depth": _depth,
+        "oldest_due_s": round(time.time() - _oldest_due, 1) if _oldest_due is not None else None,
+        "completed": completed,
+        "retried": retried,
+        "failed": failed,
+    }
@@ -1,18 +1,84 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List, AsyncGenerator
+from typing import List, AsyncGenerator, Optional, Tuple
+import asyncio
+import logging
 import os
-import json
-from openai import OpenAI
+import time
+import archive
+import batch
+import cache
+import columnar
+import context
+import db_models
+import drafts
+import jobs
+import metrics
+import prompts
+import serve
+import shared
+import sse
+import store
+import upstream
+from context import conversation_context, message_tokens
+from analytics import router as analytics_router, writer as analytics_writer
+from auth import get_current_user, get_optional_user, router as auth_router
+from columnar import router as columnar_router
+from history import router as history_router
+from search import router as search_router
+from config import MODEL_REGISTRY
+from db_models import log_usage
+from metering import ledger
+from prompts import Prompt
+from quota import calculate_cost, check_batch_quota, check_persona_access, check_quota
+from routing import model_router
+from response_cache import make_key, replay, response_cache
+from scheduler import Ticket, identity, scheduler
+from singleflight import singleflight
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 PORT = int(os.environ.get("PORT", 3001))
+# build the upstream client and load the tokenizer in the background while the app starts
+STARTUP_PRELOAD = os.environ.get("STARTUP_PRELOAD", "1") == "1"
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="RodeoAI API")
+def preload() -> None:
+    try:
+        upstream.preload()
+        context.preload()
+    except Exception:
+        logger.exception("preload failed; modules load on first use instead")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start-up work, kept out of module imports so a cold start only pays for what it uses."""
+    await store.run(store.prepare)
+    # warm-up runs in the background: requests are served right away and only wait for what they use
+    store.offload(store.warm)
+    if STARTUP_PRELOAD:
+        asyncio.get_running_loop().run_in_executor(None, preload)
+    await shared.start()
+    ledger.start()
+    await analytics_writer.start()
+    await metrics.start_lag_monitor()
+    await columnar.start_compaction()
+    await jobs.start()
+    archive.schedule()
+    yield
+    await drafts.stop(serve.drain_remaining())
+    await jobs.stop()
+    await columnar.stop_compaction()
+    await metrics.stop_lag_monitor()
+    await analytics_writer.stop()
+    await ledger.stop()
+    await upstream.close()
+    await shared.stop()
+
+app = FastAPI(title="RodeoAI API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,35 +88,15 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
-RODEO_MODELS = {
-    "scamper": {
-        "name": "Scamper",
-        "model": "gpt-4o-mini",
-        "description": "Lightning-fast answers",
-        "emoji": "⚡",
-        "system_prompt": "You are Scamper, a lightning-fast rodeo assistant. Provide quick, concise answers.",
-        "temperature": 0.7,
-        "max_tokens": 500
-    },
-    "gold-buckle": {
-        "name": "Gold Buckle",
-        "model": "gpt-4o",
-        "description": "Your champion companion",
-        "emoji": "🏆",
-        "system_prompt": "You are Gold Buckle, a balanced rodeo expert. Provide comprehensive answers.",
-        "temperature": 0.8,
-        "max_tokens": 1500
-    },
-    "bodacious": {
-        "name": "Bodacious",
-        "model": "gpt-4o",
-        "description": "Unstoppable intelligence",
-        "emoji": "🐂",
-        "system_prompt": "You are Bodacious, the most powerful rodeo assistant. Provide deep analysis.",
-        "temperature": 0.9,
-        "max_tokens": 2500
-    }
-}
+app.include_router(auth_router)
+app.include_router(analytics_router)
+app.include_router(columnar_router)
+app.include_router(history_router)
+app.include_router(search_router)
+app.include_router(metrics.router)
+app.add_middleware(metrics.ArrivalMiddleware)
+
+RODEO_MODELS = MODEL_REGISTRY
 
 class ChatMessage(BaseModel):
     role: str
@@ -60,14 +106,89 @@ class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     model: str = "gold-buckle"
     stream: bool = True
+    conversation_id: Optional[int] = None
+    persona: str = "general"
+    queue_events: bool = False
+
+class BatchItem(BaseModel):
+    messages: List[ChatMessage]
+    model: str = "gold-buckle"
+    persona: str = "general"
+
+class BatchChatRequest(BaseModel):
+    requests: List[BatchItem]
+    parallelism: int = batch.BATCH_PARALLELISM
+
+def record_usage(user: dict, model_key: str, usage: dict, conversation_id: Optional[int] = None) -> None:
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    log_usage(user["id"], conversation_id, model_key, prompt_tokens, completion_tokens, calculate_cost(model_key, prompt_tokens, completion_tokens))
+
+def coalesced_completion(cache_key: str, model_key: str, full_messages: List[dict], user: Optional[dict], conversation_id: Optional[int] = None, ticket: Optional[Ticket] = None) -> AsyncGenerator[str, None]:
+    """Stream deltas through the single-flight layer.
+
+    Only the request that starts the upstream call is charged for it and
+    stores the answer in the response cache; identical requests that join
+    the flight are treated like cache hits.  An answer the router got from
+    a fallback model is not cached, so the degraded answer is not replayed
+    under `model_key`.  The upstream call holds the scheduler slot of
+    `ticket` until it ends.
+    """
+    def fetch(usage: dict):
+        deltas = model_router.stream(model_key, full_messages, usage)
+        return ticket.hold(deltas) if ticket is not None else deltas
+
+    async def on_complete(content: str, usage: dict) -> None:
+        if user is not None:
+            record_usage(user, usage.get("model_key", model_key), usage, conversation_id)
+        if usage.get("model_key", model_key) == model_key:
+            await response_cache.set(cache_key, content, usage)
+
+    return singleflight.stream(cache_key, fetch, on_complete)
+
+async def scheduled_completion(ticket: Ticket, cache_key: str, model_key: str, full_messages: List[dict], user: Optional[dict], conversation_id: Optional[int] = None) -> AsyncGenerator[str, None]:
+    """coalesced_completion once `ticket` holds a slot; joining a running flight needs none."""
+    ticket.claimed = True
+    try:
+        if cache_key not in singleflight.flights:
+            await ticket.wait()
+    except BaseException:
+        ticket.release()
+        raise
+    if cache_key in singleflight.flights:
+        ticket.release()
+        ticket = None
+    async for delta in coalesced_completion(cache_key, model_key, full_messages, user, conversation_id, ticket):
+        yield delta
 
 @app.get("/")
 async def health_check():
-    return {
-        "status": "healthy",
+    health = {
+        "status": "draining" if serve.draining else "healthy",
         "service": "RodeoAI Backend",
         "models": list(RODEO_MODELS.keys()),
-        "openai_configured": OPENAI_API_KEY is not None
+        "openai_configured": OPENAI_API_KEY is not None,
+        "caches": cache.stats(),
+        "usage": ledger.stats(),
+        "response_cache": response_cache.stats(),
+        "singleflight": singleflight.stats(),
+        "analytics": analytics_writer.stats(),
+        "router": model_router.stats(),
+        "scheduler": scheduler.stats(),
+        "jobs": jobs.stats(),
+        "archive": archive.stats(),
+        "shared": shared.stats()
+    }
+    # a draining worker no longer accepts connections; tell load balancers too
+    return JSONResponse(health, status_code=503) if serve.draining else health
+
+@app.get("/api/personas")
+async def get_personas():
+    return {
+        "personas": [
+            {"id": key, "name": value["name"], "description": value["description"]}
+            for key, value in prompts.PERSONAS.items()
+        ]
     }
 
 @app.get("/api/models")
@@ -84,65 +205,199 @@ async def get_models():
         ]
     }
 
-async def generate_stream(messages: List[ChatMessage], model_config: dict) -> AsyncGenerator[str, None]:
+async def answer(full_messages: List[dict], prompt: Prompt, model_key: str, user: Optional[dict], conversation_id: Optional[int] = None, ticket: Optional[Ticket] = None, paced: bool = True) -> Tuple[AsyncGenerator[str, None], str]:
+    """Deltas answering `full_messages`, and where they come from ("cache" or "upstream").
+
+    Takes over `ticket`: a cache hit gives it back, an upstream answer waits for its slot.
+    A cache hit is replayed at streaming pace unless `paced` is off (the whole answer is awaited anyway).
+    """
     try:
-        full_messages = [
-            {"role": "system", "content": model_config["system_prompt"]}
-        ] + [{"role": msg.role, "content": msg.content} for msg in messages]
-        
-        stream = client.chat.completions.create(
-            model=model_config["model"],
-            messages=full_messages,
-            temperature=model_config["temperature"],
-            max_tokens=model_config["max_tokens"],
-            stream=True
-        )
-        
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield f"data: {json.dumps({'content': chunk.choices[0].delta.content})}\n\n"
+        cache_key = make_key(model_key, prompt.fingerprint, full_messages[1:])
+        cached = await response_cache.get(model_key, cache_key)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+    if cached is not None:
+        if ticket is not None:
+            ticket.release()
+        return (replay(cached["content"]) if paced else replay(cached["content"], 0)), "cache"
+    if ticket is not None:
+        return scheduled_completion(ticket, cache_key, model_key, full_messages, user, conversation_id), "upstream"
+    return coalesced_completion(cache_key, model_key, full_messages, user, conversation_id), "upstream"
+
+async def stream_frames(deltas: AsyncGenerator[str, None], timer: metrics.StreamTimer, message_id: Optional[int] = None, offset: int = 0, ticket: Optional[Ticket] = None) -> AsyncGenerator[bytes, None]:
+    """SSE frames for `deltas`; frames of a stored message carry resumable event ids.
+
+    With `ticket`, the queue position is reported until the answer gets its upstream slot.
+    """
+    try:
+        if ticket is not None:
+            async for position in ticket.positions(sse.SSE_HEARTBEAT):
+                yield sse.queued_frame(position)
+        async for content in sse.coalesce(timer.track(deltas)):
+            if content is None:
+                yield sse.HEARTBEAT_FRAME
+                continue
+            offset += len(content)
+            yield sse.content_frame(content, drafts.event_id(message_id, offset) if message_id else None)
         
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        timer.finish()
+        yield sse.DONE_FRAME
         
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield sse.error_frame(str(e))
+
+async def generate_stream(messages: List[ChatMessage], prompt: Prompt, model_key: str, user: Optional[dict] = None, received_at: Optional[float] = None, requester: Tuple[str, str] = ("free", ""), queue_events: bool = False) -> AsyncGenerator[bytes, None]:
+    try:
+        full_messages = prompt.assemble(messages)
+        # queued here rather than in the endpoint, so a response that is never sent holds no place
+        ticket = scheduler.admit(requester[0], model_key, requester[1])
+        deltas, source = await answer(full_messages, prompt, model_key, user, ticket=ticket)
+    except HTTPException as e:
+        yield sse.error_frame(e.detail)
+        return
+    except Exception as e:
+        yield sse.error_frame(str(e))
+        return
+    
+    try:
+        async for frame in stream_frames(deltas, metrics.StreamTimer(model_key, received_at or time.perf_counter(), source), ticket=ticket if queue_events else None):
+            yield frame
+    finally:
+        if ticket is not None:
+            ticket.abandon()
+
+async def start_persisted(request: ChatRequest, prompt: Prompt, user: dict, ticket: Optional[Ticket]) -> Tuple[drafts.Draft, str]:
+    """Store the turn, then generate the answer into a draft message in the background."""
+    try:
+        with metrics.STAGE.time(model=request.model, stage="persist"):
+            conversation_id, message_id = await drafts.open_exchange(user, request.conversation_id, request.model, [(msg.role, msg.content) for msg in request.messages], request.persona)
+            history = await conversation_context(conversation_id, request.model, prompt.text)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+    deltas, source = await answer(prompt.build(history), prompt, request.model, user, conversation_id, ticket, paced=request.stream)
+    return drafts.start(message_id, conversation_id, deltas), source
 
 @app.post("/api/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request, current_user: Optional[dict] = Depends(get_optional_user)):
     if request.model not in RODEO_MODELS:
         raise HTTPException(status_code=400, detail="Invalid model")
+    metrics.observe_request(http_request, request.model)
+    prompt = prompts.get(request.model, request.persona)
+    if current_user is not None:
+        with metrics.STAGE.time(model=request.model, stage="quota"):
+            await store.run(check_quota, current_user, request.model)
+    check_persona_access(current_user or {}, request.persona)
+    requester = identity(current_user, http_request.client.host if http_request.client else None)
     
-    model_config = RODEO_MODELS[request.model]
+    received_at = metrics.received_at(http_request)
+    accept_encoding = http_request.headers.get("accept-encoding", "")
+    
+    if current_user is not None:
+        ticket = scheduler.admit(requester[0], request.model, requester[1])
+        draft, source = await start_persisted(request, prompt, current_user, ticket)
+        timer = metrics.StreamTimer(request.model, received_at, source)
+        if request.stream:
+            return sse.event_stream(
+                stream_frames(draft.follow(), timer, draft.message_id, ticket=ticket if request.queue_events else None),
+                accept_encoding,
+                drafts.headers(draft.conversation_id, draft.message_id)
+            )
+        try:
+            content = "".join([delta async for delta in timer.track(draft.follow())])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        timer.finish()
+        return {
+            "content": content,
+            "model": request.model,
+            "conversation_id": draft.conversation_id,
+            "message_id": draft.message_id
+        }
     
     if request.stream:
-        return StreamingResponse(
-            generate_stream(request.messages, model_config),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive"
-            }
+        scheduler.check(requester[0], request.model, requester[1])
+        return sse.event_stream(
+            generate_stream(request.messages, prompt, request.model, current_user, received_at, requester, request.queue_events),
+            accept_encoding
         )
     else:
+        ticket = scheduler.admit(requester[0], request.model, requester[1])
         try:
-            full_messages = [
-                {"role": "system", "content": model_config["system_prompt"]}
-            ] + [{"role": msg.role, "content": msg.content} for msg in request.messages]
-            
-            response = client.chat.completions.create(
-                model=model_config["model"],
-                messages=full_messages,
-                temperature=model_config["temperature"],
-                max_tokens=model_config["max_tokens"]
-            )
+            full_messages = prompt.assemble(request.messages)
+            deltas, source = await answer(full_messages, prompt, request.model, current_user, ticket=ticket, paced=False)
+            timer = metrics.StreamTimer(request.model, received_at, source)
+            content = "".join([delta async for delta in timer.track(deltas)])
+            timer.finish()
             
             return {
-                "content": response.choices[0].message.content,
+                "content": content,
                 "model": request.model
             }
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            if ticket is not None:
+                ticket.abandon()
+
+@app.post("/api/chat/batch")
+async def chat_batch(request: BatchChatRequest, http_request: Request, current_user: Optional[dict] = Depends(get_optional_user)):
+    """Answer independent prompts concurrently, streaming each result as it finishes (see batch.py).
+
+    Batch items are not stored as conversations.  Models, personas and the
+    quota are checked once for the whole batch, before anything runs.
+    """
+    items = request.requests
+    if not items:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(items) > batch.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {batch.BATCH_MAX_ITEMS} requests per batch")
+    if any(item.model not in RODEO_MODELS for item in items):
+        raise HTTPException(status_code=400, detail="Invalid model")
+    for persona in {item.persona for item in items}:
+        check_persona_access(current_user or {}, persona)
+    item_prompts = [prompts.get(item.model, item.persona) for item in items]
+    full_messages = [prompt.assemble(item.messages) for prompt, item in zip(item_prompts, items)]
+    headers = {}
+    if current_user is not None:
+        prompt_tokens = {}
+        for item, messages in zip(items, full_messages):
+            prompt_tokens[item.model] = prompt_tokens.get(item.model, 0) + sum(message_tokens(m["content"]) for m in messages)
+        headers["X-Batch-Prompt-Cost"] = str(await store.run(check_batch_quota, current_user, prompt_tokens))
+    requester = identity(current_user, http_request.client.host if http_request.client else None)
+    received_at = metrics.received_at(http_request)
+
+    async def run_item(index: int) -> dict:
+        item = items[index]
+        ticket = scheduler.admit(requester[0], item.model, requester[1])
+        try:
+            deltas, source = await answer(full_messages[index], item_prompts[index], item.model, current_user, ticket=ticket, paced=False)
+            timer = metrics.StreamTimer(item.model, received_at, source)
+            content = "".join([delta async for delta in timer.track(deltas)])
+            timer.finish()
+        finally:
+            if ticket is not None:
+                ticket.abandon()
+        return {"model": item.model, "content": content, "source": source}
+
+    return batch.stream(len(items), run_item, request.parallelism, http_request.headers.get("accept", ""),
+                        http_request.headers.get("accept-encoding", ""), headers)
+
+@app.get("/api/chat/messages/{message_id}/stream")
+async def resume_chat(message_id: int, http_request: Request, last_event_id: Optional[str] = Header(None), current_user: dict = Depends(get_current_user)):
+    """Continue a stored answer after a disconnect, from `Last-Event-ID` on."""
+    message = await store.run(db_models.get_message, message_id)
+    if message is None or message["user_id"] != current_user["id"] or message["role"] != "assistant":
+        raise HTTPException(status_code=404, detail="Message not found")
+    offset = drafts.parse_event_id(last_event_id, message_id)
+    return sse.event_stream(
+        stream_frames(drafts.resume(message_id, offset), metrics.StreamTimer(message["model"] or "", metrics.received_at(http_request), "resume"), message_id, offset),
+        http_request.headers.get("accept-encoding", ""),
+        drafts.headers(message["conversation_id"], message_id)
+    )
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    serve.run("main:app", host="0.0.0.0", port=PORT)
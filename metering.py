@@ -0,0 +1,246 @@
+"""
+In-memory usage accounting with write-behind flushing.
+
+The ledger keeps each user's token usage for the current UTC day, in total
+and per model, and is the authority for quota admission (the limits are
+quota.TIER_LIMITS' `daily_limit` and `model_limits`).  A user's total is
+seeded once from the `daily_usage`/`last_reset` columns of the row that
+authentication already loaded, and rolls over at midnight UTC without
+touching the database.  The per-model counters start at zero when a
+process first sees the user; they bound one model's share of a day whose
+total is still enforced, and with shared state they outlive a worker.
+
+Completions are recorded in memory and written out in batches: pending
+`usage_logs` rows are inserted with one executemany and each user's totals
+are added with one UPDATE per user and day, either every
+`USAGE_FLUSH_INTERVAL` seconds or as soon as `USAGE_FLUSH_SIZE` rows are
+pending.
+
+When several workers serve the API (shared.enabled), each worker only
+sees its own completions, so admission reads the day's totals from shared
+counters instead (a blocking read: callers on the event loop use
+store.run).  Recorded usage is added to the shared counters off the loop
+(store.offload); until then it is counted from this worker's pending
+deltas.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import shared
+import store
+from cache import user_cache
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 5))
+USAGE_FLUSH_SIZE = int(os.getenv("USAGE_FLUSH_SIZE", 500))
+
+logger = logging.getLogger(__name__)
+
+
+def _today() -> str:
+    return datetime.utcnow().date().isoformat()
+
+
+def _expiry(day: str) -> float:
+    """When the shared counters of `day` can go: a day after it ends."""
+    return datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp() + timedelta(days=2).total_seconds()
+
+
+class UsageLedger:
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL, flush_size: int = USAGE_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.flushed_rows = 0
+        self._accounts: Dict[int, dict] = {}
+        self._swept = _today()
+        self._pending_rows: List[tuple] = []
+        self._pending_totals: Dict[Tuple[int, str], int] = {}
+        self._pending_seeds: List[Tuple[str, int, float]] = []
+        self._pending_shared: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._push_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _account(self, user_id: int, seed: Optional[dict] = None) -> Optional[dict]:
+        today = _today()
+        account = self._accounts.get(user_id)
+        if account is None:
+            if seed is None:
+                return None
+            seeded_day = (seed.get("last_reset") or "")[:10]
+            used = (seed.get("daily_usage") or 0) if seeded_day == today else 0
+            # "base" is the usage the database had, which seeds the shared counter
+            account = self._accounts[user_id] = {"day": today, "used": used, "base": used, "models": {}, "seeded": False}
+        elif account["day"] != today:
+            account.update(day=today, used=0, base=0, models={}, seeded=False)
+        return account
+
+    def _shared_usage(self, user_id: int, account: dict, model: str) -> Tuple[int, int]:
+        """(day total, model total) of `user_id` across all workers; blocking, called without `_lock`."""
+        day = account["day"]
+        keys = (f"usage:{user_id}:{day}", f"usage:{user_id}:{day}:{model}")
+        if not account["seeded"]:
+            shared.seed(keys[0], account["base"], _expiry(day))
+            account["seeded"] = True
+        used, by_model = shared.get(*keys)
+        with self._lock:
+            return used + self._pending_shared.get(keys[0], 0), by_model + self._pending_shared.get(keys[1], 0)
+
+    def usage_today(self, user_id: int, model: Optional[str] = None) -> Optional[int]:
+        """Tokens used today, in total or on `model`, or None if this process has not seen the user."""
+        with self._lock:
+            account = self._account(user_id)
+            if account is None:
+                return None
+            if not shared.enabled:
+                return account["used"] if model is None else account["models"].get(model, 0)
+        used, by_model = self._shared_usage(user_id, account, model or "")
+        return used if model is None else by_model
+
+    def admit(self, user: dict, model: str, daily_limit: int, model_limit: int = -1) -> bool:
+        """Whether `user` may start another `model` completion today (-1 means unlimited)."""
+        with self._lock:
+            account = self._account(user["id"], user)
+            if not shared.enabled:
+                used, by_model = account["used"], account["models"].get(model, 0)
+        if shared.enabled:
+            used, by_model = self._shared_usage(user["id"], account, model)
+        if daily_limit >= 0 and used >= daily_limit:
+            return False
+        if model_limit >= 0 and by_model >= model_limit:
+            return False
+        return True
+
+    def record(self, user_id: int, conversation_id: Optional[int], model: str, prompt_tokens: int, completion_tokens: int, cost: float) -> None:
+        total_tokens = prompt_tokens + completion_tokens
+        with self._lock:
+            account = self._account(user_id)
+            if account is not None:
+                account["used"] += total_tokens
+                account["models"][model] = account["models"].get(model, 0) + total_tokens
+            self._pending_rows.append((user_id, conversation_id, model, prompt_tokens, completion_tokens, total_tokens, cost))
+            key = (user_id, account["day"] if account else _today())
+            self._pending_totals[key] = self._pending_totals.get(key, 0) + total_tokens
+            full = len(self._pending_rows) >= self.flush_size
+            if shared.enabled:
+                if account is not None and not account["seeded"]:
+                    self._pending_seeds.append((f"usage:{user_id}:{key[1]}", account["base"], _expiry(key[1])))
+                    account["seeded"] = True
+                for counter in (f"usage:{user_id}:{key[1]}", f"usage:{user_id}:{key[1]}:{model}"):
+                    self._pending_shared[counter] = self._pending_shared.get(counter, 0) + total_tokens
+        if shared.enabled:
+            store.offload(self.push_shared)
+        if full:
+            if self._task is not None:
+                self._loop.call_soon_threadsafe(self._wake.set)
+            else:
+                self.flush()
+
+    def push_shared(self) -> None:
+        """Add the usage recorded since the last push to the shared counters."""
+        with self._push_lock:
+            with self._lock:
+                seeds, self._pending_seeds = self._pending_seeds, []
+                deltas = dict(self._pending_shared)
+            try:
+                while seeds:
+                    shared.seed(*seeds[0])
+                    seeds.pop(0)
+            finally:
+                if seeds:
+                    with self._lock:
+                        self._pending_seeds[:0] = seeds
+            for counter, amount in deltas.items():
+                shared.add(counter, amount, _expiry(counter.split(":")[2]))
+                # pending until added, so admission never misses it
+                with self._lock:
+                    left = self._pending_shared[counter] - amount
+                    if left:
+                        self._pending_shared[counter] = left
+                    else:
+                        del self._pending_shared[counter]
+
+    def _evict_stale(self) -> None:
+        """Once a day, forget the users not seen since it rolled over; called with `_lock`."""
+        today = _today()
+        if self._swept != today:
+            self._swept = today
+            for user_id in [user_id for user_id, account in self._accounts.items() if account["day"] != today]:
+                del self._accounts[user_id]
+
+    def flush(self) -> int:
+        """Write pending rows and user totals; returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending_rows = self._pending_rows, []
+                totals, self._pending_totals = self._pending_totals, {}
+                updates = [(day, added, added, added, day, user_id) for (user_id, day), added in sorted(totals.items(), key=lambda t: t[0][1])]
+                self._evict_stale()
+            if not rows:
+                return 0
+            try:
+                with store.connection() as conn:
+                    conn.executemany("INSERT INTO usage_logs (user_id, conversation_id, model, prompt_tokens, completion_tokens, total_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                    conn.executemany("UPDATE users SET daily_usage = CASE WHEN substr(last_reset, 1, 10) = ? THEN daily_usage + ? ELSE ? END, total_usage = total_usage + ?, last_reset = ? WHERE id = ?", updates)
+            except Exception:
+                with self._lock:
+                    self._pending_rows[:0] = rows
+                    for key, added in totals.items():
+                        self._pending_totals[key] = self._pending_totals.get(key, 0) + added
+                raise
+            user_cache.invalidate_many({user_id for user_id, _ in totals})
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await store.run(self.flush)
+            except Exception:
+                logger.exception("usage flush failed; will retry")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await store.run(self.flush)
+        except Exception:
+            logger.exception("final usage flush failed; %d rows lost", len(self._pending_rows))
+        if shared.enabled:
+            try:
+                await store.run(self.push_shared)
+            except Exception:
+                logger.exception("could not add the last usage to the shared counters")
+
+    def stats(self) -> dict:
+        return {
+            "tracked_users": len(self._accounts),
+            "pending_rows": len(self._pending_rows),
+            "flushed_rows": self.flushed_rows
+        }
+
+
+ledger = UsageLedger()
@@ -0,0 +1,278 @@
+"""
+Latency metrics for the chat hot path, exposed Prometheus-style at /metrics.
+
+Histograms have fixed buckets and are keyed by label values, so recording
+a sample is a dict lookup and a bisect; they are only touched from the
+event loop.  Per model key we record:
+
+    rodeoai_request_queue_seconds   arrival until dependencies start
+                                    (includes reading the request body)
+    rodeoai_stage_seconds           auth (token + user lookup) and quota
+    rodeoai_upstream_ttft_seconds   first token from the upstream that won
+    rodeoai_ttft_seconds            arrival until the first content delta
+    rodeoai_chunk_gap_seconds       gaps between content deltas
+    rodeoai_tokens_per_second       content deltas per second after the first
+    rodeoai_stream_duration_seconds arrival until the stream finished
+
+plus rodeoai_event_loop_lag_seconds from a background task that notices
+how late its own wake-ups are, and process_cpu_seconds_total.
+
+A sampling profiler can be switched on at runtime (`POST /metrics/profile`,
+guarded by the `X-Metrics-Key` header).  It samples the event loop thread's
+stack from a side thread and serves folded stacks, the input format of
+flamegraph.pl and speedscope.
+"""
+
+import asyncio
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncGenerator, AsyncIterable, Dict, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from fastapi.responses import PlainTextResponse
+
+METRICS_API_KEY = os.getenv("METRICS_API_KEY")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+router = APIRouter(tags=["metrics"])
+_histograms = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: Dict[tuple, list] = {}
+        _histograms.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labels, key))
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total:.6f}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return "\n".join(lines)
+
+
+REQUEST_QUEUE = Histogram("rodeoai_request_queue_seconds", "Time from request arrival until its dependencies start.", ("model",))
+STAGE = Histogram("rodeoai_stage_seconds", "Time spent in auth and quota checks.", ("model", "stage"))
+UPSTREAM_TTFT = Histogram("rodeoai_upstream_ttft_seconds", "Upstream time to first token; for a cancelled hedge loser, the time it had waited.", ("model", "upstream"))
+TTFT = Histogram("rodeoai_ttft_seconds", "Time from request arrival to the first content delta.", ("model", "source"))
+CHUNK_GAP = Histogram("rodeoai_chunk_gap_seconds", "Gap between consecutive content deltas.", ("model",))
+TOKENS_PER_SECOND = Histogram("rodeoai_tokens_per_second", "Content deltas per second after the first one.", ("model",), RATE_BUCKETS)
+STREAM_DURATION = Histogram("rodeoai_stream_duration_seconds", "Time from request arrival until the answer finished.", ("model", "source"))
+LOOP_LAG = Histogram("rodeoai_event_loop_lag_seconds", "How late the event loop ran a timer it was asked to run.")
+SCHEDULER_WAIT = Histogram("rodeoai_scheduler_wait_seconds", "Time a request queued for an upstream slot of its model.", ("model", "tier"))
+PASSWORD_HASH = Histogram("rodeoai_password_hash_seconds", "Time to hash or verify a password, including the wait for a hashing worker.", ("scheme", "op"))
+JOB_WAIT = Histogram("rodeoai_job_wait_seconds", "Time a background job was due before a worker started it.", ("kind",))
+JOB_RUN = Histogram("rodeoai_job_run_seconds", "Time a handler took for one batch of background jobs.", ("kind",))
+
+
+class ArrivalMiddleware:
+    """Stamp each HTTP request with its arrival time (`request.state.received_at`)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+def received_at(request: Request) -> float:
+    return getattr(request.state, "received_at", None) or time.perf_counter()
+
+
+def observe_request(request: Request, model_key: str) -> None:
+    """Record queueing and auth time that the dependencies noted on `request`."""
+    auth_started = getattr(request.state, "auth_started", None)
+    if auth_started is not None:
+        REQUEST_QUEUE.observe(auth_started - received_at(request), model=model_key)
+        STAGE.observe(request.state.auth_seconds, model=model_key, stage="auth")
+
+
+class StreamTimer:
+    """Records TTFT, chunk gaps, throughput and duration for one answer."""
+
+    def __init__(self, model_key: str, started: float, source: str = "upstream"):
+        self.model_key = model_key
+        self.started = started
+        self.source = source
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.chunks = 0
+
+    def chunk(self) -> None:
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+            TTFT.observe(now - self.started, model=self.model_key, source=self.source)
+        else:
+            CHUNK_GAP.observe(now - self.last, model=self.model_key)
+        self.last = now
+        self.chunks += 1
+
+    async def track(self, deltas: AsyncIterable[str]) -> AsyncGenerator[str, None]:
+        async for delta in deltas:
+            self.chunk()
+            yield delta
+
+    def finish(self) -> None:
+        STREAM_DURATION.observe(time.perf_counter() - self.started, model=self.model_key, source=self.source)
+        if self.source == "upstream" and self.chunks > 1 and self.last > self.first:
+            TOKENS_PER_SECOND.observe((self.chunks - 1) / (self.last - self.first), model=self.model_key)
+
+
+def render() -> str:
+    cpu = [
+        "# HELP process_cpu_seconds_total User and system CPU time spent by this process.",
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {time.process_time():.6f}"
+    ]
+    return "\n".join([histogram.render() for histogram in _histograms] + cpu) + "\n"
+
+
+async def _watch_loop_lag() -> None:
+    while True:
+        expected = time.perf_counter() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - expected))
+
+
+_lag_task: Optional[asyncio.Task] = None
+
+
+async def start_lag_monitor() -> None:
+    global _lag_task
+    if _lag_task is None and LOOP_LAG_INTERVAL > 0:
+        _lag_task = asyncio.get_running_loop().create_task(_watch_loop_lag())
+
+
+async def stop_lag_monitor() -> None:
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        try:
+            await _lag_task
+        except asyncio.CancelledError:
+            pass
+        _lag_task = None
+
+
+class SamplingProfiler:
+    """Periodically samples one thread's stack into folded-stack counts."""
+
+    def __init__(self):
+        self.samples: collections.Counter = collections.Counter()
+        self.started_at: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval: float = PROFILE_INTERVAL) -> None:
+        target = threading.get_ident()
+        self.samples.clear()
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(target, seconds, interval), name="metrics-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self, target: int, seconds: float, interval: float) -> None:
+        deadline = time.monotonic() + seconds
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self, top: int) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common(top))
+
+    def stats(self) -> dict:
+        return {"running": self.running, "started_at": self.started_at, "samples": sum(self.samples.values()), "stacks": len(self.samples)}
+
+
+profiler = SamplingProfiler()
+
+def require_metrics_key(x_metrics_key: Optional[str] = Header(None)) -> None:
+    if not METRICS_API_KEY or x_metrics_key != METRICS_API_KEY:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Metrics key required")
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    """Every histogram in the Prometheus text exposition format."""
+    return render()
+
+
+@router.post("/metrics/profile", dependencies=[Depends(require_metrics_key)])
+async def start_profile(seconds: float = 30, interval: float = PROFILE_INTERVAL) -> dict:
+    """Start sampling the event loop thread for up to `seconds`."""
+    if profiler.running:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profiler already running")
+    profiler.start(min(seconds, PROFILE_MAX_SECONDS), max(interval, 0.001))
+    return profiler.stats()
+
+
+@router.delete("/metrics/profile", dependencies=[Depends(require_metrics_key)])
+async def stop_profile() -> dict:
+    await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+    return profiler.stats()
+
+
+@router.get("/metrics/profile", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_key)])
+async def profile_samples(top: int = 500) -> str:
+    """Folded stacks collected so far, most frequent first."""
+    return profiler.folded(top)
@@ -0,0 +1,136 @@
+"""
+Schema migrations for rodeoai.db, tracked with `PRAGMA user_version`.
+
+db_models.init_all_tables creates the base tables; every entry in
+MIGRATIONS then runs once, in order, each in its own write transaction
+that also bumps user_version to the entry's position.  Workers starting
+at the same time serialize on the write lock and re-check the version, so
+a migration never runs twice.  Append new migrations; never edit or
+reorder ones that have shipped.
+
+    python migrations.py           # apply pending migrations
+    python migrations.py status
+"""
+
+import sqlite3
+import sys
+from typing import List, Tuple
+
+SEARCH_BACKFILL = """INSERT INTO messages_fts (rowid, content)
+    SELECT (c.user_id << 32) | m.id, m.content FROM messages m JOIN conversations c ON c.id = m.conversation_id
+    WHERE m.status = 'complete'"""
+
+MIGRATIONS: List[Tuple[str, List[str]]] = [
+    ("history indexes", [
+        # created rows used CURRENT_TIMESTAMP ("YYYY-MM-DD HH:MM:SS") while updates
+        # wrote isoformat ("...THH:MM:SS"); one format keeps string order = time order
+        "UPDATE conversations SET updated_at = replace(updated_at, ' ', 'T') WHERE updated_at LIKE '% %'",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)",
+    ]),
+    ("message search", [
+        # FTS5 index over completed messages.  Rows are keyed (user_id << 32) | message id,
+        # so one user's messages form a rowid range the index can seek to instead of
+        # intersecting with every user's matches.  Two- and three-character prefix
+        # indexes serve search-as-you-type terms ("ro*") without a term-range scan.
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, tokenize='porter unicode61', prefix='2 3')",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages WHEN new.status = 'complete' BEGIN
+             INSERT INTO messages_fts (rowid, content)
+             SELECT (user_id << 32) | new.id, new.content FROM conversations WHERE id = new.conversation_id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages WHEN old.status = 'complete' BEGIN
+             DELETE FROM messages_fts WHERE rowid = (SELECT (user_id << 32) | old.id FROM conversations WHERE id = old.conversation_id);
+           END""",
+        # drafts are checkpointed many times; only the finished message is indexed
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, status ON messages
+           WHEN old.status = 'complete' OR new.status = 'complete' BEGIN
+             DELETE FROM messages_fts WHERE old.status = 'complete'
+               AND rowid = (SELECT (user_id << 32) | old.id FROM conversations WHERE id = old.conversation_id);
+             INSERT INTO messages_fts (rowid, content)
+             SELECT (user_id << 32) | new.id, new.content FROM conversations WHERE id = new.conversation_id AND new.status = 'complete';
+           END""",
+        SEARCH_BACKFILL,
+    ]),
+    ("background jobs", [
+        # see jobs.py; times are unix seconds
+        """CREATE TABLE IF NOT EXISTS jobs (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             kind TEXT NOT NULL,
+             dedup_key TEXT,
+             payload TEXT NOT NULL,
+             priority INTEGER NOT NULL DEFAULT 0,
+             state TEXT NOT NULL DEFAULT 'queued',
+             attempts INTEGER NOT NULL DEFAULT 0,
+             run_after REAL NOT NULL,
+             created REAL NOT NULL,
+             started REAL,
+             error TEXT
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (state, priority, run_after, id)",
+        # one queued job per key; a running one does not stop the next from queueing
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_queued_key ON jobs (kind, dedup_key) WHERE state = 'queued'",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_running_key ON jobs (kind, dedup_key) WHERE state = 'running'",
+    ]),
+    ("archive", [
+        # see archive.py; an archived conversation keeps its row, its messages live in a segment file
+        "ALTER TABLE conversations ADD COLUMN archived INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_idle ON conversations (updated_at) WHERE archived = 0",
+        """CREATE TABLE IF NOT EXISTS archived_conversations (
+             conversation_id INTEGER PRIMARY KEY,
+             segment TEXT NOT NULL,
+             byte_offset INTEGER NOT NULL,
+             byte_length INTEGER NOT NULL,
+             messages INTEGER NOT NULL,
+             first_message INTEGER,
+             last_message INTEGER,
+             archived_at REAL NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_archived_segment ON archived_conversations (segment)",
+        "CREATE INDEX IF NOT EXISTS idx_archived_messages ON archived_conversations (first_message, last_message)",
+        """CREATE TABLE IF NOT EXISTS usage_daily (
+             user_id INTEGER NOT NULL,
+             day TEXT NOT NULL,
+             model TEXT NOT NULL,
+             requests INTEGER NOT NULL,
+             prompt_tokens INTEGER NOT NULL,
+             completion_tokens INTEGER NOT NULL,
+             total_tokens INTEGER NOT NULL,
+             cost REAL NOT NULL,
+             PRIMARY KEY (user_id, day, model)
+           )""",
+    ]),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations; returns the resulting schema version."""
+    conn.commit()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = current_version(conn)
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return version
+        try:
+            for statement in MIGRATIONS[version][1]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+if __name__ == "__main__":
+    from db_models import connection  # db_models creates the base tables on first connection
+    with connection() as conn:
+        if sys.argv[1:] == ["status"]:
+            version = current_version(conn)
+            for number, (name, _) in enumerate(MIGRATIONS, start=1):
+                print(f"{number:3d} {'applied' if number <= version else 'pending'}  {name}")
+        else:
+            print(f"schema version {migrate(conn)}")
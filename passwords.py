@@ -0,0 +1,169 @@
+"""
+Salted, memory-hard password hashing kept off the event loop.
+
+New hashes use `PASSWORD_SCHEME`: scrypt (the default), pbkdf2_sha256, or
+argon2 when the argon2-cffi package is installed.  Hashing a password
+costs tens of milliseconds of CPU by design, so it runs on a small
+dedicated thread pool (`PASSWORD_HASH_WORKERS`).  All three
+implementations release the GIL while they work, so a burst of logins
+queues for a hashing worker instead of stalling every other request.
+
+Stored hashes name their scheme and parameters:
+
+    scrypt$16384$8$1$<salt>$<hash>
+    pbkdf2_sha256$600000$<salt>$<hash>
+    $argon2id$v=19$m=65536,t=3,p=4$<salt>$<hash>
+
+The unsalted SHA-256 hex digests written by earlier versions still verify.
+`verify` reports when a hash is legacy or uses weaker parameters than the
+current settings, and login then stores a fresh hash, so accounts move to
+the new scheme as their owners sign in.
+
+    PASSWORD_HASH_WORKERS=0  hashes on the event loop (for comparison only)
+"""
+
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import importlib.util
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import metrics
+
+PASSWORD_SCHEME = os.getenv("PASSWORD_SCHEME", "scrypt")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", 8))
+SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", 1))
+PBKDF2_ITERATIONS = int(os.getenv("PASSWORD_PBKDF2_ITERATIONS", 600_000))
+
+if PASSWORD_SCHEME not in ("scrypt", "pbkdf2_sha256", "argon2"):
+    raise ValueError(f"Unknown PASSWORD_SCHEME {PASSWORD_SCHEME!r}")
+if PASSWORD_SCHEME == "argon2" and importlib.util.find_spec("argon2") is None:
+    raise ValueError("PASSWORD_SCHEME=argon2 needs the argon2-cffi package")
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="rodeoai-password") if PASSWORD_HASH_WORKERS > 0 else None
+
+
+@functools.lru_cache(maxsize=1)
+def _argon2():
+    """argon2's hasher, imported on first use (None without argon2-cffi)."""
+    try:
+        import argon2
+    except ImportError:
+        return None
+    return argon2.PasswordHasher()
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=32)
+
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def hash_password_sync(password: str) -> str:
+    if PASSWORD_SCHEME == "argon2":
+        return _argon2().hash(password)
+    salt = secrets.token_bytes(16)
+    if PASSWORD_SCHEME == "pbkdf2_sha256":
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(_pbkdf2(password, salt, PBKDF2_ITERATIONS))}"
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(_scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P))}"
+
+
+def scheme_of(stored: str) -> str:
+    if stored.startswith("$argon2"):
+        return "argon2"
+    if "$" in stored:
+        return stored.split("$", 1)[0]
+    return "sha256"
+
+
+def needs_rehash(stored: str) -> bool:
+    """True if `stored` is not a hash the current settings would produce."""
+    scheme = scheme_of(stored)
+    if scheme != PASSWORD_SCHEME:
+        return True
+    if scheme == "argon2":
+        return _argon2().check_needs_rehash(stored)
+    if scheme == "pbkdf2_sha256":
+        return int(stored.split("$")[1]) < PBKDF2_ITERATIONS
+    n, r, p = (int(v) for v in stored.split("$")[1:4])
+    return (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def verify_password_sync(password: str, stored: str) -> bool:
+    scheme = scheme_of(stored)
+    try:
+        if scheme == "sha256":
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        if scheme == "argon2":
+            hasher = _argon2()
+            if hasher is None:
+                return False
+            from argon2.exceptions import VerificationError
+            try:
+                return hasher.verify(stored, password)
+            except VerificationError:
+                return False
+        parts = stored.split("$")
+        if scheme == "pbkdf2_sha256":
+            computed = _pbkdf2(password, _unb64(parts[2]), int(parts[1]))
+            return hmac.compare_digest(computed, _unb64(parts[3]))
+        if scheme == "scrypt":
+            computed = _scrypt(password, _unb64(parts[4]), int(parts[1]), int(parts[2]), int(parts[3]))
+            return hmac.compare_digest(computed, _unb64(parts[5]))
+    except (ValueError, IndexError):
+        pass
+    return False
+
+
+async def _run(op: str, scheme: str, fn, *args):
+    start = time.perf_counter()
+    try:
+        if _executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args))
+    finally:
+        metrics.PASSWORD_HASH.observe(time.perf_counter() - start, scheme=scheme, op=op)
+
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", PASSWORD_SCHEME, hash_password_sync, password)
+
+
+_dummy_hash: Optional[str] = None
+
+
+async def verify(password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """Check `password` against `stored`; returns (ok, replacement hash or None).
+
+    With no stored hash (unknown account) a dummy hash is checked anyway, so
+    the response time does not reveal which emails are registered.
+    """
+    global _dummy_hash
+    if stored is None:
+        if _dummy_hash is None:
+            _dummy_hash = await hash_password(secrets.token_urlsafe(16))
+        await _run("verify", PASSWORD_SCHEME, verify_password_sync, password, _dummy_hash)
+        return False, None
+    ok = await _run("verify", scheme_of(stored), verify_password_sync, password, stored)
+    if ok and needs_rehash(stored):
+        return True, await hash_password(password)
+    return ok, None
+
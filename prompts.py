@@ -0,0 +1,111 @@
+"""
+Personas and the system prompts compiled from them.
+
+Every (model, persona) pair gets one `Prompt` when the module is imported:
+the model's own system prompt followed by the persona's voice.  It holds
+the ready-made upstream system message, its token count and a short
+fingerprint for response-cache keys, so a request no longer rebuilds,
+re-counts or re-hashes the prompt text.
+
+Providers cache prompt prefixes (OpenAI reuses a prefix of 1024+ tokens
+that is byte-identical to a recent request), so payloads are laid out
+most-stable first: the compiled system message, which never contains
+per-request data, then the conversation, whose window start only moves in
+steps (context.CONTEXT_TRIM_STEP).  The shared system message dicts must
+never be mutated.
+
+The personas are the ones quota.TIER_LIMITS grants per tier.
+"""
+
+import hashlib
+from typing import Dict, List, Sequence, Tuple
+
+from fastapi import HTTPException, status
+
+from config import MODEL_REGISTRY
+from context import budget_for, message_tokens, window_start
+
+PERSONAS: Dict[str, Dict[str, str]] = {
+    "general": {
+        "name": "RodeoAI",
+        "description": "The model's own voice",
+        "prompt": ""
+    },
+    "wesley": {
+        "name": "Wesley",
+        "description": "Roughstock coach",
+        "prompt": "Answer as Wesley, a retired saddle bronc and bull rider who now coaches roughstock riders. "
+                  "Focus on riding position, timing, rigging and riggers, mental preparation and staying safe. "
+                  "Talk like a patient coach in the practice pen: direct, encouraging, no fluff."
+    },
+    "dale": {
+        "name": "Dale",
+        "description": "Horseman and trainer",
+        "prompt": "Answer as Dale, a lifelong horseman who trains rope horses and barrel horses. "
+                  "Focus on horsemanship, conditioning, soundness, tack fit and reading a horse's behaviour. "
+                  "Explain the why behind every exercise and put the horse's welfare first."
+    },
+    "carlye": {
+        "name": "Carlye",
+        "description": "Barrel racing pro",
+        "prompt": "Answer as Carlye, a professional barrel racer who has run at the NFR. "
+                  "Focus on patterns, pockets, rate, ground conditions, hauling and entering rodeos. "
+                  "Be upbeat and specific, the way you would talk to a rider in the alley."
+    },
+    "ezekiel": {
+        "name": "Ezekiel",
+        "description": "Old-time rancher and historian",
+        "prompt": "Answer as Ezekiel, an old-time rancher and rodeo historian. "
+                  "Bring in the history of events, legendary riders and stock, ranch traditions and how the sport changed. "
+                  "Speak with plain-spoken, unhurried wisdom."
+    },
+    "westdesperado": {
+        "name": "West Desperado",
+        "description": "Outlaw storyteller",
+        "prompt": "Answer as the West Desperado, a tall-tale-telling outlaw of the old frontier. "
+                  "Keep the facts accurate but deliver them with swagger, colourful western slang and a wink. "
+                  "Stay friendly and never encourage anything unsafe."
+    }
+}
+
+
+class Prompt:
+    """A compiled system prompt for one model and persona."""
+
+    __slots__ = ("model_key", "persona", "text", "message", "tokens", "fingerprint")
+
+    def __init__(self, model_key: str, persona: str):
+        parts = [MODEL_REGISTRY[model_key]["system_prompt"], PERSONAS[persona]["prompt"]]
+        self.model_key = model_key
+        self.persona = persona
+        self.text = "\n\n".join(part for part in parts if part)
+        self.message = {"role": "system", "content": self.text}
+        self.tokens = message_tokens(self.text)
+        self.fingerprint = hashlib.sha256(self.text.encode()).hexdigest()[:16]
+
+    def assemble(self, messages: Sequence) -> List[dict]:
+        """Upstream messages for client-sent turns (objects with role/content): this prompt, then the newest that fit."""
+        start = window_start([message_tokens(m.content) for m in messages], budget_for(self.model_key) - self.tokens)
+        payload = [self.message]
+        payload.extend({"role": m.role, "content": m.content} for m in messages[start:])
+        return payload
+
+    def build(self, history: List[dict]) -> List[dict]:
+        """Upstream messages for an already trimmed history."""
+        payload = [self.message]
+        payload.extend(history)
+        return payload
+
+
+PROMPTS: Dict[Tuple[str, str], Prompt] = {
+    (model_key, persona): Prompt(model_key, persona)
+    for model_key in MODEL_REGISTRY
+    for persona in PERSONAS
+}
+
+
+def get(model_key: str, persona: str = "general") -> Prompt:
+    prompt = PROMPTS.get((model_key, persona))
+    if prompt is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid persona")
+    return prompt
@@ -1,17 +1,19 @@
+from typing import Dict
 from fastapi import HTTPException, status
-from db_models import get_user_usage_today
+from config import MODEL_REGISTRY
+from metering import ledger
 
 MODEL_COSTS = {
-    "bodacious": {"input": 0.000003, "output": 0.000015, "display_name": "Bodacious", "base_model": "gpt-4"},
-    "gold-buckle": {"input": 0.0000025, "output": 0.00001, "display_name": "Gold Buckle", "base_model": "gpt-4o"},
-    "scamper": {"input": 0.00000015, "output": 0.0000006, "display_name": "Scamper", "base_model": "gpt-4o-mini"}
+    key: {"input": entry["cost_input"], "output": entry["cost_output"], "display_name": entry["name"], "base_model": entry.get("base_model", entry["model"])}
+    for key, entry in MODEL_REGISTRY.items()
 }
 
+# model_limits caps the daily tokens of one model within daily_limit; models not listed share the whole limit
 TIER_LIMITS = {
-    "free": {"daily_limit": 10000, "allowed_models": ["scamper"], "allowed_personas": ["general", "westdesperado"]},
-    "pro": {"daily_limit": 500000, "allowed_models": ["scamper", "gold-buckle"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]},
-    "champion": {"daily_limit": 2000000, "allowed_models": ["scamper", "gold-buckle", "bodacious"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]},
-    "team": {"daily_limit": 10000000, "allowed_models": ["scamper", "gold-buckle", "bodacious"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]}
+    "free": {"daily_limit": 10000, "model_limits": {}, "allowed_models": ["scamper"], "allowed_personas": ["general", "westdesperado"]},
+    "pro": {"daily_limit": 500000, "model_limits": {"gold-buckle": 200000}, "allowed_models": ["scamper", "gold-buckle"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]},
+    "champion": {"daily_limit": 2000000, "model_limits": {"bodacious": 500000}, "allowed_models": ["scamper", "gold-buckle", "bodacious"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]},
+    "team": {"daily_limit": 10000000, "model_limits": {"bodacious": 2500000}, "allowed_models": ["scamper", "gold-buckle", "bodacious"], "allowed_personas": ["general", "wesley", "dale", "carlye", "ezekiel", "westdesperado"]}
 }
 
 def check_quota(user: dict, model: str) -> None:
@@ -19,10 +21,28 @@ def check_quota(user: dict, model: str) -> None:
     tier_config = TIER_LIMITS.get(tier, TIER_LIMITS["free"])
     if model not in tier_config["allowed_models"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Model '{model}' not available on {tier} tier. Upgrade to access.")
-    current_usage = get_user_usage_today(user["id"])
-    if current_usage >= tier_config["daily_limit"]:
+    if not ledger.admit(user, model, tier_config["daily_limit"], tier_config["model_limits"].get(model, -1)):
         raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Daily quota exceeded. Upgrade for more queries.")
 
+def check_batch_quota(user: dict, prompt_tokens: Dict[str, int]) -> float:
+    """check_quota for a whole batch at once; `prompt_tokens` maps each model to its items' prompt tokens.
+
+    Every model must be allowed and today's remaining allowance, in total
+    and per model, must cover all the prompts.  Returns their estimated cost.
+    """
+    for model in prompt_tokens:
+        check_quota(user, model)
+    tier_config = TIER_LIMITS.get(user.get("tier", "free"), TIER_LIMITS["free"])
+    daily_limit = tier_config["daily_limit"]
+    used = ledger.usage_today(user["id"]) or 0
+    if daily_limit >= 0 and used + sum(prompt_tokens.values()) > daily_limit:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Daily quota does not cover this batch. Send fewer requests or upgrade for more queries.")
+    for model, tokens in prompt_tokens.items():
+        model_limit = tier_config["model_limits"].get(model, -1)
+        if model_limit >= 0 and (ledger.usage_today(user["id"], model) or 0) + tokens > model_limit:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Daily quota for '{model}' does not cover this batch. Send fewer requests or upgrade for more queries.")
+    return round(sum(calculate_cost(model, tokens, 0) for model, tokens in prompt_tokens.items()), 6)
+
 def check_persona_access(user: dict, persona: str) -> None:
     tier = user.get("tier", "free")
     tier_config = TIER_LIMITS.get(tier, TIER_LIMITS["free"])
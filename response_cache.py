@@ -0,0 +1,174 @@
+"""
+Cache of completed chat answers in front of the upstream call.
+
+Answers are keyed on the model key, its system prompt and the normalised
+message list (case-folded, whitespace collapsed, trailing punctuation
+dropped), so "What is the NFR schedule?" and "what is the nfr schedule"
+share an entry.  Entries expire after `RESPONSE_CACHE_TTL` seconds and the
+least recently used ones are evicted beyond `RESPONSE_CACHE_SIZE`.
+
+A hit is replayed word by word at `RESPONSE_CACHE_REPLAY_RATE` pieces a
+second (0 sends them all at once), so the SSE coalescer frames it like a
+live stream instead of merging the whole answer into one frame.
+
+`RESPONSE_CACHE_BACKEND` selects where entries live: `memory` (the
+default with one worker), `sqlite` (the `RESPONSE_CACHE_PATH` file, shared
+by every worker on the host; the default with several) or `off`.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import AsyncGenerator, List, Optional
+
+import shared
+import store
+from cache import TTLCache
+from quota import calculate_cost
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "sqlite" if shared.enabled else "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 5000))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 6 * 60 * 60))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.db")
+RESPONSE_CACHE_REPLAY_RATE = float(os.getenv("RESPONSE_CACHE_REPLAY_RATE", 150))
+
+_WHITESPACE = re.compile(r"\s+")
+_REPLAY_PIECES = re.compile(r"\S+\s*|\s+")
+
+
+def normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip().casefold().rstrip("?!. ")
+
+
+def make_key(model_key: str, system_prompt: str, messages: List[dict]) -> str:
+    normalized = [(m["role"], normalize(m["content"])) for m in messages]
+    raw = json.dumps([model_key, system_prompt, normalized], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def replay_chunks(content: str) -> List[str]:
+    """Split a cached answer into word-sized deltas, like a live stream."""
+    return _REPLAY_PIECES.findall(content)
+
+
+async def replay(content: str, rate: float = RESPONSE_CACHE_REPLAY_RATE) -> AsyncGenerator[str, None]:
+    """Deltas of a cached answer, paced at `rate` pieces a second; the first goes out at once."""
+    for i, piece in enumerate(replay_chunks(content)):
+        if i and rate > 0:
+            await asyncio.sleep(1 / rate)
+        yield piece
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache("responses", maxsize, ttl)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    def set(self, key: str, entry: dict) -> None:
+        self._cache.set(key, entry)
+
+
+class SQLiteBackend:
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, entry: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO response_cache (key, entry, expires_at, last_used) VALUES (?, ?, ?, ?)", (key, json.dumps(entry), now + self.ttl, now))
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            self._conn.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+            self._conn.commit()
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        self.saved_cost = 0.0
+
+    async def get(self, model_key: str, key: str) -> Optional[dict]:
+        if self.backend is None:
+            return None
+        entry = await store.run(self.backend.get, key) if self.backend.blocking else self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_prompt_tokens += entry["prompt_tokens"]
+        self.saved_completion_tokens += entry["completion_tokens"]
+        self.saved_cost += calculate_cost(model_key, entry["prompt_tokens"], entry["completion_tokens"])
+        return entry
+
+    async def set(self, key: str, content: str, usage: dict) -> None:
+        if self.backend is None or not content:
+            return
+        entry = {
+            "content": content,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+        if self.backend.blocking:
+            await store.run(self.backend.set, key, entry)
+        else:
+            self.backend.set(key, entry)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": RESPONSE_CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "saved_tokens": self.saved_prompt_tokens + self.saved_completion_tokens,
+            "saved_cost": round(self.saved_cost, 6)
+        }
+
+
+def _make_backend():
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        return SQLiteBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    if RESPONSE_CACHE_BACKEND == "memory":
+        return MemoryBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    return None
+
+
+response_cache = ResponseCache(_make_backend())
@@ -0,0 +1,250 @@
+"""
+Latency-aware routing across the upstream models in config.MODEL_REGISTRY.
+
+For every upstream model the router keeps a rolling window of
+time-to-first-token samples and request outcomes (p50/p95 TTFT and error
+rate are reported by the health check) plus a circuit breaker: after
+`CIRCUIT_FAILURES` consecutive failures the model is skipped for
+`CIRCUIT_COOLDOWN` seconds, then a single probe request decides whether it
+closes again.
+
+A request starts on its own model.  If no token has arrived within the
+model's `ttft_budget`, the next fallback is started alongside it (a hedge)
+and whichever produces a token first is streamed; the other is cancelled.
+An upstream that fails before its first token is replaced by the next
+fallback straight away.  Once tokens have been sent to the client the
+request is committed to that upstream.
+
+A hedge loser cancelled after its budget ran out still counts: the time it
+had waited is recorded as a (censored) TTFT sample.  Once a model has at
+least `ROUTER_SLOW_SAMPLES` samples and its p95 is over budget, it is
+tried after its fallbacks instead of first, so requests stop paying for two
+upstream calls; every `ROUTER_SLOW_RETRY` seconds one request tries it
+first again, and a first token within budget restores it.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncGenerator, Deque, Dict, List, Optional
+
+import metrics
+import upstream
+from config import MODEL_REGISTRY
+
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", 5))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", 30))
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 200))
+ROUTER_SLOW_SAMPLES = int(os.getenv("ROUTER_SLOW_SAMPLES", 10))
+ROUTER_SLOW_RETRY = float(os.getenv("ROUTER_SLOW_RETRY", 30))
+# Overrides every model's ttft_budget; mainly for load tests.
+ROUTER_TTFT_BUDGET = os.getenv("ROUTER_TTFT_BUDGET")
+
+
+class UpstreamHealth:
+    def __init__(self):
+        self.ttfts: Deque[float] = deque(maxlen=ROUTER_WINDOW)
+        self.outcomes: Deque[bool] = deque(maxlen=ROUTER_WINDOW)
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.slow_since: Optional[float] = None
+
+    def available(self) -> bool:
+        if self.opened_at is None:
+            return True
+        return not self.probing and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN
+
+    def begin(self) -> bool:
+        """Note a request is starting; returns True if it is the half-open probe."""
+        if self.opened_at is None:
+            return False
+        self.probing = True
+        return True
+
+    def preferred(self) -> bool:
+        """Whether to try this model before its fallbacks; a slow one is retried every ROUTER_SLOW_RETRY seconds."""
+        if self.slow_since is None:
+            return True
+        if time.monotonic() - self.slow_since < ROUTER_SLOW_RETRY:
+            return False
+        self.slow_since = time.monotonic()
+        return True
+
+    def first_token(self, ttft: float, budget: float) -> None:
+        """Record a TTFT sample; for a cancelled attempt, the time it had waited."""
+        if ttft <= budget and self.slow_since is not None:
+            # recovered: forget the samples that made it slow
+            self.slow_since = None
+            self.ttfts.clear()
+        self.ttfts.append(ttft)
+        if self.slow_since is None and len(self.ttfts) >= ROUTER_SLOW_SAMPLES and self.percentile(0.95) > budget:
+            self.slow_since = time.monotonic()
+
+    def success(self) -> None:
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.probing or self.consecutive_failures >= CIRCUIT_FAILURES:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self) -> None:
+        """A probe that was cancelled proves nothing either way."""
+        self.probing = False
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.ttfts:
+            return None
+        ordered = sorted(self.ttfts)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "ttft_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "ttft_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.outcomes.count(False) / len(self.outcomes), 4) if self.outcomes else 0.0,
+            "circuit": "closed" if self.opened_at is None else "open",
+            "slow": self.slow_since is not None
+        }
+
+
+class Attempt:
+    def __init__(self, key: str, messages: List[dict], probe: bool):
+        self.key = key
+        self.probe = probe
+        self.config = MODEL_REGISTRY[key]
+        self.usage: dict = {}
+        self.started = time.monotonic()
+        self.stream = upstream.stream_chat(self.config["model"], messages, self.config["temperature"], self.config["max_tokens"], self.usage)
+        self.first = asyncio.ensure_future(self.stream.__anext__())
+
+    async def cancel(self) -> None:
+        self.first.cancel()
+        try:
+            await self.first
+        except BaseException:
+            pass
+        await self.stream.aclose()
+
+
+class ModelRouter:
+    def __init__(self):
+        self.health: Dict[str, UpstreamHealth] = {}
+        self.hedges = 0
+        self.failovers = 0
+
+    def _health(self, key: str) -> UpstreamHealth:
+        model = MODEL_REGISTRY[key]["model"]
+        health = self.health.get(model)
+        if health is None:
+            health = self.health[model] = UpstreamHealth()
+        return health
+
+    def chain(self, model_key: str) -> List[str]:
+        """The model followed by its fallbacks, skipping open circuits and trying slow models last."""
+        keys = [model_key] + MODEL_REGISTRY[model_key]["fallbacks"]
+        available = [key for key in keys if self._health(key).available()]
+        preferred = [key for key in available if self._health(key).preferred()]
+        return preferred + [key for key in available if key not in preferred] or [model_key]
+
+    def _budget(self, key: str) -> float:
+        return float(ROUTER_TTFT_BUDGET) if ROUTER_TTFT_BUDGET else MODEL_REGISTRY[key]["ttft_budget"]
+
+    async def stream(self, model_key: str, messages: List[dict], usage: Optional[dict] = None) -> AsyncGenerator[str, None]:
+        """Yield content deltas for `model_key`, hedging and failing over as needed.
+
+        `usage` is filled with the token counts of the upstream that answered
+        and `model_key`, the registry key it was served by.
+        """
+        candidates = iter(self.chain(model_key))
+        attempts: List[Attempt] = []
+        winner: Optional[Attempt] = None
+        first_chunk = None
+        error: Optional[BaseException] = None
+
+        exhausted = False
+
+        def launch() -> bool:
+            nonlocal exhausted
+            key = next(candidates, None)
+            if key is None:
+                exhausted = True
+                return False
+            attempts.append(Attempt(key, messages, self._health(key).begin()))
+            return True
+
+        launch()
+        try:
+            while winner is None:
+                if not attempts:
+                    raise error or RuntimeError(f"no upstream available for {model_key}")
+                newest = attempts[-1]
+                timeout = None if exhausted else max(0.0, newest.started + self._budget(newest.key) - time.monotonic())
+                done, _ = await asyncio.wait([a.first for a in attempts], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launch():
+                        self.hedges += 1
+                    continue
+                for attempt in [a for a in attempts if a.first in done]:
+                    attempts.remove(attempt)
+                    exc = attempt.first.exception()
+                    if exc is None or isinstance(exc, StopAsyncIteration):
+                        winner = attempt
+                        first_chunk = None if exc else attempt.first.result()
+                        break
+                    self._health(attempt.key).failure()
+                    error = exc
+                    if not attempts and launch():
+                        self.failovers += 1
+        finally:
+            for loser in attempts:
+                waited = time.monotonic() - loser.started
+                if waited > self._budget(loser.key):
+                    self._observe_ttft(loser, waited)
+                if loser.probe:
+                    self._health(loser.key).release()
+                await loser.cancel()
+
+        # the attempt's outcome is recorded once, when its stream ends
+        health = self._health(winner.key)
+        self._observe_ttft(winner, time.monotonic() - winner.started)
+        outcome = None
+        try:
+            if first_chunk is not None:
+                yield first_chunk
+                async for chunk in winner.stream:
+                    yield chunk
+            if usage is not None:
+                usage.update(winner.usage, model_key=winner.key)
+            outcome = True
+            health.success()
+        except Exception:
+            outcome = False
+            health.failure()
+            raise
+        finally:
+            if outcome is None and winner.probe:
+                health.release()
+            await winner.stream.aclose()
+
+    def _observe_ttft(self, attempt: Attempt, ttft: float) -> None:
+        self._health(attempt.key).first_token(ttft, self._budget(attempt.key))
+        metrics.UPSTREAM_TTFT.observe(ttft, model=attempt.key, upstream=attempt.config["model"])
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.hedges,
+            "failovers": self.failovers,
+            "upstreams": {model: health.stats() for model, health in self.health.items()}
+        }
+
+
+model_router = ModelRouter()
@@ -0,0 +1,237 @@
+"""
+Admission control and fair-share scheduling of upstream completions.
+
+Every chat that needs the upstream takes a ticket for its model's lane.  A
+lane runs at most `SCHEDULER_CONCURRENCY` completions for its model at
+once; the rest wait in a queue ordered by start-time fair queuing.  Every
+caller is a flow whose weight is that of its tier in quota.TIER_LIMITS
+(`SCHEDULER_TIER_WEIGHTS`): its virtual clock advances by 1/weight per
+request, so while several callers are waiting each gets slots in
+proportion to its tier's weight, a burst from one caller only delays that
+caller's own later requests, and an idle caller cannot bank credit for
+later.
+
+Requests are shed before they queue:
+
+* 429 when the caller already has `SCHEDULER_MAX_PER_USER` requests
+  waiting on that model, and
+* 503 when the model's queue holds `SCHEDULER_MAX_QUEUE` requests.
+
+Both carry a `Retry-After` estimated from the queue depth and the recent
+time a completion holds its slot.  Cache hits and requests that join an
+identical in-flight completion give their ticket back without taking a
+slot.  `SCHEDULER=off` disables the scheduler (upstream.py still caps
+concurrency per upstream model, first come first served).
+
+Queues are per worker process.  With `WEB_CONCURRENCY` workers each one
+gets its share of `SCHEDULER_CONCURRENCY` and `SCHEDULER_MAX_QUEUE`, so
+the host as a whole keeps to the configured limits; the per-caller limit
+applies within each worker.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import Counter
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+import metrics
+import shared
+from config import MODEL_REGISTRY
+from quota import TIER_LIMITS
+
+
+def _per_key(value: str) -> Dict[str, float]:
+    pairs = [item.split("=") for item in value.split(",") if "=" in item]
+    return {key.strip(): float(number) for key, number in pairs}
+
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER", "on") != "off"
+SCHEDULER_CONCURRENCY = _per_key(os.getenv("SCHEDULER_CONCURRENCY", "scamper=40,gold-buckle=20,bodacious=10"))
+SCHEDULER_TIER_WEIGHTS = _per_key(os.getenv("SCHEDULER_TIER_WEIGHTS", "free=1,pro=2,champion=4,team=4"))
+SCHEDULER_MAX_QUEUE = math.ceil(int(os.getenv("SCHEDULER_MAX_QUEUE", 200)) / shared.WORKERS)
+SCHEDULER_MAX_PER_USER = int(os.getenv("SCHEDULER_MAX_PER_USER", 10))
+SCHEDULER_POSITION_INTERVAL = float(os.getenv("SCHEDULER_POSITION_INTERVAL", 1))
+# Slot hold time assumed for Retry-After until completions have been measured
+SCHEDULER_SERVICE_ESTIMATE = float(os.getenv("SCHEDULER_SERVICE_ESTIMATE", 5))
+
+DEFAULT_CONCURRENCY = 20
+
+
+class Ticket:
+    def __init__(self, lane: "Lane", tier: str, owner: str, start: float, seq: int):
+        self.lane = lane
+        self.tier = tier
+        self.owner = owner
+        self.start = start
+        self.seq = seq
+        self.queued_at = time.perf_counter()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self.claimed = False
+        self.served = False
+        self._granted = asyncio.Event()
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.start, self.seq) < (other.start, other.seq)
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    async def wait(self) -> None:
+        """Block until this ticket holds a slot of its lane."""
+        await self._granted.wait()
+
+    def release(self) -> None:
+        """Give the slot back, or leave the queue; safe to call more than once."""
+        if not self.released:
+            self.released = True
+            self.lane.release(self)
+
+    def abandon(self) -> None:
+        """Release unless an answer has taken the ticket over (see `claimed`)."""
+        if not self.claimed:
+            self.release()
+
+    async def positions(self, repeat: float = 0) -> AsyncGenerator[int, None]:
+        """Queue position (1 = next) until a slot is granted: on every change, and every `repeat` seconds."""
+        last, last_sent = None, 0.0
+        while not self.granted and not self.released:
+            position = self.lane.position(self)
+            if position != last or (repeat > 0 and time.monotonic() - last_sent >= repeat):
+                last, last_sent = position, time.monotonic()
+                yield position
+            try:
+                await asyncio.wait_for(self._granted.wait(), SCHEDULER_POSITION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def hold(self, deltas: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+        """Stream `deltas` on this ticket's slot, releasing it when they end."""
+        try:
+            await self.wait()
+            self.served = True
+            async for delta in deltas:
+                yield delta
+        finally:
+            self.release()
+
+
+class Lane:
+    """Slots and fair queue of one model."""
+
+    def __init__(self, model_key: str, capacity: int):
+        self.model_key = model_key
+        self.capacity = capacity
+        self.running = 0
+        self.virtual = 0.0
+        self.finish: Dict[str, float] = {}  # virtual finish time of each caller's last request
+        self.heap: List[Ticket] = []
+        self.queued = 0
+        self.waiting: Counter = Counter()
+        self.service = SCHEDULER_SERVICE_ESTIMATE
+        self.granted = 0
+        self.shed = Counter()
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil((self.queued + 1) / self.capacity * self.service))
+
+    def check(self, owner: str) -> None:
+        if self.waiting[owner] >= SCHEDULER_MAX_PER_USER:
+            self.shed["429"] += 1
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many queued requests for this model",
+                                headers={"Retry-After": str(self.retry_after())})
+        if self.queued >= SCHEDULER_MAX_QUEUE:
+            self.shed["503"] += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Model '{self.model_key}' is overloaded, try again shortly",
+                                headers={"Retry-After": str(self.retry_after())})
+
+    def enqueue(self, tier: str, owner: str, seq: int) -> Ticket:
+        if len(self.finish) > 4 * (self.queued + self.capacity) + 1000:
+            # clocks behind the lane's are equivalent to none at all
+            self.finish = {key: finish for key, finish in self.finish.items() if finish > self.virtual}
+        start = max(self.virtual, self.finish.get(owner, 0.0))
+        self.finish[owner] = start + 1 / SCHEDULER_TIER_WEIGHTS.get(tier, 1)
+        ticket = Ticket(self, tier, owner, start, seq)
+        heapq.heappush(self.heap, ticket)
+        self.queued += 1
+        self.waiting[owner] += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self.running < self.capacity and self.heap:
+            ticket = heapq.heappop(self.heap)
+            if ticket.released:
+                continue
+            self.queued -= 1
+            self.waiting[ticket.owner] -= 1
+            if not self.waiting[ticket.owner]:
+                del self.waiting[ticket.owner]
+            self.running += 1
+            self.granted += 1
+            self.virtual = ticket.start
+            ticket.granted_at = time.perf_counter()
+            ticket._granted.set()
+            metrics.SCHEDULER_WAIT.observe(ticket.granted_at - ticket.queued_at, model=self.model_key, tier=ticket.tier)
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket.granted:
+            self.running -= 1
+            if ticket.served:
+                self.service += 0.1 * (time.perf_counter() - ticket.granted_at - self.service)
+        else:
+            # left while queued; its heap entry is skipped when it comes up
+            self.queued -= 1
+            self.waiting[ticket.owner] -= 1
+            if not self.waiting[ticket.owner]:
+                del self.waiting[ticket.owner]
+        self._dispatch()
+
+    def position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for other in self.heap if other < ticket and not other.released)
+
+    def stats(self) -> dict:
+        return {"capacity": self.capacity, "running": self.running, "queued": self.queued, "granted": self.granted,
+                "shed": dict(self.shed), "service_s": round(self.service, 2)}
+
+
+class Scheduler:
+    def __init__(self):
+        self.lanes = {
+            key: Lane(key, math.ceil(SCHEDULER_CONCURRENCY.get(key, DEFAULT_CONCURRENCY) / shared.WORKERS))
+            for key in MODEL_REGISTRY
+        }
+        self._seq = itertools.count()
+
+    def check(self, tier: str, model_key: str, owner: str) -> None:
+        """Raise the 429/503 `admit` would, without queueing."""
+        if SCHEDULER_ENABLED:
+            self.lanes[model_key].check(owner)
+
+    def admit(self, tier: str, model_key: str, owner: str) -> Optional[Ticket]:
+        """Queue for a slot of `model_key`, or raise 429/503; None when scheduling is off."""
+        if not SCHEDULER_ENABLED:
+            return None
+        lane = self.lanes[model_key]
+        lane.check(owner)
+        return lane.enqueue(tier if tier in TIER_LIMITS else "free", owner, next(self._seq))
+
+    def stats(self) -> dict:
+        return {"enabled": SCHEDULER_ENABLED, "lanes": {key: lane.stats() for key, lane in self.lanes.items()}}
+
+
+def identity(user: Optional[dict], client_host: Optional[str]) -> Tuple[str, str]:
+    """(tier, owner) of a request; anonymous callers count as free, keyed by address."""
+    if user is None:
+        return "free", f"ip:{client_host}"
+    return user.get("tier") or "free", f"user:{user['id']}"
+
+
+scheduler = Scheduler()
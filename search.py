@@ -0,0 +1,91 @@
+"""
+Full-text search over the signed-in user's conversation history.
+
+Completed messages are indexed in the `messages_fts` FTS5 table (porter
+stemming, so "roping" finds "rope"), kept current by triggers on
+`messages` (see migrations.py).  Index rows are keyed by user, so a search
+only visits the caller's messages instead of filtering everyone's
+matches.  Results come with HTML-escaped snippets whose matches are
+wrapped in <mark> tags, and are ranked with bm25 by default;
+`order=recent` skips the scoring, which has to read every user's postings
+for the query terms, and is the cheap choice for very common words.
+
+Free-text queries are reduced to quoted terms that must all match; a
+trailing `*` makes the last term a prefix.  To rebuild the index of an
+existing database (e.g. after a bulk import):
+
+    python search.py reindex
+    python search.py optimize
+"""
+
+import os
+import re
+import sys
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+import db_models
+import store
+from migrations import SEARCH_BACKFILL
+from auth import get_current_user
+
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", 8))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", 1000))
+
+router = APIRouter(prefix="/api/search", tags=["search"])
+
+
+def build_match(query: str) -> str:
+    """FTS5 expression for free text: every term quoted, so user input cannot inject syntax."""
+    terms = re.findall(r"\w+", query)[:SEARCH_MAX_TERMS]
+    if not terms:
+        return ""
+    match = " ".join(f'"{term}"' for term in terms)
+    return match + "*" if query.rstrip().endswith("*") else match
+
+
+@router.get("")
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    order: str = Query("relevance", pattern="^(relevance|recent)$"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Ranked messages matching `q`; pass `next_offset` back for the next page."""
+    match = build_match(q)
+    if not match:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Query has no searchable terms")
+    if offset > SEARCH_MAX_OFFSET:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Refine the query instead of paging this deep")
+    results = await store.run(db_models.search_messages, current_user["id"], match, limit, offset, order)
+    return {
+        "results": results,
+        "next_offset": offset + limit if len(results) == limit and offset + limit <= SEARCH_MAX_OFFSET else None
+    }
+
+
+def reindex() -> dict:
+    """Rebuild the index from every completed message, then merge its segments."""
+    start = time.perf_counter()
+    with store.connection() as conn:
+        conn.execute("DELETE FROM messages_fts")
+        indexed = conn.execute(SEARCH_BACKFILL).rowcount
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    return {"indexed": indexed, "seconds": round(time.perf_counter() - start, 2)}
+
+
+def optimize() -> dict:
+    start = time.perf_counter()
+    with store.connection() as conn:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    return {"seconds": round(time.perf_counter() - start, 2)}
+
+
+if __name__ == "__main__":
+    commands = {"reindex": reindex, "optimize": optimize}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        print(commands[sys.argv[1]]())
+    else:
+        print("usage: python search.py reindex|optimize")
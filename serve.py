@@ -0,0 +1,136 @@
+"""
+Process management for `python main.py`: workers, reloads and draining.
+
+`WEB_CONCURRENCY` uvicorn workers (default 1) share one listening socket;
+state they must agree on lives in shared.py.  The supervisor restarts a
+worker that dies and reloads all of them on SIGHUP without dropping a
+connection: a new set of workers starts accepting on the same socket
+before the old ones are told to stop.  SIGTERM or SIGINT stops everything.
+
+A worker told to stop drains instead of dropping its streams: it closes
+its listening socket, answers health checks with 503, lets running
+responses and background generations (drafts.py) finish for up to
+`DRAIN_TIMEOUT` seconds and only then cancels what is left.  Clients of a
+cancelled persisted stream can resume it from another worker with
+`Last-Event-ID`.
+
+    WEB_CONCURRENCY=4 python main.py
+    kill -HUP <supervisor pid>     # rolling reload, e.g. after a deploy
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import List, Optional
+
+import uvicorn
+
+import shared
+
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 30))
+# How long a reload waits for new workers to accept connections before stopping the old ones
+READY_TIMEOUT = 60
+
+logger = logging.getLogger("uvicorn.error")
+
+draining = False
+_drain_started: Optional[float] = None
+
+
+def begin_drain() -> None:
+    global draining, _drain_started
+    if not draining:
+        draining = True
+        _drain_started = time.monotonic()
+
+
+def drain_remaining() -> float:
+    """Seconds left of this worker's drain (0 when it is not draining)."""
+    if _drain_started is None:
+        return 0.0
+    return max(0.0, DRAIN_TIMEOUT - (time.monotonic() - _drain_started))
+
+
+class Server(uvicorn.Server):
+    """uvicorn's server, draining on the first stop signal and reporting when it accepts connections."""
+
+    def __init__(self, config: uvicorn.Config, ready=None):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None) -> None:
+        await super().startup(sockets)
+        if self.ready is not None and self.started:
+            self.ready.set()
+
+    def handle_exit(self, sig, frame) -> None:
+        begin_drain()
+        super().handle_exit(sig, frame)
+
+
+def _worker(config: uvicorn.Config, sockets, ready) -> None:
+    config.configure_logging()
+    Server(config, ready).run(sockets=sockets)
+
+
+class Supervisor:
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.sockets = [config.bind_socket()]
+        self.processes: List[multiprocessing.Process] = []
+        self.retiring: List[multiprocessing.Process] = []
+        self.context = multiprocessing.get_context("spawn")
+        self.should_exit = threading.Event()
+        self.should_reload = threading.Event()
+
+    def spawn(self) -> multiprocessing.Process:
+        ready = self.context.Event()
+        process = self.context.Process(target=_worker, args=(self.config, self.sockets, ready))
+        process.start()
+        process.ready = ready
+        return process
+
+    def reload(self) -> None:
+        logger.info("Reloading %d workers", self.workers)
+        fresh = [self.spawn() for _ in range(self.workers)]
+        deadline = time.monotonic() + READY_TIMEOUT
+        for process in fresh:
+            process.ready.wait(max(0.0, deadline - time.monotonic()))
+        for process in self.processes:
+            process.terminate()
+        self.retiring.extend(self.processes)
+        self.processes = fresh
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, lambda *_: self.should_exit.set())
+        signal.signal(signal.SIGTERM, lambda *_: self.should_exit.set())
+        signal.signal(signal.SIGHUP, lambda *_: self.should_reload.set())
+        logger.info("Started supervisor [%d] with %d workers", os.getpid(), self.workers)
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        while not self.should_exit.wait(0.5):
+            if self.should_reload.is_set():
+                self.should_reload.clear()
+                self.reload()
+            self.retiring = [p for p in self.retiring if p.is_alive()]
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning("Worker [%s] exited with %s; restarting it", process.pid, process.exitcode)
+                    self.processes[i] = self.spawn()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes + self.retiring:
+            process.join()
+        logger.info("Stopped supervisor [%d]", os.getpid())
+
+
+def run(app: str, host: str, port: int, workers: int = shared.WORKERS) -> None:
+    # uvicorn waits this long for open connections before cancelling them
+    config = uvicorn.Config(app, host=host, port=port, timeout_graceful_shutdown=DRAIN_TIMEOUT)
+    if workers <= 1:
+        Server(config).run()
+    else:
+        Supervisor(config, workers).run()
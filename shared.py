@@ -0,0 +1,219 @@
+"""
+State shared by the worker processes serving the API on one host.
+
+`python main.py` runs `WEB_CONCURRENCY` uvicorn workers (see serve.py).
+Each worker has its own memory, so state that must agree across them lives
+in one SQLite file, `SHARED_STATE_PATH`, opened in WAL mode by every
+worker:
+
+* counters: named integers that are incremented atomically (`add`) and
+  expire at a given time, e.g. a user's token usage for one UTC day;
+* leases: a named role held by one worker at a time, e.g. the one running
+  periodic analytics compaction;
+* a pub/sub channel: `publish` appends a message to the `events` table and
+  every other worker delivers it to its `subscribe`rs.  Workers look for
+  new events every `SHARED_POLL_INTERVAL` seconds with `PRAGMA
+  data_version`, which only changes after another connection committed,
+  so an idle channel costs no queries.
+
+With a single worker (and `SHARED_STATE` unset) nothing is shared:
+counters, leases and messages stay in process and the file is never
+created.  `SHARED_STATE=on` forces the shared backend, e.g. when running
+`uvicorn --workers` directly.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "shared_state.db")
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", 0.1))
+SHARED_EVENT_TTL = float(os.getenv("SHARED_EVENT_TTL", 60))
+
+enabled = os.getenv("SHARED_STATE", "on" if WORKERS > 1 else "off") == "on"
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, origin INTEGER NOT NULL, channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL);
+"""
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_subscribers: Dict[str, List[Callable]] = {}
+_counters: Dict[str, tuple] = {}
+_leases: Dict[str, float] = {}
+_task: Optional[asyncio.Task] = None
+published = 0
+delivered = 0
+
+
+def _connection() -> sqlite3.Connection:
+    """This thread's connection to the shared file."""
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(SHARED_STATE_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                _schema_ready = True
+    return conn
+
+
+# -- counters -------------------------------------------------------------
+
+def add(key: str, amount: int, expires: float) -> int:
+    """Add `amount` to counter `key` (created at 0, dropped after `expires`); returns the new value."""
+    if not enabled:
+        if len(_counters) > 100_000:
+            now = time.time()
+            for stale in [k for k, (_, until) in _counters.items() if until < now]:
+                del _counters[stale]
+        value = _counters.get(key, (0, 0))[0] + amount
+        _counters[key] = (value, expires)
+        return value
+    return _connection().execute(
+        "INSERT INTO counters (key, value, expires) VALUES (?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value RETURNING value",
+        (key, amount, expires)
+    ).fetchone()[0]
+
+
+def seed(key: str, value: int, expires: float) -> None:
+    """Create counter `key` at `value` unless some worker already has."""
+    if not enabled:
+        _counters.setdefault(key, (value, expires))
+        return
+    _connection().execute("INSERT OR IGNORE INTO counters (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+
+
+def get(*keys: str) -> List[int]:
+    """Current values of `keys` (0 for counters that do not exist)."""
+    if not enabled:
+        return [_counters.get(key, (0, 0))[0] for key in keys]
+    rows = dict(_connection().execute(
+        f"SELECT key, value FROM counters WHERE key IN ({','.join('?' * len(keys))})", keys
+    ).fetchall())
+    return [rows.get(key, 0) for key in keys]
+
+
+# -- leases ---------------------------------------------------------------
+
+def lease(name: str, ttl: float) -> bool:
+    """Take or renew role `name` for `ttl` seconds; False while another worker holds it."""
+    now = time.time()
+    if not enabled:
+        _leases[name] = now + ttl
+        return True
+    row = _connection().execute(
+        "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+        "WHERE leases.owner = excluded.owner OR leases.expires < ? RETURNING owner",
+        (name, os.getpid(), now + ttl, now)
+    ).fetchone()
+    return row is not None
+
+
+def release(name: str) -> None:
+    if not enabled:
+        _leases.pop(name, None)
+        return
+    _connection().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, os.getpid()))
+
+
+# -- pub/sub --------------------------------------------------------------
+
+def subscribe(channel: str, handler: Callable[[object], None]) -> None:
+    """Call `handler(message)` for every message other workers publish on `channel`."""
+    _subscribers.setdefault(channel, []).append(handler)
+
+
+def publish(channel: str, message: object) -> None:
+    """Send a JSON-serialisable `message` to the other workers; a no-op when nothing is shared."""
+    global published
+    if not enabled:
+        return
+    _connection().execute(
+        "INSERT INTO events (origin, channel, payload, created) VALUES (?, ?, ?, ?)",
+        (os.getpid(), channel, json.dumps(message), time.time())
+    )
+    published += 1
+
+
+def _deliver(conn: sqlite3.Connection, after: int) -> int:
+    global delivered
+    rows = conn.execute("SELECT id, origin, channel, payload FROM events WHERE id > ? ORDER BY id", (after,)).fetchall()
+    for event_id, origin, channel, payload in rows:
+        after = event_id
+        if origin == os.getpid():
+            continue
+        for handler in _subscribers.get(channel, ()):
+            try:
+                handler(json.loads(payload))
+            except Exception:
+                logger.exception("shared event handler for %r failed", channel)
+        delivered += 1
+    return after
+
+
+def _sweep(conn: sqlite3.Connection) -> None:
+    now = time.time()
+    conn.execute("DELETE FROM events WHERE created < ?", (now - SHARED_EVENT_TTL,))
+    conn.execute("DELETE FROM counters WHERE expires < ?", (now,))
+
+
+async def _poll() -> None:
+    # A connection of its own: data_version only reports commits by other connections.
+    conn = sqlite3.connect(SHARED_STATE_PATH, timeout=5, isolation_level=None)
+    try:
+        last = conn.execute("SELECT coalesce(max(id), 0) FROM events").fetchone()[0]
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        swept = time.monotonic()
+        while True:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            try:
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current != version:
+                    version = current
+                    last = _deliver(conn, last)
+                if time.monotonic() - swept >= SHARED_EVENT_TTL and lease("shared-sweep", SHARED_EVENT_TTL):
+                    swept = time.monotonic()
+                    _sweep(conn)
+            except sqlite3.Error:
+                logger.exception("polling shared events failed")
+    finally:
+        conn.close()
+
+
+async def start() -> None:
+    global _task
+    if enabled and _task is None:
+        _connection()
+        _task = asyncio.get_running_loop().create_task(_poll())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def stats() -> dict:
+    return {"enabled": enabled, "workers": WORKERS, "pid": os.getpid(), "published": published, "delivered": delivered}
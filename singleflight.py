@@ -0,0 +1,93 @@
+"""
+Request coalescing for identical in-flight completions.
+
+The first request for a key starts one upstream stream in a background
+task; every identical request that arrives while it runs attaches to the
+same flight.  Deltas are appended to a shared buffer and each subscriber
+reads it through its own cursor, so late joiners replay what was already
+emitted and a slow client never holds up the upstream stream or the other
+clients.  The upstream task runs to completion even if every subscriber
+disconnects, so its result can still be cached.
+"""
+
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+Fetch = Callable[[dict], AsyncIterator[str]]
+OnComplete = Callable[[str, dict], Awaitable[None]]
+
+
+class Flight:
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.usage: dict = {}
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+
+    async def _publish(self, chunk: Optional[str] = None) -> None:
+        async with self._changed:
+            if chunk is not None:
+                self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    async def run(self, fetch: Fetch, on_complete: Optional[OnComplete]) -> None:
+        try:
+            async for chunk in fetch(self.usage):
+                await self._publish(chunk)
+            if on_complete is not None:
+                await on_complete("".join(self.chunks), self.usage)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done = True
+            await self._publish()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        self.subscribers += 1
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: index < len(self.chunks) or self.done)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def stream(self, key: str, fetch: Fetch, on_complete: Optional[OnComplete] = None) -> AsyncGenerator[str, None]:
+        """Deltas for `key`, starting `fetch` only if no identical flight is running.
+
+        `on_complete(content, usage)` runs once, after the upstream stream of
+        the flight that was actually started has finished successfully.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight()
+            self.started += 1
+            task = asyncio.get_running_loop().create_task(flight.run(fetch, on_complete))
+            task.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self.coalesced += 1
+        return flight.subscribe()
+
+    def _land(self, key: str, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.flights), "started": self.started, "coalesced": self.coalesced}
+
+
+singleflight = SingleFlight()
@@ -0,0 +1,167 @@
+"""
+Server-sent event framing for chat streams.
+
+Upstream deltas are often a single token, so framing each one separately
+costs a JSON encode, an ASGI send and a socket write per token.  `coalesce`
+groups deltas instead: the first delta after a quiet spell goes out at
+once, later ones are held for at most `SSE_COALESCE_MS` or until
+`SSE_COALESCE_BYTES` have built up.  Idle streams get a `: ping` comment
+every `SSE_HEARTBEAT` seconds so proxies do not time them out.
+
+Frames are built from pre-encoded byte templates and keep the existing
+wire format (`data: {"content": ...}`), so clients need no change.  When
+`SSE_COMPRESSION` lists an encoding the client accepts (gzip, or br if the
+brotli package is installed), the stream is compressed with a flush after
+every write so frames are not held back by the compressor.
+"""
+
+import asyncio
+import json
+import os
+import zlib
+from json.encoder import encode_basestring_ascii
+from typing import AsyncGenerator, AsyncIterable, AsyncIterator, List, Optional
+
+from fastapi.responses import StreamingResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", 25))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", 512))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", 15))
+SSE_COMPRESSION = [e.strip() for e in os.getenv("SSE_COMPRESSION", "").split(",") if e.strip()]
+
+CONTENT_PREFIX = b'data: {"content": '
+FRAME_END = b'}\n\n'
+DONE_FRAME = b'data: {"done": true}\n\n'
+HEARTBEAT_FRAME = b': ping\n\n'
+HEADERS = {"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
+
+
+def content_frame(text: str, event_id: Optional[str] = None) -> bytes:
+    frame = CONTENT_PREFIX + encode_basestring_ascii(text).encode() + FRAME_END
+    return b"id: " + event_id.encode() + b"\n" + frame if event_id else frame
+
+
+def queued_frame(position: int) -> bytes:
+    return f'data: {{"queue_position": {int(position)}}}\n\n'.encode()
+
+
+def error_frame(message: str) -> bytes:
+    return f"data: {json.dumps({'error': message})}\n\n".encode()
+
+
+async def coalesce(
+    deltas: AsyncIterable[str],
+    window: float = SSE_COALESCE_MS / 1000,
+    max_bytes: int = SSE_COALESCE_BYTES,
+    heartbeat: float = SSE_HEARTBEAT
+) -> AsyncGenerator[Optional[str], None]:
+    """Yield runs of joined deltas; None means the stream has been idle for `heartbeat`."""
+    if window <= 0 and heartbeat <= 0:
+        async for delta in deltas:
+            yield delta
+        return
+
+    loop = asyncio.get_running_loop()
+    buffer: List[str] = []
+    size = 0
+    finished = False
+    error: Optional[BaseException] = None
+    waiter: Optional[asyncio.Future] = None
+
+    def wake() -> None:
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def produce() -> None:
+        nonlocal size, finished, error
+        try:
+            async for delta in deltas:
+                buffer.append(delta)
+                size += len(delta)
+                if len(buffer) == 1 or size >= max_bytes:
+                    wake()
+        except Exception as e:
+            error = e
+        finally:
+            finished = True
+            wake()
+
+    producer = loop.create_task(produce())
+    last_flush = float("-inf")
+    try:
+        while True:
+            if buffer:
+                due = last_flush + window
+                if finished or size >= max_bytes or loop.time() >= due:
+                    text = "".join(buffer)
+                    buffer.clear()
+                    size = 0
+                    last_flush = loop.time()
+                    yield text
+                    continue
+                timeout = due - loop.time()
+            elif finished:
+                break
+            else:
+                timeout = heartbeat if heartbeat > 0 else None
+            waiter = loop.create_future()
+            timer = loop.call_later(timeout, wake) if timeout is not None else None
+            await waiter
+            waiter = None
+            if timer is not None:
+                timer.cancel()
+            if not buffer and not finished:
+                yield None
+        if error is not None:
+            raise error
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    for encoding in SSE_COMPRESSION:
+        if encoding in accepted and (encoding != "br" or brotli is not None):
+            return encoding
+    return None
+
+
+async def compress(frames: AsyncIterator[bytes], encoding: str) -> AsyncGenerator[bytes, None]:
+    if encoding == "br":
+        compressor = brotli.Compressor()
+
+        def write(frame: bytes) -> bytes:
+            return compressor.process(frame) + compressor.flush()
+
+        tail = compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        def write(frame: bytes) -> bytes:
+            return compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        tail = compressor.flush
+    async for frame in frames:
+        yield write(frame)
+    yield tail()
+
+
+def event_stream(frames: AsyncIterator[bytes], accept_encoding: str = "", extra_headers: Optional[dict] = None, media_type: str = "text/event-stream") -> StreamingResponse:
+    """Wrap SSE frames (or other streamed lines, see batch.py) in a response, compressed if the client allows it."""
+    headers = dict(HEADERS, **(extra_headers or {}))
+    encoding = choose_encoding(accept_encoding) if SSE_COMPRESSION else None
+    if encoding is not None:
+        frames = compress(frames, encoding)
+        headers["Content-Encoding"] = encoding
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(frames, media_type=media_type, headers=headers)
@@ -0,0 +1,153 @@
+"""
+Pooled SQLite access shared by db_models and auth.
+
+Connections are opened once in WAL mode and handed out from a small pool,
+so each helper no longer pays for connect/close and readers do not block
+behind the writer.  Every pooled connection keeps its own prepared
+statement cache, which the sqlite3 module reuses whenever the same SQL
+text is executed again.
+
+Blocking calls should not run on the event loop; async code wraps them
+with `run`, which executes them on a bounded thread pool:
+
+    user = await store.run(get_user_by_id, user_id)
+
+Writes nobody waits for (shared counters, cache invalidations) go through
+`offload`, which hands them to the same pool when called on the loop.
+
+Nothing touches the database at import time.  Modules register one-time
+setup (schema creation, see db_models.ensure_schema) with `setup`; it runs
+before the first connection is handed out, or earlier with `prepare`.
+`warm` opens the pooled connections ahead of time.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, TypeVar
+
+DB_PATH = os.getenv("RODEOAI_DB", "rodeoai.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 5))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+
+T = TypeVar("T")
+
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="rodeoai-db")
+_setup: List[Callable[[], None]] = []
+_setup_lock = threading.RLock()
+_setup_running = False
+_ready = threading.Event()
+_ready.set()
+logger = logging.getLogger(__name__)
+
+
+def setup(fn: Callable[[], None]) -> None:
+    """Run `fn` once, before the first connection is handed out."""
+    with _setup_lock:
+        _setup.append(fn)
+        _ready.clear()
+
+
+def prepare() -> None:
+    """Run pending setup now, e.g. while the app starts rather than on its first request."""
+    _run_setup()
+
+
+def _run_setup() -> None:
+    global _setup_running
+    # other threads wait on the lock until every step has finished
+    with _setup_lock:
+        if _setup_running:
+            return  # a connection opened by the setup step itself
+        _setup_running = True
+        try:
+            while _setup:
+                _setup[0]()
+                _setup.pop(0)
+            _ready.set()
+        finally:
+            _setup_running = False
+
+
+def warm(connections: int = DB_POOL_SIZE) -> None:
+    """Fill the pool ahead of the first requests."""
+    while _pool.qsize() < connections:
+        _pool.put(_connect())
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE
+    )
+    conn.row_factory = sqlite3.Row
+    # before WAL: it only takes effect in a new, empty database (archive.py converts old ones)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def connection() -> Iterator[sqlite3.Connection]:
+    """Borrow a pooled connection; commits on success, rolls back on error."""
+    if not _ready.is_set():
+        _run_setup()
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if _pool.qsize() < DB_POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
+
+
+async def run(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking data-access call on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+def offload(fn: Callable[..., None], *args) -> None:
+    """Call blocking `fn(*args)` without waiting for it on the event loop.
+
+    On the loop thread it is submitted to the pool and a failure is logged;
+    anywhere else (a pool thread, a script) it simply runs.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        fn(*args)
+        return
+    _executor.submit(fn, *args).add_done_callback(_log_failure)
+
+
+def _log_failure(future: Future) -> None:
+    if future.exception() is not None:
+        logger.error("offloaded call failed", exc_info=future.exception())
+
+
+def close_all() -> None:
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
@@ -0,0 +1,77 @@
+"""
+Conversation titles, generated in the background.
+
+A new conversation gets a title job (jobs.py) due `TITLE_DELAY` seconds
+after its first turn is stored.  Conversations started within that time
+of each other are titled together: one Scamper call names up to
+`TITLE_BATCH_SIZE` of them from their first user message.  A title the model does not give falls
+back to the start of that message, and a title set in the meantime is
+kept.
+"""
+
+import os
+import re
+from typing import Dict, List
+
+import db_models
+import jobs
+import store
+import upstream
+from config import FOUNDATION_MODELS
+
+TITLE_MODEL = "scamper"
+TITLE_BATCH_SIZE = int(os.getenv("TITLE_BATCH_SIZE", 20))
+TITLE_DELAY = float(os.getenv("TITLE_DELAY", 5))
+TITLE_MAX_CHARS = 60
+# Characters of each opening message shown to the model
+TITLE_OPENING_CHARS = 500
+
+TITLE_PROMPT = (
+    "You name conversations with a rodeo assistant. For every numbered opening "
+    "message, reply with one line '<number>: <title>': a title of at most six "
+    "words, without quotes. Reply with the lines only."
+)
+
+_line = re.compile(r"^\s*(\d+)\s*[:.)-]\s*(.+?)\s*$")
+
+
+def fallback(text: str) -> str:
+    """The first line of `text`, cut at a word boundary to fit a title."""
+    line = text.strip().splitlines()[0] if text.strip() else ""
+    if len(line) <= TITLE_MAX_CHARS:
+        return line
+    return line[:TITLE_MAX_CHARS].rsplit(" ", 1)[0].rstrip(",.;:") + "…"
+
+
+def parse(reply: str) -> Dict[int, str]:
+    titles = {}
+    for line in (reply or "").splitlines():
+        match = _line.match(line)
+        if match:
+            titles[int(match.group(1))] = match.group(2).strip("\"'")[:TITLE_MAX_CHARS]
+    return titles
+
+
+def schedule(conversation_id: int) -> None:
+    jobs.defer("title", {"conversation_id": conversation_id}, key=str(conversation_id), delay=TITLE_DELAY)
+
+
+async def generate(payloads: List[dict]) -> None:
+    openings = await store.run(db_models.get_untitled_openings, list({p["conversation_id"] for p in payloads}))
+    if not openings:
+        return
+    numbered = list(openings.items())
+    listing = "\n".join(f"{i}: {' '.join(text[:TITLE_OPENING_CHARS].split())}" for i, (_, text) in enumerate(numbered, 1))
+    reply = await upstream.complete_chat(
+        FOUNDATION_MODELS[TITLE_MODEL]["openai_model"],
+        [{"role": "system", "content": TITLE_PROMPT}, {"role": "user", "content": listing}],
+        0.3,
+        20 * len(numbered)
+    )
+    titles = parse(reply)
+    await store.run(db_models.set_generated_titles, [
+        (titles.get(i) or fallback(text), conversation_id) for i, (conversation_id, text) in enumerate(numbered, 1)
+    ])
+
+
+jobs.register("title", generate, batch_size=TITLE_BATCH_SIZE, priority=1, linger=TITLE_DELAY)
@@ -0,0 +1,114 @@
+"""
+Shared async client for the upstream OpenAI API.
+
+All chat endpoints go through this module so they share one bounded,
+keep-alive connection pool instead of each building a blocking client.
+Concurrency is additionally capped per upstream model so a burst of slow
+completions on one model cannot take every connection in the pool.
+The SDK's own retries are capped by `UPSTREAM_MAX_RETRIES` (none by
+default): routing.py fails over to a fallback model instead of retrying a
+struggling one.
+
+The SDK and httpx take about half a second to import, so they are
+imported when the client is built (by `preload` while the app starts, or
+on first use) rather than with this module.
+"""
+
+import asyncio
+import os
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20))
+UPSTREAM_MODEL_CONCURRENCY = int(os.getenv("UPSTREAM_MODEL_CONCURRENCY", 50))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 0))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", 120))
+
+_client: Optional["AsyncOpenAI"] = None
+_model_slots: Dict[str, asyncio.Semaphore] = {}
+
+
+def preload() -> None:
+    """Import the SDK and build the client, e.g. on a worker thread while the app starts."""
+    get_client()
+
+
+def get_client() -> "AsyncOpenAI":
+    """Return the process-wide client, creating it on first use."""
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        http_client = httpx.AsyncClient(
+            http2=UPSTREAM_HTTP2,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=10.0),
+        )
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=UPSTREAM_MAX_RETRIES)
+    return _client
+
+
+def model_slot(model: str) -> asyncio.Semaphore:
+    """Concurrency limiter for a single upstream model."""
+    slot = _model_slots.get(model)
+    if slot is None:
+        slot = _model_slots[model] = asyncio.Semaphore(UPSTREAM_MODEL_CONCURRENCY)
+    return slot
+
+
+def _fill_usage(usage: Optional[dict], reported) -> None:
+    if usage is not None and reported is not None:
+        usage["prompt_tokens"] = reported.prompt_tokens
+        usage["completion_tokens"] = reported.completion_tokens
+
+
+async def stream_chat(model: str, messages: List[dict], temperature: float, max_tokens: int, usage: Optional[dict] = None) -> AsyncGenerator[str, None]:
+    """Yield content deltas of a streamed completion.
+
+    If `usage` is given it is filled with the token counts the upstream
+    reports at the end of the stream.
+    """
+    extra = {"stream_options": {"include_usage": True}} if usage is not None else {}
+    async with model_slot(model):
+        stream = await get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            **extra
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                _fill_usage(usage, chunk.usage)
+        finally:
+            await stream.close()
+
+
+async def complete_chat(model: str, messages: List[dict], temperature: float, max_tokens: int, usage: Optional[dict] = None) -> str:
+    """Return the content of a non-streamed completion."""
+    async with model_slot(model):
+        response = await get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+    _fill_usage(usage, response.usage)
+    return response.choices[0].message.content
+
+
+async def close() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None